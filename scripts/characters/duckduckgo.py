@@ -12,6 +12,8 @@ class DDG(Character):
         self.level = 95
         self.weight = 0.25
         self.non_repeat = False
+        self.prefetch = True
+        self.speculative = True
 
     def ask(self, question):
         response = requests.get('http://api.duckduckgo.com', params={'q': question, 'format': 'json'})
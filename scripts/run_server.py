@@ -77,7 +77,8 @@ from flask import Flask, request, Response, send_from_directory
 from chatbot.server.chatbot_agent import (
     ask, list_character, session_manager, set_weights, set_context,
     dump_history, dump_session, add_character, list_character_names,
-    rate_answer, get_context, said, remove_context, update_config)
+    rate_answer, get_context, said, remove_context, update_config,
+    reload_aiml_files, session_memory, tier_budget, timing)
 from chatbot.stats import history_stats
 
 json_encode = json.JSONEncoder().encode
@@ -108,12 +109,26 @@ def _chat():
     lang = data.get('lang', 'en-US')
     query = data.get('query', 'false')
     query = query.lower() == 'true'
+    trace = data.get('trace', 'true')
+    trace = trace.lower() == 'true'
+    timeout = data.get('timeout')
+    if timeout is not None:
+        try:
+            timeout = float(timeout)
+            if timeout < 0:
+                raise ValueError(timeout)
+        except ValueError:
+            return Response(json_encode({
+                'ret': False,
+                'response': {'err_msg': 'Invalid timeout {}'.format(timeout)}
+            }), status=400, mimetype="application/json")
     request_id = request.headers.get('X-Request-Id')
     marker = data.get('marker', 'default')
     run_id = data.get('run_id', '')
     response, ret = ask(
         question, lang, session, query,
-        request_id=request_id, marker=marker, run_id=run_id)
+        request_id=request_id, marker=marker, run_id=run_id, trace=trace,
+        timeout=timeout)
     return Response(json_encode({'ret': ret, 'response': response}),
                     mimetype="application/json")
 
@@ -283,6 +298,39 @@ def _update_config():
     return Response(json_encode({'ret': ret, 'response': response}),
                     mimetype="application/json")
 
+@app.route(ROOT + '/reload_aiml', methods=['GET'])
+@requires_auth
+def _reload_aiml():
+    try:
+        response = reload_aiml_files()
+        ret = True
+    except Exception as ex:
+        ret, response = False, {'err_msg': str(ex)}
+        logger.error(ex)
+    return Response(json_encode({'ret': ret, 'response': response}),
+                    mimetype="application/json")
+
+@app.route(ROOT + '/session_memory', methods=['GET'])
+@requires_auth
+def _session_memory():
+    response = session_memory()
+    return Response(json_encode({'ret': True, 'response': response}),
+                    mimetype="application/json")
+
+@app.route(ROOT + '/tier_budget', methods=['GET'])
+@requires_auth
+def _tier_budget():
+    response = tier_budget()
+    return Response(json_encode({'ret': True, 'response': response}),
+                    mimetype="application/json")
+
+@app.route(ROOT + '/timing', methods=['GET'])
+@requires_auth
+def _timing():
+    response = timing()
+    return Response(json_encode({'ret': True, 'response': response}),
+                    mimetype="application/json")
+
 @app.route('/log')
 def _log():
     def generate():
@@ -0,0 +1,392 @@
+"""
+Copyright 2003-2010 Cort Stratton. All rights reserved.
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+# This class stores the same node tree as PatternMgr, in a compiled form
+# that is much cheaper to keep in memory.  Every word is interned to an
+# integer id, and the nodes are laid out breadth-first in flat arrays so
+# that the children of a node are contiguous:
+#
+#  - _first[n] .. _first[n+1] is the range of node n's edges,
+#  - _keys[i] is the key id of edge i (edges of a node are sorted by key),
+#    and edge i leads to node i+1,
+#  - _tmpl[n] is the index of node n's template in _templates, or -1,
+#  - _minLen[n] and _maxLen[n] are the length bounds of node n (see
+#    PatternMgr._computeLengthBounds()).
+#
+# Key ids below _FIRST_WORD_ID are the special dictionary keys of
+# PatternMgr (_UNDERSCORE, _STAR, _THAT, ...).  Words get their ids in
+# the order of their UTF-8 encoding, so that the word table can be
+# searched without a dictionary (see MappedPatternMgr).
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from operator import itemgetter
+import threading
+import logging
+
+from PatternMgr import PatternMgr
+
+logger = logging.getLogger('hr.chatbot.aiml.compiledpatternmgr')
+
+
+def _utf8(word):
+    return unicode(word).encode('utf-8')
+
+
+class CompiledPatternMgr(PatternMgr):
+    _FIRST_WORD_ID = 6
+
+    def __init__(self):
+        PatternMgr.__init__(self)
+        # Newly added categories go into the dict-based tree in self._root,
+        # which is compiled into the arrays the next time a match is made.
+        self._dirty = False
+        self._compileLock = threading.Lock()
+        self._wordIds = {}
+        self._words = []
+        self._templates = []
+        self._first = array('i', [0, 0])
+        self._keys = array('i')
+        self._tmpl = array('i', [-1])
+        self._minLen = array('i', [self._UNBOUNDED])
+        self._maxLen = array('i', [-1])
+
+    def templates(self):
+        """Return a list of all templates currently stored."""
+        if self._dirty:
+            return PatternMgr.templates(self)
+        return list(self._templates)
+
+    def restore(self, filename):
+        """Restore a previously save()d collection of patterns."""
+        with self._compileLock:
+            PatternMgr.restore(self, filename)
+            self._dirty = True
+
+    def add(self, (pattern, that, topic), template):
+        """Add a [pattern/that/topic] tuple and its corresponding template
+        to the node tree.
+
+        """
+        with self._compileLock:
+            if not self._dirty:
+                self._root = self._thaw()
+                self._dirty = True
+            PatternMgr.add(self, (pattern, that, topic), template)
+
+    def get(self, (pattern, that, topic)):
+        """Return the template of the [pattern/that/topic] tuple, or None
+        if it has none.
+
+        """
+        with self._compileLock:
+            if self._dirty:
+                return PatternMgr.get(self, (pattern, that, topic))
+            node = 0
+            for key in self._path((pattern, that, topic)):
+                if not isinstance(key, int):
+                    key = self._wordIds.get(key, -1)
+                node = self._child(node, key)
+                if node < 0:
+                    return None
+            tid = self._tmpl[node]
+            if tid < 0:
+                return None
+            return self._templates[tid]
+
+    def remove(self, (pattern, that, topic)):
+        """Remove the template of a [pattern/that/topic] tuple from the
+        node tree.  Returns the removed template, or None if there was
+        none.
+
+        """
+        # don't thaw the tree for nothing
+        if self.get((pattern, that, topic)) is None:
+            return None
+        with self._compileLock:
+            if not self._dirty:
+                self._root = self._thaw()
+                self._dirty = True
+            return PatternMgr.remove(self, (pattern, that, topic))
+
+    def compile(self):
+        """Compile the pending additions into the node arrays and release
+        the dict-based tree.
+
+        """
+        with self._compileLock:
+            if not self._dirty:
+                return
+            words = set()
+            stack = [self._root]
+            while stack:
+                node = stack.pop()
+                for key, child in node.iteritems():
+                    if key == self._TEMPLATE:
+                        continue
+                    if not isinstance(key, int):
+                        words.add(key)
+                    stack.append(child)
+            words = sorted(words, key=_utf8)
+            wordIds = dict((word, self._FIRST_WORD_ID + i)
+                           for i, word in enumerate(words))
+            templates = []
+            first = array('i', [0])
+            keys = array('i')
+            tmpl = array('i')
+            queue = deque([self._root])
+            while queue:
+                node = queue.popleft()
+                edges = []
+                for key, child in node.iteritems():
+                    if key == self._TEMPLATE:
+                        continue
+                    if isinstance(key, int):
+                        keyId = key
+                    else:
+                        keyId = wordIds[key]
+                    edges.append((keyId, child))
+                edges.sort(key=itemgetter(0))
+                for keyId, child in edges:
+                    keys.append(keyId)
+                    queue.append(child)
+                first.append(len(keys))
+                if node.has_key(self._TEMPLATE):
+                    tmpl.append(len(templates))
+                    templates.append(node[self._TEMPLATE])
+                else:
+                    tmpl.append(-1)
+            self._wordIds = wordIds
+            self._words = words
+            self._templates = templates
+            self._first = first
+            self._keys = keys
+            self._tmpl = tmpl
+            self._minLen, self._maxLen = self._computeArrayLengthBounds()
+            self._root = {}
+            self._dirty = False
+            logger.debug("Compiled %d nodes, %d words, %d templates" % (
+                len(tmpl), len(words), len(templates)))
+
+    def _computeArrayLengthBounds(self):
+        """Return the arrays of the minimum and maximum length bounds of
+        the nodes, as PatternMgr._computeLengthBounds() defines them.
+
+        """
+        unbounded = self._UNBOUNDED
+        nodeCount = len(self._tmpl)
+        minLen = array('i', [unbounded]) * nodeCount
+        maxLen = array('i', [-1]) * nodeCount
+        # the children of a node come after it, so visit them first
+        for n in xrange(nodeCount - 1, -1, -1):
+            lo, hi = unbounded, -1
+            if self._tmpl[n] >= 0:
+                lo, hi = 0, 0
+            for i in xrange(self._first[n], self._first[n + 1]):
+                key = self._keys[i]
+                if key == self._THAT or key == self._TOPIC:
+                    # the segment can end here
+                    lo, hi = 0, max(hi, 0)
+                    continue
+                childLo, childHi = minLen[i + 1], maxLen[i + 1]
+                if childLo > childHi:
+                    continue
+                if key == self._UNDERSCORE or key == self._STAR:
+                    childHi = unbounded
+                elif childHi < unbounded:
+                    childHi += 1
+                lo = min(lo, childLo + 1)
+                hi = max(hi, childHi)
+            minLen[n] = lo
+            maxLen[n] = hi
+        return minLen, maxLen
+
+    def _tree(self):
+        """Return the node tree as nested dictionaries."""
+        if self._dirty:
+            return self._root
+        return self._thaw()
+
+    def _thaw(self):
+        """Rebuild the dict-based node tree from the node arrays."""
+        nodes = [{} for n in xrange(len(self._tmpl))]
+        for n, node in enumerate(nodes):
+            for i in xrange(self._first[n], self._first[n + 1]):
+                key = self._keys[i]
+                if key >= self._FIRST_WORD_ID:
+                    key = self._words[key - self._FIRST_WORD_ID]
+                node[key] = nodes[i + 1]
+            if self._tmpl[n] >= 0:
+                node[self._TEMPLATE] = self._templates[self._tmpl[n]]
+        return nodes[0]
+
+    def _child(self, node, key):
+        """Return the node reached from node by the edge key, or -1."""
+        lo = self._first[node]
+        hi = self._first[node + 1]
+        i = bisect_left(self._keys, key, lo, hi)
+        if i < hi and self._keys[i] == key:
+            return i + 1
+        return -1
+
+    def _rootNode(self):
+        if self._dirty:
+            self.compile()
+        return 0
+
+    def _childNode(self, node, key):
+        """Return the child of node by the edge key, or None."""
+        child = self._child(node, key)
+        if child < 0:
+            return None
+        return child
+
+    def _childNodes(self, node):
+        """Return the list of (key, child) of the children of node."""
+        return [(self._keys[i], i + 1)
+                for i in xrange(self._first[node], self._first[node + 1])]
+
+    def _nodeTemplate(self, node):
+        tid = self._tmpl[node]
+        if tid < 0:
+            return None
+        return self._templates[tid]
+
+    def _wordKey(self, word):
+        """Return the key of the edges of word."""
+        return self._wordIds.get(word, -1)
+
+    def _matchRoot(self, words, thatWords, topicWords, botName):
+        """Match the mutilated input words against the whole node tree.
+        Returns the same (pat, tem, spans) tuple as PatternMgr._matchRoot().
+
+        """
+        if self._dirty:
+            self.compile()
+        segments = (words, thatWords, topicWords)
+        wordIds = self._wordIds
+        ids = tuple([wordIds.get(word, -1) for word in segment]
+                    for segment in segments)
+        return self._matchNode(segments, ids, 0, 0, 0, botName)
+
+    def _splits(self, pos, end, child):
+        """Return the positions after the words a wildcard leading to
+        child can match, from the word at pos to end.
+
+        """
+        if self._minLen is None:
+            return xrange(pos + 1, end + 1)
+        return xrange(max(pos + 1, end - self._maxLen[child]),
+                      end - self._minLen[child] + 1)
+
+    def _matchNode(self, segments, ids, seg, pos, node, botName):
+        """Return a tuple (pat, tem, spans) for the words of segments[seg]
+        starting at pos, matched from node.  seg is 0 for the input, 1
+        for 'that' and 2 for 'topic'.  botName is the word matched by
+        <bot name="name">.
+
+        This follows the search of PatternMgr._matchRoot() step by step,
+        so both return the same result, except that nodes whose length bounds exclude
+        the number of words left aren't searched.
+
+        """
+        words = segments[seg]
+        end = len(words)
+        minLen = self._minLen
+        if minLen is not None:
+            left = end - pos
+            if left < minLen[node] or left > self._maxLen[node]:
+                return (None, None, None)
+        if pos == end:
+            # we're out of words.
+            pattern = []
+            template = None
+            spans = []
+            nextSeg = None
+            if seg == 0 and len(segments[1]) > 0:
+                nextSeg, marker = 1, self._THAT
+            elif seg < 2 and len(segments[2]) > 0:
+                nextSeg, marker = 2, self._TOPIC
+            if nextSeg is not None:
+                child = self._child(node, marker)
+                if child >= 0:
+                    pattern, template, spans = self._matchNode(
+                        segments, ids, nextSeg, 0, child, botName)
+                    if pattern is not None:
+                        pattern = [marker] + pattern
+            if template is None:
+                # we're totally out of input.  Grab the template at this node.
+                pattern = []
+                spans = []
+                tid = self._tmpl[node]
+                if tid >= 0:
+                    template = self._templates[tid]
+            return (pattern, template, spans)
+
+        first = words[pos]
+
+        # Check underscore.
+        child = self._child(node, self._UNDERSCORE)
+        if child >= 0:
+            for p in self._splits(pos, end, child):
+                pattern, template, spans = self._matchNode(
+                    segments, ids, seg, p, child, botName)
+                if template is not None:
+                    return ([self._UNDERSCORE] + pattern, template,
+                            [(end - pos, p - pos)] + spans)
+
+        # Check first
+        firstId = ids[seg][pos]
+        if firstId >= 0:
+            child = self._child(node, firstId)
+            if child >= 0:
+                pattern, template, spans = self._matchNode(
+                    segments, ids, seg, pos + 1, child, botName)
+                if template is not None:
+                    return ([first] + pattern, template, spans)
+
+        # check bot name
+        if first == botName:
+            child = self._child(node, self._BOT_NAME)
+            if child >= 0:
+                pattern, template, spans = self._matchNode(
+                    segments, ids, seg, pos + 1, child, botName)
+                if template is not None:
+                    return ([first] + pattern, template, spans)
+
+        # check star
+        child = self._child(node, self._STAR)
+        if child >= 0:
+            for p in self._splits(pos, end, child):
+                pattern, template, spans = self._matchNode(
+                    segments, ids, seg, p, child, botName)
+                if template is not None:
+                    return ([self._STAR] + pattern, template,
+                            [(end - pos, p - pos)] + spans)
+
+        # No matches were found.
+        return (None, None, None)
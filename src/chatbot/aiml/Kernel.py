@@ -31,11 +31,18 @@ import AimlParser
 import DefaultSubs
 import Utils
 from PatternMgr import PatternMgr
+from Session import QuerySession, SessionStore
+from TemplateCompiler import TemplateCompiler
+from CompiledPatternMgr import CompiledPatternMgr
+from MappedPatternMgr import MappedPatternMgr, saveMapped
 from WordSub import WordSub
 
 from ConfigParser import ConfigParser
+from collections import OrderedDict
 import copy
 import glob
+import itertools
+import multiprocessing
 import os
 import random
 import re
@@ -49,6 +56,90 @@ import logging
 logger = logging.getLogger('hr.chatbot.aiml.kernel')
 
 
+def _forkIsSafe():
+    """Return True if worker processes can be forked.  A process forked
+    while other threads run gets the locks they hold, which are never
+    released in it, so only a single-threaded process forks."""
+    return threading.active_count() == 1
+
+
+def _parseAimlFile(args):
+    """Parse an AIML file.  Return its categories and the parse error.
+
+    This is run by the worker processes of Kernel.learn().
+
+    """
+    filename, encoding = args
+    parser = AimlParser.create_parser()
+    handler = parser.getContentHandler()
+    handler.setEncoding(encoding)
+    try:
+        parser.parse(filename)
+    except xml.sax.SAXParseException, msg:
+        err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (filename, msg)
+        return None, err
+    return handler.categories, None
+
+
+# The Kernel and arguments of the matchMany() call whose worker processes
+# are being forked, which inherit them.
+_batchMatch = None
+_batchMatchLock = threading.Lock()
+
+
+def _matchBatch(inputs):
+    """Match a batch of inputs.  This is run by the worker processes of
+    Kernel.matchMany().
+
+    """
+    kernel, that, topic = _batchMatch
+    return kernel._matchMany(inputs, that, topic)
+
+
+def _traceRecord(template):
+    """Return the trace record of a template: the 'doc' and 'loc' of the
+    template, and the 'pattern' and 'pattern-loc' of its category."""
+    attrs = template[1]
+    return {
+        'doc': attrs['doc'],
+        'loc': attrs['line'],
+        'pattern': attrs['pattern'],
+        'pattern-loc': attrs['pattern-loc'],
+    }
+
+
+class _RequestState(threading.local):
+    """State of the request a thread is processing."""
+
+    def __init__(self):
+        # the templates processed by the last request, innermost first,
+        # or None if the request isn't traced
+        self.trace = []
+        # the templates the sentences of the last request matched
+        self.matches = []
+        # the stack of the inputs being processed, and of the wildcard
+        # bindings of the categories they matched
+        self.inputStack = []
+        self.starStack = []
+        # files <learn> elements asked for, learned after the request
+        self.learns = []
+        # the strings normalized by the request, which are looked up by
+        # every <srai> again
+        self.normalized = Utils.Memo()
+        # the choices of the <random> elements processed, when
+        # respondCandidates() enumerates them: the order of their <li>
+        # elements and the position of the one chosen
+        self.choices = None
+        # the number of <random> elements processed by the candidate
+        self.choice = 0
+        # the number of requests the thread is processing, as respond()
+        # can be called again while a request is processed
+        self.depth = 0
+        # the match results of the inputs, kept while respondCandidates()
+        # processes the same input again
+        self.matched = None
+
+
 class Kernel:
     # module constants
     _globalSessionID = "_global"  # key of the global session (duh)
@@ -62,20 +153,49 @@ class Kernel:
     _inputHistory = "_inputHistory"
     # keys to a queue (list) of recent responses.
     _outputHistory = "_outputHistory"
-    # Should always be empty in between calls to respond()
-    _inputStack = "_inputStack"
+    # pattern managers selectable with setBrainType()
+    _brainTypes = {
+        "dict": PatternMgr,
+        "compiled": CompiledPatternMgr,
+        "mapped": MappedPatternMgr,
+    }
+    # concurrency modes accepted by setConcurrency()
+    _concurrencyModes = ["global", "session"]
 
     def __init__(self):
         self._verboseMode = True
         self._version = "PyAIML 0.8.6"
+        self._brainType = "dict"
         self._brain = PatternMgr()
+        # True while self._brain may be shared with other Kernels
+        self._brainShared = False
+        self._matchCacheSize = 0
         self._respondLock = threading.RLock()
+        self._concurrency = "global"
+        self._learnProcesses = 1
+        self._sessionLocks = {}
+        self._sessionLocksLock = threading.Lock()
+        self._brainLock = Utils.ReadWriteLock()
+        self._request = _RequestState()
+        self._normalizedHits = 0
+        self._normalizedMisses = 0
+        self._statsLock = threading.Lock()
         self._textEncoding = "utf-8"
-        self._trace = []
+        # the srai index built by buildSraiIndex(), keyed by the id() of
+        # the templates, or None if it must be built again, the number of
+        # times it was dropped, and the lock of the request building it
+        self._sraiIndexing = False
+        self._sraiIndex = None
+        self._sraiIndexVersion = 0
+        self._sraiIndexLock = threading.Lock()
+        # the [pattern/that/topic] tuples of the categories of each AIML
+        # file learned, in the order the files were learned
+        self._learnedFiles = OrderedDict()
 
         # set up the sessions
-        self._sessions = {}
+        self._sessions = SessionStore()
         self._addSession(self._globalSessionID)
+        self._queryCounter = itertools.count()
 
         # Set up the bot predicates
         self._botPredicates = {}
@@ -123,6 +243,12 @@ class Kernel:
             "version":      self._processVersion,
         }
 
+        # set up the template compiler, and the cache of the templates
+        # it compiled, keyed by their id()
+        self._templateCompiler = TemplateCompiler(self)
+        self._templateCompilation = True
+        self._compiledTemplates = {}
+
     def bootstrap(self, brainFile=None, learnFiles=[], commands=[]):
         """Prepare a Kernel object for use.
 
@@ -171,6 +297,320 @@ class Kernel:
         """Return the Kernel's version string."""
         return self._version
 
+    def setConcurrency(self, mode):
+        """Select how concurrent calls to respond() are handled.
+
+        In "global" mode (the default) requests are processed one at a
+        time.  In "session" mode only requests to the same session are
+        serialized, and requests to different sessions are matched
+        against the brain concurrently.  In both modes the brain can
+        only change while no request is reading it, so files named by
+        <learn> elements are learned once the request that processed
+        them is complete.
+
+        """
+        if mode not in self._concurrencyModes:
+            raise ValueError, "mode must be in %s" % self._concurrencyModes
+        self._concurrency = mode
+
+    def setLearnProcesses(self, processes):
+        """Set the number of processes learn() parses AIML files with.
+
+        With more than one process the files are parsed by a pool of
+        worker processes, and their categories are added to the brain in
+        the order of the files, as if they were parsed one by one.  The
+        pool is only forked while no other thread runs, e.g. when the
+        files are first learned at startup, and the files are parsed one
+        by one otherwise.
+
+        """
+        if processes < 1:
+            raise ValueError, "processes must be at least 1"
+        self._learnProcesses = processes
+
+    def setTemplateCompilation(self, enabled):
+        """Select whether templates are compiled before they are processed
+        (the default), or interpreted element by element.
+
+        A template is compiled the first time it is processed, into a
+        function that gives the same response as the interpreter.
+
+        """
+        self._templateCompilation = enabled
+        self._compiledTemplates = {}
+
+    def setMatchCacheSize(self, size):
+        """Set the number of match results the brain keeps, so that
+        repeated inputs aren't matched again.  The cache is cleared
+        whenever the brain learns something.  A size of 0 (the default)
+        disables it.
+
+        """
+        self._brainLock.acquireWrite()
+        try:
+            self._matchCacheSize = size
+            self._brain.setMatchCacheSize(size)
+        finally:
+            self._brainLock.releaseWrite()
+
+    def getMatchCacheStats(self):
+        """Return a dictionary of the number of match results cached
+        ('size') and the maximum ('maxSize'), the number of matches that
+        were found in the cache ('hits') or not ('misses'), and the hit
+        rate.  Returns None if the cache is disabled.
+
+        """
+        stats = self._brain.matchCacheStats()
+        if stats is not None:
+            lookups = stats["hits"] + stats["misses"]
+            stats["hitRate"] = (float(stats["hits"]) / lookups
+                                if lookups else 0.0)
+        return stats
+
+    def getBrainType(self):
+        """Return the type of the brain, as selected with setBrainType()."""
+        return self._brainType
+
+    def shareBrain(self):
+        """Return the brain, to be passed to setBrain() of other Kernels.
+
+        A shared brain is never changed: a Kernel copies it before it
+        learns anything else.  It keeps the categories of the files
+        learned, so that the Kernels using it can unlearn and relearn
+        them.
+
+        """
+        self._brainLock.acquireWrite()
+        try:
+            self._brainShared = True
+            self._brain.setLearnedFiles(self._learnedFiles.items())
+            return self._brain
+        finally:
+            self._brainLock.releaseWrite()
+
+    def setBrain(self, brain):
+        """Use the brain returned by shareBrain() of another Kernel.
+
+        The Kernel keeps its own bot predicates and sessions, and
+        patterns with <bot name="name"> tags are matched with its own
+        name.
+
+        """
+        for brainType, brainClass in self._brainTypes.items():
+            if brain.__class__ is brainClass:
+                break
+        else:
+            raise ValueError, "brain must be one of %s" % sorted(
+                self._brainTypes.keys())
+        self._brainLock.acquireWrite()
+        try:
+            self._brain = brain
+            self._brainType = brainType
+            self._brainShared = True
+            self._learnedFiles = OrderedDict(brain.learnedFiles())
+            self._brainChanged()
+        finally:
+            self._brainLock.releaseWrite()
+
+    def _copyBrain(self, brainClass):
+        """Return a new brainClass instance holding the categories of the
+        brain.
+
+        """
+        brain = brainClass()
+        brain.setBotName(self.getBotPredicate("name"))
+        brain.setMatchCacheSize(self._matchCacheSize)
+        for tem in self._brain.templates():
+            attr = tem[1]
+            brain.add((attr['pattern'], attr['that'], attr['topic']), tem)
+        return brain
+
+    def _ownBrain(self):
+        """Copy the brain if it's shared, before changing it.  Must be
+        called with the brain write lock held.
+
+        """
+        if self._brainShared:
+            self._brain = self._copyBrain(self._brain.__class__)
+            self._brainShared = False
+
+    def _brainChanged(self):
+        """Drop what was derived from the templates of the brain.  Must
+        be called with the brain write lock held.
+
+        """
+        self._compiledTemplates = {}
+        self._dropSraiIndex()
+
+    def buildSraiIndex(self, reportSize=10):
+        """Index the chains of reductions in the brain, so that they're
+        skipped when responding.
+
+        Many templates are pure reductions to another input, like
+        <srai>HELLO</srai>.  When the template that input matches
+        doesn't depend on the 'that' or 'topic', and is a reduction too,
+        the whole chain of reductions always ends up with the same
+        input.  The index maps the first template of each chain to the
+        inputs along it, and the response then processes only the last
+        one.  Chains with cycles, or longer than the maximum recursion
+        depth, are left to be processed step by step.
+
+        Once built, the index is dropped whenever the brain, the bot name
+        or the substitutions change, and the next request builds it
+        again.  Brains with templates that aren't kept in memory (mapped brains)
+        aren't indexed.
+
+        Returns the longest reportSize chains, as a list of dictionaries
+        with the 'pattern', 'doc' and 'loc' of their first template and
+        the list of their 'inputs', longest first.
+
+        """
+        start = time.clock()
+        self._sraiIndexing = True
+        self._brainLock.acquireRead()
+        try:
+            version = self._sraiIndexVersion
+            brain = self._brain
+            if not brain.stableTemplates():
+                self._sraiIndex = None
+                return []
+            reductions = {}
+            for tem in brain.templates():
+                sraiInput = self._sraiInput(tem)
+                if sraiInput:
+                    reductions[id(tem)] = sraiInput
+            chains = {}
+            index = {}
+            for tem in brain.templates():
+                if id(tem) not in reductions:
+                    continue
+                chain = self._sraiChain(tem, reductions, chains)
+                # a chain of one reduction is processed as fast as it is
+                if (chain is not None and len(chain[0]) > 1 and
+                        len(chain[0]) <= self._maxRecursionDepth):
+                    index[id(tem)] = (tem, chain[0], chain[1])
+            # unless the bot name or the substitutions changed meanwhile
+            if version == self._sraiIndexVersion:
+                self._sraiIndex = index
+        finally:
+            self._brainLock.releaseRead()
+
+        longest = sorted(index.values(), key=lambda entry: -len(entry[1]))
+        report = []
+        for tem, inputs, templates in longest[:reportSize]:
+            report.append({
+                'pattern': tem[1]['pattern'],
+                'doc': tem[1]['doc'],
+                'loc': tem[1]['line'],
+                'inputs': list(inputs),
+            })
+        if self._verboseMode:
+            logger.info("Indexed %d chains of reductions in %.2f seconds" % (
+                len(index), time.clock() - start))
+            for chain in report:
+                logger.info("%d reductions from %s: %s" % (
+                    len(chain['inputs']), chain['pattern'],
+                    " -> ".join(chain['inputs'])))
+        return report
+
+    def setSraiIndexing(self, enabled):
+        """Select whether the chains of reductions in the brain are
+        indexed by buildSraiIndex(), and the index kept up to date as the
+        brain changes.  Disabled by default.  The index is built by the
+        next request.
+
+        """
+        self._sraiIndexing = enabled
+        self._dropSraiIndex()
+
+    def _dropSraiIndex(self):
+        """Drop the srai index after a change, for the next request to
+        build it again."""
+        self._sraiIndexVersion += 1
+        self._sraiIndex = None
+
+    def _updateSraiIndex(self):
+        """Build the srai index if it was dropped.  The requests that come
+        while one builds it go on without it.  The caller must not hold
+        the brain lock.
+
+        """
+        if not self._sraiIndexing or self._sraiIndex is not None:
+            return
+        if not self._sraiIndexLock.acquire(False):
+            return
+        try:
+            if self._sraiIndex is None:
+                self.buildSraiIndex(0)
+        finally:
+            self._sraiIndexLock.release()
+
+    def _sraiInput(self, tem):
+        """Return the input of the template tem if it's a single <srai>
+        with constant contents, or None.
+
+        """
+        if len(tem) != 3 or tem[2][0] != 'srai':
+            return None
+        for e in tem[2][2:]:
+            if e[0] != 'text':
+                return None
+        func = self._templateCompiler.compile(tem)
+        return getattr(func, 'sraiInput', None)
+
+    def _sraiChain(self, tem, reductions, chains):
+        """Return a tuple (inputs, templates) for the chain of reductions
+        starting at the template tem: the inputs of the reductions in
+        order, and the templates along it, innermost first.
+        Returns None if the chain has a cycle.
+
+        reductions maps the id() of the reductions to their input, and
+        chains keeps the chains already found.
+
+        """
+        normalSub = self._subbers['normal'].sub
+        botName = self.getBotPredicate("name")
+        path = []
+        seen = set()
+        while True:
+            if id(tem) in chains:
+                tail = chains[id(tem)]
+                break
+            if id(tem) in seen:
+                tail = None
+                break
+            seen.add(id(tem))
+            path.append(tem)
+            sraiInput = reductions[id(tem)]
+            match = self._brain.staticMatch(normalSub(sraiInput), botName)
+            if match is None or id(match[0]) not in reductions:
+                tail = ([], [])
+                break
+            tem = match[0]
+        for tem in reversed(path):
+            if tail is not None:
+                tail = ([reductions[id(tem)]] + tail[0], tail[1] + [tem])
+            chains[id(tem)] = tail
+        return tail
+
+    def getNormalizationStats(self):
+        """Return a dictionary of the number of times a string was found
+        already normalized by the request ('hits'), the number of times
+        it had to be normalized ('misses'), and the hit rate.
+
+        """
+        self._statsLock.acquire()
+        try:
+            hits, misses = self._normalizedHits, self._normalizedMisses
+        finally:
+            self._statsLock.release()
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hitRate": float(hits) / lookups if lookups else 0.0,
+        }
+
     def numCategories(self):
         """Return the number of categories the Kernel has learned."""
         # there's a one-to-one mapping between templates and categories
@@ -184,8 +624,37 @@ class Kernel:
             kern = aiml.Kernel()
 
         """
+        brainType = self._brainType
         del(self._brain)
         self.__init__()
+        self.setBrainType(brainType)
+
+    def setBrainType(self, brainType):
+        """Select how the brain stores its patterns.
+
+        "dict" (the default) keeps the node tree in nested dictionaries.
+        "compiled" interns the words and keeps the node tree in flat
+        arrays, which takes much less memory for large AIML sets and
+        gives the same matches.  "mapped" is a compiled brain that can
+        be saved with saveMappedBrain() and mapped into memory with
+        mapBrain().  Categories that have already been learned are
+        carried over to the new brain.
+
+        """
+        try:
+            brainClass = self._brainTypes[brainType]
+        except KeyError:
+            raise ValueError, "brainType must be in %s" % sorted(
+                self._brainTypes.keys())
+        self._brainLock.acquireWrite()
+        try:
+            if self._brain.__class__ is not brainClass:
+                self._brain = self._copyBrain(brainClass)
+                self._brainShared = False
+                self._brainChanged()
+            self._brainType = brainType
+        finally:
+            self._brainLock.releaseWrite()
 
     def loadBrain(self, filename):
         """Attempt to load a previously-saved 'brain' from the
@@ -197,7 +666,19 @@ class Kernel:
         if self._verboseMode:
             logger.info("Loading brain from %s..." % filename,)
         start = time.clock()
-        self._brain.restore(filename)
+        self._brainLock.acquireWrite()
+        try:
+            if self._brainShared:
+                self._brain = self._brain.__class__()
+                self._brain.setMatchCacheSize(self._matchCacheSize)
+                self._brainShared = False
+            self._brain.restore(filename)
+            self._learnedFiles = OrderedDict(self._brain.learnedFiles())
+            self._brainChanged()
+            # the bot name is a predicate of this Kernel, not of the brain
+            self._brain.setBotName(self.getBotPredicate("name"))
+        finally:
+            self._brainLock.releaseWrite()
         if self._verboseMode:
             end = time.clock() - start
             logger.info("done (%d categories in %.2f seconds)" %
@@ -208,10 +689,54 @@ class Kernel:
         if self._verboseMode:
             logger.info("Saving brain to %s..." % filename,)
         start = time.clock()
-        self._brain.save(filename)
+        self._brainLock.acquireRead()
+        try:
+            self._brain.setLearnedFiles(self._learnedFiles.items())
+            self._brain.save(filename)
+        finally:
+            self._brainLock.releaseRead()
+        if self._verboseMode:
+            logger.info("done (%.2f seconds)" % (time.clock() - start))
+
+    def saveMappedBrain(self, filename):
+        """Save the brain to a file that mapBrain() can map into memory."""
+        if self._verboseMode:
+            logger.info("Saving mapped brain to %s..." % filename,)
+        start = time.clock()
+        self._brainLock.acquireRead()
+        try:
+            brain = self._brain
+            if not isinstance(brain, CompiledPatternMgr):
+                brain = self._copyBrain(CompiledPatternMgr)
+            brain.setLearnedFiles(self._learnedFiles.items())
+            saveMapped(brain, filename)
+        finally:
+            self._brainLock.releaseRead()
         if self._verboseMode:
             logger.info("done (%.2f seconds)" % (time.clock() - start))
 
+    def mapBrain(self, filename):
+        """Map a brain saved by saveMappedBrain() into memory and use it
+        instead of the current brain.
+
+        The processes that map the same file share a single copy of it,
+        and mapping takes no time, whatever the size of the brain.
+
+        """
+        brain = MappedPatternMgr()
+        brain.map(filename)
+        brain.setBotName(self.getBotPredicate("name"))
+        brain.setMatchCacheSize(self._matchCacheSize)
+        self._brainLock.acquireWrite()
+        try:
+            self._brain = brain
+            self._brainType = "mapped"
+            self._brainShared = False
+            self._learnedFiles = OrderedDict(brain.learnedFiles())
+            self._brainChanged()
+        finally:
+            self._brainLock.releaseWrite()
+
     def getPredicate(self, name, sessionID=_globalSessionID):
         """Retrieve the current value of the predicate 'name' from the
         specified session.
@@ -234,9 +759,8 @@ class Kernel:
         created.
 
         """
-        self._addSession(
-            sessionID)  # add the session, if it doesn't already exist.
-        self._sessions[sessionID][name] = value
+        # add the session, if it doesn't already exist.
+        self._sessions.add(sessionID)[name] = value
 
     def getBotPredicate(self, name):
         """Retrieve the value of the specified bot predicate.
@@ -258,8 +782,12 @@ class Kernel:
         self._botPredicates[name] = value
         # Clumsy hack: if updating the bot name, we must update the
         # name in the brain as well
-        if name == "name":
+        # (a shared brain is matched with the name of each Kernel instead)
+        if name == "name" and not self._brainShared:
             self._brain.setBotName(self.getBotPredicate("name"))
+        # the srai index is matched with the bot name too
+        if name == "name":
+            self._dropSraiIndex()
 
     def setTextEncoding(self, encoding):
         """Set the text encoding used when loading AIML files (Latin-1, UTF-8, etc.)."""
@@ -287,23 +815,72 @@ class Kernel:
             # iterate over the key,value pairs and add them to the subber
             for k, v in parser.items(s):
                 self._subbers[s][k] = v
+        # the srai index holds inputs normalized by the old subbers
+        self._dropSraiIndex()
 
     def _addSession(self, sessionID):
         """Create a new session with the specified ID string."""
-        if self._sessions.has_key(sessionID):
-            return
-        # Create the session.
-        self._sessions[sessionID] = {
-            # Initialize the special reserved predicates
-            self._inputHistory: [],
-            self._outputHistory: [],
-            self._inputStack: []
-        }
+        self._sessions.add(sessionID)
 
     def _deleteSession(self, sessionID):
-        """Delete the specified session."""
-        if self._sessions.has_key(sessionID):
-            self._sessions.pop(sessionID)
+        """Delete the specified session, once the requests to it are
+        complete.
+
+        """
+        lock = self._acquireSession(sessionID)
+        try:
+            if self._sessions.has_key(sessionID):
+                self._sessions.pop(sessionID)
+            with self._sessionLocksLock:
+                if self._sessionLocks.get(sessionID) is lock:
+                    del self._sessionLocks[sessionID]
+        finally:
+            lock.release()
+
+    def _sessionLock(self, sessionID):
+        """Return the lock that serializes requests to the specified
+        session in "session" concurrency mode.
+
+        """
+        with self._sessionLocksLock:
+            lock = self._sessionLocks.get(sessionID)
+            if lock is None:
+                lock = threading.RLock()
+                self._sessionLocks[sessionID] = lock
+            return lock
+
+    def _acquireSession(self, sessionID):
+        """Acquire the lock that serializes the requests to the specified
+        session, and return it.
+
+        """
+        if self._concurrency != "session":
+            self._respondLock.acquire()
+            return self._respondLock
+        while True:
+            lock = self._sessionLock(sessionID)
+            lock.acquire()
+            # the lock is dropped when the session is deleted, and
+            # requests waiting for it then take the new one
+            with self._sessionLocksLock:
+                if self._sessionLocks.get(sessionID) is lock:
+                    return lock
+            lock.release()
+
+    def _addQuerySession(self, sessionID):
+        """Create a query session over the specified session, and return
+        its ID.
+
+        A query session reads the predicates of the session it is
+        created over, but keeps any changes to itself.  Every query gets
+        its own query session, so concurrent queries don't collide.
+
+        """
+        querySessionID = "%s/%d" % (self._querySessionID,
+                                    self._queryCounter.next())
+        self._sessions[querySessionID] = QuerySession(
+            self._sessions[sessionID])
+        return querySessionID
 
     def getSessionData(self, sessionID=None):
         """Return a copy of the session data dictionary for the
@@ -313,49 +890,207 @@ class Kernel:
         *all* of the individual session dictionaries.
 
         """
-        s = None
         if sessionID is not None:
             try:
-                s = self._sessions[sessionID]
+                s = self._sessions[sessionID].copy()
             except KeyError:
                 s = {}
         else:
-            s = self._sessions
+            s = dict((sessionID, session.copy())
+                     for sessionID, session in self._sessions.items())
         return copy.deepcopy(s)
 
+    def getSessionSizes(self):
+        """Return a dictionary of the number of bytes each session holds,
+        by session ID: the predicates, histories and stacks of the
+        session, and the containers they are kept in.
+
+        """
+        return self._sessions.sizes()
+
     def learn(self, filename):
         """Load and learn the contents of the specified AIML file.
 
         If filename includes wildcard characters, all matching files
-        will be loaded and learned.
+        will be loaded and learned.  filename may also be a list of
+        such names, which are learned in order.
+
+        """
+        return self._learn(filename, False)
+
+    def relearn(self, filename):
+        """Learn the specified AIML files again, replacing the categories
+        learned from their previous contents.
+
+        The files keep their place in the order the files were learned:
+        categories a later file overrides stay overridden, and the
+        categories a file no longer has are restored from the earlier
+        files that have them.  filename is expanded like in learn().
 
         """
+        return self._learn(filename, True)
+
+    def _learn(self, filename, replace):
+        """Learn the files named by filename, replacing the categories of
+        their previous contents if replace is True.  Returns the list of
+        parse errors.
+
+        """
+        if isinstance(filename, basestring):
+            filename = [filename]
+        files = []
+        for name in filename:
+            files.extend(glob.glob(name))
+        args = [(f, self._textEncoding) for f in files]
+        pool = None
+        if self._learnProcesses > 1 and len(files) > 1 and _forkIsSafe():
+            pool = multiprocessing.Pool(min(self._learnProcesses, len(files)))
+            results = pool.imap(_parseAimlFile, args)
+        else:
+            results = itertools.imap(_parseAimlFile, args)
         errors = []
-        for f in glob.glob(filename):
-            if self._verboseMode:
-                logger.info("Loading %s..." % f,)
-            start = time.clock()
-            # Load and parse the AIML file.
-            parser = AimlParser.create_parser()
-            handler = parser.getContentHandler()
-            handler.setEncoding(self._textEncoding)
-            try:
-                parser.parse(f)
-            except xml.sax.SAXParseException, msg:
-                err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
-                errors.append(err)
+        try:
+            for f in files:
+                if self._verboseMode:
+                    logger.info("Loading %s..." % f,)
+                start = time.clock()
+                # Load and parse the AIML file.  The results come in the
+                # order of the files, so later files still override the
+                # categories of earlier ones.
+                categories, err = results.next()
+                if err is not None:
+                    errors.append(err)
+                    logger.error(err)
+                    continue
+                # store the pattern/template pairs in the PatternMgr.
+                self._brainLock.acquireWrite()
+                try:
+                    self._ownBrain()
+                    if replace:
+                        self._replaceFile(f, categories)
+                    else:
+                        for key, tem in categories.items():
+                            self._brain.add(key, tem)
+                        # a file learned again overrides the later ones
+                        self._learnedFiles.pop(f, None)
+                        self._learnedFiles[f] = set(categories)
+                    # drop the replaced templates
+                    self._brainChanged()
+                finally:
+                    self._brainLock.releaseWrite()
+                # Parsing was successful.
+                if self._verboseMode:
+                    logger.info("done (%.2f seconds)" % (time.clock() - start))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return errors
+
+    def unlearn(self, filename):
+        """Forget the categories learned from the specified AIML file, or
+        list of files.
+
+        The categories the files had overridden are restored from the
+        earlier files that have them, as if the files had never been
+        learned.  The files don't have to exist anymore.  Returns the
+        number of categories removed.
+
+        """
+        if isinstance(filename, basestring):
+            filename = [filename]
+        removed = 0
+        self._brainLock.acquireWrite()
+        try:
+            self._ownBrain()
+            for f in filename:
+                removed += self._replaceFile(f, None)
+            self._brainChanged()
+        finally:
+            self._brainLock.releaseWrite()
+        if self._verboseMode:
+            logger.info("Unlearned %d categories of %s" % (
+                removed, ", ".join(filename)))
+        return removed
+
+    def getLearnedFiles(self):
+        """Return the list of the AIML files learned, in order."""
+        return self._learnedFiles.keys()
+
+    def _replaceFile(self, filename, categories):
+        """Replace the categories learned from the AIML file filename by
+        the dictionary categories, or just remove them if categories is
+        None.  Returns the number of categories removed.  Must be called
+        with the brain write lock held.
+
+        Files the brain has no record of, such as those of a brain saved
+        without them, are found by the 'doc' of the templates, and the
+        categories they had overridden are lost.
+
+        """
+        keys = self._learnedFiles.get(filename)
+        if keys is None:
+            keys = set((tem[1]['pattern'].strip(), tem[1]['that'],
+                        tem[1]['topic'])
+                       for tem in self._brain.templates()
+                       if tem[1].get('doc') == filename)
+        files = self._learnedFiles.keys()
+        if filename in files:
+            earlier = files[:files.index(filename)]
+            later = set(files[files.index(filename) + 1:])
+        else:
+            earlier = files
+            later = set()
+
+        # remove the categories of the file that no later file overrides,
+        # except those about to be replaced anyway
+        removed = []
+        for key in keys:
+            if categories is not None and key in categories:
+                continue
+            tem = self._brain.get(key)
+            if tem is not None and tem[1].get('doc') == filename:
+                self._brain.remove(key)
+                removed.append(key)
+
+        # restore the removed categories the earlier files have, from the
+        # last one that has each
+        restore = {}
+        for key in removed:
+            for f in reversed(earlier):
+                if key in self._learnedFiles[f]:
+                    restore.setdefault(f, []).append(key)
+                    break
+        for f, restoreKeys in restore.items():
+            fileCategories, err = _parseAimlFile((f, self._textEncoding))
+            if err is not None:
                 logger.error(err)
                 continue
-            # store the pattern/template pairs in the PatternMgr.
-            for key, tem in handler.categories.items():
-                self._brain.add(key, tem)
-            # Parsing was successful.
-            if self._verboseMode:
-                logger.info("done (%.2f seconds)" % (time.clock() - start))
-        return errors
+            for key in restoreKeys:
+                if key in fileCategories:
+                    self._brain.add(key, fileCategories[key])
+
+        if categories is None:
+            self._learnedFiles.pop(filename, None)
+            return len(removed)
+
+        # add the new categories, except those a later file overrides
+        for key, tem in categories.items():
+            current = self._brain.get(key)
+            if current is not None and current[1].get('doc') in later:
+                continue
+            self._brain.add(key, tem)
+        self._learnedFiles[filename] = set(categories)
+        return len(removed)
+
+    def respond(self, input, sessionID=_globalSessionID, query=False,
+                trace=True):
+        """Return the Kernel's response to the input string.
 
-    def respond(self, input, sessionID=_globalSessionID, query=False):
-        """Return the Kernel's response to the input string."""
+        Unless trace is False, the templates processed are recorded for
+        getTrace().  The templates the sentences matched are recorded for
+        getMatches() either way.
+
+        """
         if len(input) == 0:
             return ""
 
@@ -367,31 +1102,208 @@ class Kernel:
         except AttributeError:
             pass
 
+        return self._respondLocked(sessionID, self._respondSentences,
+                                   input, sessionID, query, trace)
+
+    def respondCandidates(self, input, accept, sessionID=_globalSessionID,
+                          query=False, trace=True, maxCandidates=6):
+        """Return the Kernel's response to the input string, choosing
+        between the responses the <random> elements can give.
+
+        The input is matched once, and then processed up to maxCandidates
+        times, each time with a different choice of <random> elements:
+        the first time as respond() would, and then in random order.
+        Each distinct response is passed to accept() in turn, and the
+        first one it accepts is returned.  If none is accepted, the first
+        response is returned.  Only the processing that gave the response
+        returned changes the session.
+
+        """
+        if len(input) == 0:
+            return ""
+        try:
+            input = input.decode(self._textEncoding, 'replace')
+        except UnicodeError:
+            pass
+        except AttributeError:
+            pass
+        return self._respondLocked(
+            sessionID, self._respondCandidates, input, accept, sessionID,
+            query, trace, maxCandidates)
+
+    def _respondLocked(self, sessionID, respond, *args):
+        """Call respond(*args) with the locks a request to the session
+        takes, and return its response, encoded.
+
+        """
+        request = self._request
+        if request.depth == 0:
+            self._updateSraiIndex()
         # prevent other threads from stomping all over us.
-        self._respondLock.acquire()
+        lock = self._acquireSession(sessionID)
+        if request.depth == 0:
+            self._brainLock.acquireRead()
+        request.depth += 1
+        try:
+            finalResponse = respond(*args)
+        finally:
+            # release the locks
+            request.depth -= 1
+            if request.depth == 0:
+                self._brainLock.releaseRead()
+            lock.release()
+        if request.depth > 0:
+            return self._encode(finalResponse)
+
+        # learn the files <learn> elements asked for, now that the brain
+        # is no longer being read by this request.
+        learns = self._request.learns
+        self._request.learns = []
+        for filename in learns:
+            self.learn(filename)
+
+        return self._encode(finalResponse)
+
+    def _encode(self, response):
+        try:
+            return response.encode(self._textEncoding)
+        except UnicodeError:
+            return response
 
+    def _respondSentences(self, input, sessionID, query, trace=True):
+        """Respond to each sentence of the input in turn, and return the
+        combined response.  The caller must hold the locks respond()
+        takes.
+
+        """
         # Add the session, if it doesn't already exist
         self._addSession(sessionID)
 
         if query:
-            # Copy current session data to new query session, and delete it
+            # Process the input in a query session, and delete it after
             # use
-            sessionData = self.getSessionData(sessionID)
-            sessionID = self._querySessionID
-            self._addSession(sessionID)
-            self._sessions[sessionID].update(sessionData)
-
-        self._trace = []
+            sessionID = self._addQuerySession(sessionID)
+            try:
+                return self._respondSentences(
+                    input, sessionID, False, trace)
+            finally:
+                self._deleteSession(sessionID)
+
+        self._request.trace = [] if trace else None
+        self._request.matches = []
+        self._request.normalized = Utils.Memo()
+        self._request.inputStack = []
+        self._request.starStack = []
         # split the input into discrete sentences
         sentences = Utils.sentences(input)
+        finalResponse = self._respondEach(sentences, sessionID)
+        self._endRequest(trace)
+        return finalResponse
+
+    def _respondCandidates(self, input, accept, sessionID, query, trace,
+                           maxCandidates):
+        """Respond to the input like respondCandidates() does.  The caller
+        must hold the locks respond() takes.
+
+        """
+        self._addSession(sessionID)
+
+        if query:
+            sessionID = self._addQuerySession(sessionID)
+            try:
+                return self._respondCandidates(
+                    input, accept, sessionID, False, trace, maxCandidates)
+            finally:
+                self._deleteSession(sessionID)
+
+        request = self._request
+        request.normalized = Utils.Memo()
+        request.inputStack = []
+        request.starStack = []
+        request.matched = {}
+        request.choices = []
+        sentences = Utils.sentences(input)
+        candidates = set()
+        first = chosen = None
+        try:
+            for i in xrange(maxCandidates):
+                request.choice = 0
+                request.trace = [] if trace else None
+                request.matches = []
+                # process each candidate in a query session, so that only
+                # the changes of the one chosen are kept
+                candidateID = self._addQuerySession(sessionID)
+                try:
+                    response = self._respondEach(sentences, candidateID)
+                    candidate = (response, self._sessions[candidateID],
+                                 request.trace, request.matches)
+                finally:
+                    self._deleteSession(candidateID)
+                if first is None:
+                    first = candidate
+                if response not in candidates:
+                    candidates.add(response)
+                    if accept(self._encode(response)):
+                        chosen = candidate
+                        break
+                if not self._nextChoices():
+                    break
+        finally:
+            request.choices = None
+            request.matched = None
+        if chosen is None:
+            chosen = first
+        response, session, request.trace, request.matches = chosen
+        session.commit()
+        self._endRequest(trace)
+        return response
+
+    def _nextChoices(self):
+        """Choose the next <li> element of the last <random> element
+        processed that has any left, and forget the choices after it.
+        Returns False once every choice has been made.
+
+        """
+        choices = self._request.choices
+        while choices:
+            choice = choices[-1]
+            if choice[1] + 1 < len(choice[0]):
+                choice[1] += 1
+                return True
+            choices.pop()
+        return False
+
+    def _choose(self, n):
+        """Return the index of the <li> element a <random> element with n
+        of them processes.
+
+        """
+        order = range(n)
+        choices = self._request.choices
+        if choices is None:
+            random.shuffle(order)
+            return order[0]
+        k = self._request.choice
+        self._request.choice = k + 1
+        if k < len(choices):
+            order, position = choices[k]
+            return order[position]
+        random.shuffle(order)
+        choices.append([order, 0])
+        return order[0]
+
+    def _respondEach(self, sentences, sessionID):
+        """Respond to each of the sentences in turn, and return the
+        combined response.
+
+        """
         finalResponse = ""
         for s in sentences:
             # Add the input to the history list before fetching the
             # response, so that <input/> tags work properly.
             inputHistory = self.getPredicate(self._inputHistory, sessionID)
             inputHistory.append(s)
-            while len(inputHistory) > self._maxHistorySize:
-                inputHistory.pop(0)
+            del inputHistory[:-self._maxHistorySize]
             self.setPredicate(self._inputHistory, inputHistory, sessionID)
 
             # Fetch the response
@@ -400,25 +1312,117 @@ class Kernel:
             # add the data from this exchange to the history lists
             outputHistory = self.getPredicate(self._outputHistory, sessionID)
             outputHistory.append(response)
-            while len(outputHistory) > self._maxHistorySize:
-                outputHistory.pop(0)
+            del outputHistory[:-self._maxHistorySize]
             self.setPredicate(self._outputHistory, outputHistory, sessionID)
 
             # append this response to the final response.
             finalResponse += (response + "  ")
         finalResponse = finalResponse.strip()
 
-        assert(len(self.getPredicate(self._inputStack, sessionID)) == 0)
+        assert(len(self._request.inputStack) == 0)
+        return finalResponse
 
-        if query:
-            self._deleteSession(self._querySessionID)
-        logger.debug("Trace: {}".format(self._trace))
-        # release the lock and return
-        self._respondLock.release()
+    def _endRequest(self, trace):
+        """Count the normalizations of the request."""
+        normalized = self._request.normalized
+        self._statsLock.acquire()
         try:
-            return finalResponse.encode(self._textEncoding)
-        except UnicodeError:
-            return finalResponse
+            self._normalizedHits += normalized.hits
+            self._normalizedMisses += normalized.misses
+        finally:
+            self._statsLock.release()
+        logger.debug("Normalization: %d hits, %d misses" % (
+            normalized.hits, normalized.misses))
+        if trace and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Trace: {}".format(self.getTraceDocs()))
+
+    def matchMany(self, inputs, that=None, topic=None, processes=1):
+        """Match each of the inputs against the brain, without responding
+        to them or touching any session.
+
+        Returns a list with an entry for each input: the list of the
+        matches of its sentences, as dictionaries with the 'input'
+        sentence, the 'pattern', 'that' and 'topic' of the category
+        matched, its 'doc', the 'loc' of its template and the
+        'pattern-loc' of its pattern, or None for the sentences that
+        match nothing.  Blank sentences, and inputs that aren't strings
+        such as the NaN of an empty table cell, have no matches.
+
+        that and topic are the bot's previous response and the topic all
+        the inputs are matched with.  With more than one process, the
+        inputs are matched by a pool of worker processes forked from
+        this one, which share its brain.  The pool is only forked while
+        no other thread runs, and the inputs are matched in this process
+        otherwise.
+
+        """
+        global _batchMatch
+        if processes <= 1 or len(inputs) <= 1 or not _forkIsSafe():
+            return self._matchMany(inputs, that, topic)
+        # a few batches per process, so that they're kept busy
+        size = max(1, len(inputs) // (processes * 4))
+        batches = [inputs[i:i + size] for i in xrange(0, len(inputs), size)]
+        _batchMatchLock.acquire()
+        try:
+            _batchMatch = (self, that, topic)
+            pool = multiprocessing.Pool(min(processes, len(batches)))
+        finally:
+            _batchMatch = None
+            _batchMatchLock.release()
+        try:
+            results = pool.map(_matchBatch, batches)
+        finally:
+            pool.terminate()
+        return list(itertools.chain.from_iterable(results))
+
+    def _matchMany(self, inputs, that, topic):
+        """Match the inputs in this process, as matchMany() does."""
+        # the same sentences are normalized and split up only once
+        memo = Utils.Memo()
+        normalSub = self._subbers['normal'].sub
+
+        def normalize(text):
+            try:
+                text = text.decode(self._textEncoding, 'replace')
+            except (UnicodeError, AttributeError):
+                pass
+            return memo.lookup(("normal", text), normalSub, text)
+        subbedThat = normalize(that or "")
+        subbedTopic = normalize(topic or "")
+        botName = self.getBotPredicate("name")
+        results = []
+        self._brainLock.acquireRead()
+        try:
+            for input in inputs:
+                matches = []
+                results.append(matches)
+                if not isinstance(input, basestring):
+                    continue
+                try:
+                    input = input.decode(self._textEncoding, 'replace')
+                except (UnicodeError, AttributeError):
+                    pass
+                for s in Utils.sentences(input):
+                    if not s.strip():
+                        continue
+                    elem, stars = self._brain.matchStars(
+                        normalize(s), subbedThat, subbedTopic, botName, memo)
+                    if elem is None:
+                        matches.append(None)
+                        continue
+                    attrs = elem[1]
+                    matches.append({
+                        'input': s,
+                        'pattern': attrs['pattern'],
+                        'that': attrs['that'],
+                        'topic': attrs['topic'],
+                        'doc': attrs['doc'],
+                        'loc': attrs['line'],
+                        'pattern-loc': attrs['pattern-loc'],
+                    })
+        finally:
+            self._brainLock.releaseRead()
+        return results
 
     # This version of _respond() just fetches the response for some input.
     # It does not mess with the input and output histories.  Recursive calls
@@ -430,7 +1434,7 @@ class Kernel:
             return ""
 
         # guard against infinite recursion
-        inputStack = self.getPredicate(self._inputStack, sessionID)
+        inputStack = self._request.inputStack
         if len(inputStack) > self._maxRecursionDepth:
             if self._verboseMode:
                 err = "WARNING: maximum recursion depth exceeded (input='%s')" % input.encode(
@@ -439,12 +1443,12 @@ class Kernel:
             return ""
 
         # push the input onto the input stack
-        inputStack = self.getPredicate(self._inputStack, sessionID)
         inputStack.append(input)
-        self.setPredicate(self._inputStack, inputStack, sessionID)
 
         # run the input through the 'normal' subber
-        subbedInput = self._subbers['normal'].sub(input)
+        normalized = self._request.normalized
+        normalSub = self._subbers['normal'].sub
+        subbedInput = normalized.lookup(("normal", input), normalSub, input)
 
         # fetch the bot's previous response, to pass to the match()
         # function as 'that'.
@@ -453,34 +1457,77 @@ class Kernel:
             that = outputHistory[-1]
         except IndexError:
             that = ""
-        subbedThat = self._subbers['normal'].sub(that)
+        subbedThat = normalized.lookup(("normal", that), normalSub, that)
 
         # fetch the current topic
         topic = self.getPredicate("topic", sessionID)
-        subbedTopic = self._subbers['normal'].sub(topic)
+        subbedTopic = normalized.lookup(("normal", topic), normalSub, topic)
 
         # Determine the final response.
         response = ""
-        elem = self._brain.match(subbedInput, subbedThat, subbedTopic)
+        matched = self._request.matched
+        key = (subbedInput, subbedThat, subbedTopic)
+        if matched is not None and key in matched:
+            elem, stars = matched[key]
+        else:
+            elem, stars = self._brain.matchStars(
+                subbedInput, subbedThat, subbedTopic,
+                self.getBotPredicate("name"), normalized)
+            if matched is not None:
+                matched[key] = elem, stars
         if elem is None:
             if self._verboseMode:
                 err = "No match found for input: %s" % input.encode(
                     self._textEncoding)
                 logger.debug(err)
         else:
+            # Keep the wildcard bindings of the match around for the
+            # <star>, <thatstar> and <topicstar> elements of the template.
+            starStack = self._request.starStack
+            starStack.append(stars)
+
+            if len(inputStack) == 1:
+                self._request.matches.append(elem)
+
             # Process the element into a response string.
-            _response = self._processElement(elem, sessionID).strip()
+            chain = None
+            sraiIndex = self._sraiIndex
+            if sraiIndex is not None:
+                chain = sraiIndex.get(id(elem))
+            if (chain is not None and chain[0] is elem and
+                    len(inputStack) + len(chain[1]) - 2 <=
+                    self._maxRecursionDepth):
+                _response = self._respondChain(chain, sessionID)
+            elif self._templateCompilation and self._brain.stableTemplates():
+                _response = self._compiledTemplate(elem)(sessionID).strip()
+            else:
+                _response = self._processElement(elem, sessionID).strip()
             response += _response
             response += " "
+
+            starStack.pop()
         response = response.strip()
 
         # pop the top entry off the input stack.
-        inputStack = self.getPredicate(self._inputStack, sessionID)
         inputStack.pop()
-        self.setPredicate(self._inputStack, inputStack, sessionID)
 
         return response
 
+    def _respondChain(self, chain, sessionID):
+        """Respond to the last input of a chain of reductions from the
+        srai index, as if each reduction along it had been processed.
+
+        """
+        tem, inputs, templates = chain
+        inputStack = self._request.inputStack
+        inputStack.extend(inputs[:-1])
+        response = self._respond(inputs[-1], sessionID)
+        del inputStack[len(inputStack) - len(inputs) + 1:]
+        trace = self._request.trace
+        if trace is not None:
+            trace.extend(templates)
+        return response
+
     def _processElement(self, elem, sessionID):
         """Process an AIML element.
 
@@ -505,15 +1552,41 @@ class Kernel:
 
         _response = handlerFunc(elem, sessionID)
         if elem[0] == 'template':
-            trace = {}
-            trace['doc'] = elem[1]['doc']
-            trace['loc'] = elem[1]['line']
-            trace['pattern'] = elem[1]['pattern']
-            trace['pattern-loc'] = elem[1]['pattern-loc']
-            self._trace.append(trace)
+            trace = self._request.trace
+            if trace is not None:
+                trace.append(elem)
 
         return _response
 
+    def _compiledTemplate(self, elem):
+        """Return the function the template elem compiles to."""
+        try:
+            template, func = self._compiledTemplates[id(elem)]
+            if template is elem:
+                return func
+        except KeyError:
+            pass
+        func = self._templateCompiler.compile(elem)
+        # keep a reference to the template, so that its id() can't be
+        # reused by another one
+        self._compiledTemplates[id(elem)] = (elem, func)
+        return func
+
+    def _getStar(self, starType, index, sessionID):
+        """Return the text fragment captured by the index'th wildcard of
+        the given type ('star', 'thatstar' or 'topicstar') in the
+        category currently being processed, or the empty string if there
+        is no such wildcard.
+
+        """
+        starStack = self._request.starStack
+        if index < 1:
+            return ""
+        try:
+            return starStack[-1][starType][index - 1]
+        except (IndexError, KeyError):
+            return ""
+
     ######################################################
     ### Individual element-processing functions follow ###
     ######################################################
@@ -771,7 +1844,9 @@ class Kernel:
         filename = ""
         for e in elem[2:]:
             filename += self._processElement(e, sessionID)
-        self.learn(filename)
+        # this request holds the brain for reading, so the file is
+        # learned by respond() once the request is complete.
+        self._request.learns.append(filename)
         return ""
 
     # <li>
@@ -866,8 +1941,8 @@ class Kernel:
             return ""
 
         # select and process a random listitem.
-        random.shuffle(listitems)
-        return self._processElement(listitems[0], sessionID)
+        return self._processElement(
+            listitems[self._choose(len(listitems))], sessionID)
 
     # <sentence>
     def _processSentence(self, elem, sessionID):
@@ -962,18 +2037,7 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("star", input, that, topic, index)
-        return response
+        return self._getStar("star", index, sessionID)
 
     # <system>
     def _processSystem(self, elem, sessionID):
@@ -1109,18 +2173,7 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("thatstar", input, that, topic, index)
-        return response
+        return self._getStar("thatstar", index, sessionID)
 
     # <think>
     def _processThink(self, elem, sessionID):
@@ -1154,18 +2207,7 @@ class Kernel:
             index = int(elem[1]['index'])
         except KeyError:
             index = 1
-        # fetch the user's last input
-        inputStack = self.getPredicate(self._inputStack, sessionID)
-        input = self._subbers['normal'].sub(inputStack[-1])
-        # fetch the Kernel's last response (for 'that' context)
-        outputHistory = self.getPredicate(self._outputHistory, sessionID)
-        try:
-            that = self._subbers['normal'].sub(outputHistory[-1])
-        except:
-            that = ""  # there might not be any output yet
-        topic = self.getPredicate("topic", sessionID)
-        response = self._brain.star("topicstar", input, that, topic, index)
-        return response
+        return self._getStar("topicstar", index, sessionID)
 
     # <uppercase>
     def _processUppercase(self, elem, sessionID):
@@ -1191,12 +2233,32 @@ class Kernel:
         """
         return self.version()
 
+    def getTrace(self):
+        """Return the trace records of the templates the last request of
+        this thread processed, outermost first: dictionaries with the
+        'doc' and 'loc' of the template, and the 'pattern' and
+        'pattern-loc' of its category.  Returns an empty list if the
+        request wasn't traced.
+
+        """
+        templates = self._request.trace or []
+        return [_traceRecord(tem) for tem in reversed(templates)]
+
+    def getMatches(self):
+        """Return the trace records of the templates the sentences of the
+        last request of this thread matched, last sentence first.  These
+        are recorded whether or not the request is traced.
+
+        """
+        return [_traceRecord(tem) for tem in reversed(self._request.matches)]
+
     def getTraceDocs(self):
+        """Return the trace of the last request as strings, see
+        getTrace()."""
         docs = []
-        for trace in self._trace:
+        for trace in self.getTrace():
             docs.append(
                 '{doc}, {loc}, {pattern}, {pattern-loc}'.format(**trace))
-        docs.reverse()
         return docs
 
 
@@ -1221,18 +2283,560 @@ def _testTag(kern, tag, input, outputList):
                      response.encode(kern._textEncoding, 'replace'))
         return False
 
-if __name__ == "__main__":
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.INFO)
-    # Run some self-tests
-    k = Kernel()
-    cwd = os.path.dirname(os.path.realpath(__file__))
-    k.bootstrap(learnFiles=os.path.join(cwd, "self-test.aiml"))
+def _testCandidates(kern, tag, input, output):
+    """Tests that respondCandidates() finds the response 'output' to
+    'input', when it is the only one accepted.
 
+    """
     global _numTests, _numPassed
-    _numTests = 0
-    _numPassed = 0
+    _numTests += 1
+    logger.info("Testing <" + tag + "> candidates:",)
+    response = kern.respondCandidates(input, lambda r: r == output)
+    if response == output:
+        logger.info("PASSED")
+        _numPassed += 1
+        return True
+    else:
+        logger.error("FAILED (response: '%s')" % response)
+        return False
+
+def _testEqual(tag, value, expected):
+    """Tests 'tag' by comparing 'value' to the 'expected' one."""
+    global _numTests, _numPassed
+    _numTests += 1
+    logger.info("Testing " + tag + ":",)
+    if value == expected:
+        logger.info("PASSED")
+        _numPassed += 1
+        return True
+    else:
+        logger.error("FAILED (%r instead of %r)" % (value, expected))
+        return False
+
+def _testBrainTypes():
+    """Tests that the compiled and mapped brains, and the brains restored
+    from their snapshots, match random inputs like PatternMgr.
+
+    """
+    import tempfile
+    rand = random.Random(0)
+    words = [u"A", u"B", u"C", u"HELLO"]
+
+    def pattern(maxLen, special):
+        # one word in five is special
+        return u" ".join(rand.choice(special if rand.random() < 0.2
+                                     else words)
+                         for i in range(rand.randint(1, maxLen)))
+
+    def category():
+        that = topic = u""
+        if rand.random() < 0.3:
+            that = pattern(2, [u"*", u"_"])
+        if rand.random() < 0.2:
+            topic = pattern(2, [u"*", u"_"])
+        # a pattern of wildcards only would match everything first
+        key = (rand.choice(words) + u" " +
+               pattern(3, [u"*", u"_", u"BOT_NAME"]), that, topic)
+        return key, ["template", {"pattern": key[0], "that": key[1],
+                                  "topic": key[2]}]
+
+    def matches(brain, inputs):
+        results = []
+        for input, that, topic in inputs:
+            template, stars = brain.matchStars(input, that, topic)
+            results.append((template and template[1], stars))
+        return results
+
+    def instance(text):
+        # an input the pattern text matches, or random words for no text
+        words = []
+        for word in text.split():
+            if word in (u"*", u"_"):
+                words.extend(rand.choice([u"A", u"D", u"HELLO"])
+                             for i in range(rand.randint(1, 2)))
+            else:
+                words.append(word.replace(u"BOT_NAME", u"NAMELESS"))
+        return u" ".join(words) or pattern(3, [u"D"])
+
+    categories = dict(category() for i in range(300))
+    inputs = []
+    for key in rand.sample(sorted(categories), 200):
+        inputs.append(tuple(instance(text) for text in key))
+    for i in range(200):
+        inputs.append((pattern(6, [u"D", u"NAMELESS"]), pattern(3, [u"D"]),
+                       rand.choice([u"", pattern(2, [u"D"])])))
+    brains = [PatternMgr(), CompiledPatternMgr()]
+    for brain in brains:
+        brain.setBotName(u"NAMELESS")
+        for key, tem in categories.items():
+            brain.add(key, tem)
+    fd, mapFile = tempfile.mkstemp(suffix=".brn")
+    os.close(fd)
+    fd, brainFile = tempfile.mkstemp(suffix=".brn")
+    os.close(fd)
+    try:
+        saveMapped(brains[1], mapFile)
+        brains.append(MappedPatternMgr())
+        brains[-1].map(mapFile)
+        for brain in brains[:2]:
+            restored = brain.__class__()
+            brain.save(brainFile)
+            restored.restore(brainFile)
+            brains.append(restored)
+    finally:
+        os.remove(mapFile)
+        os.remove(brainFile)
+    names = ["compiled", "mapped", "restored dict", "restored compiled"]
+    expected = matches(brains[0], inputs)
+    for name, brain in zip(names, brains[1:]):
+        _testEqual("%s brain matches" % name, matches(brain, inputs),
+                   expected)
+    # categories added to the brains, mapped or not, match the same way
+    for i in range(30):
+        key, tem = category()
+        for brain in brains:
+            brain.add(key, tem)
+    expected = matches(brains[0], inputs)
+    for name, brain in zip(names, brains[1:]):
+        _testEqual("%s brain matches (added)" % name,
+                   matches(brain, inputs), expected)
+
+def _testConcurrency(aimlFile):
+    """Tests that sessions answered by several threads at once, while the
+    brain learns a file again and learns and unlearns another one, get
+    the responses they get one by one.  Tests that a session is deleted
+    once the request to it is complete.
+
+    """
+    import shutil
+    import tempfile
+    tmpDir = tempfile.mkdtemp()
+    extraFile = os.path.join(tmpDir, "extra.aiml")
+    with open(extraFile, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<aiml>\n')
+        for i in range(100):
+            f.write("<category><pattern>EXTRA %d *</pattern>"
+                    "<template>extra</template></category>\n" % i)
+        f.write("</aiml>\n")
+
+    def changeBrain(k):
+        for i in range(3):
+            k.learn(extraFile)
+            k.unlearn(extraFile)
+            k.learn(aimlFile)
+
+    inputs = ["test system", "test that", "test that", "test srai"]
+    expected = ["The system says hello!",
+                "I just said: The system says hello!",
+                "I have already answered this question", "srai test passed"]
+    for mode in Kernel._concurrencyModes:
+        k = Kernel()
+        k.verbose(False)
+        k.setConcurrency(mode)
+        k.learn(aimlFile)
+        results = {}
+
+        def converse(sessionID):
+            try:
+                responses = []
+                for i in range(10):
+                    responses.append([k.respond(input, sessionID)
+                                      for input in inputs])
+                results[sessionID] = (
+                    responses, k.getPredicate(k._inputHistory, sessionID))
+            except Exception, e:
+                results[sessionID] = e
+
+        threads = [threading.Thread(target=converse, args=("t%d" % i,))
+                   for i in range(4)]
+        threads.append(threading.Thread(target=changeBrain, args=(k,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        history = inputs * 10
+        _testEqual("%s concurrency" % mode, results,
+                   dict(("t%d" % i, ([expected] * 10,
+                                     history[-k._maxHistorySize:]))
+                        for i in range(4)))
+
+        # a request to the session holds its lock until it's complete
+        k.respond("test system", "deleted")
+        lock = k._acquireSession("deleted")
+        thread = threading.Thread(target=k._deleteSession, args=("deleted",))
+        thread.start()
+        thread.join(0.05)
+        deleted = not k._sessions.has_key("deleted")
+        lock.release()
+        thread.join()
+        _testEqual("%s session deletion" % mode,
+                   (deleted, k._sessions.has_key("deleted"),
+                    "deleted" in k._sessionLocks),
+                   (False, False, False))
+    shutil.rmtree(tmpDir)
+    try:
+        k.setConcurrency("none")
+    except ValueError:
+        _testEqual("concurrency mode check", True, True)
+    else:
+        _testEqual("concurrency mode check", False, True)
+
+def _testQueries(aimlFile):
+    """Tests that queries are answered with the predicates of their
+    session without changing it, and leave no session behind.
+
+    """
+    k = Kernel()
+    k.learn(aimlFile)
+    k.respond("test system", "q")
+    session = k.getSessionData("q")
+    _testEqual("query", [k.respond("test that", "q", query=True),
+                         k.respond("test get and set", "q", query=True),
+                         k.respond("test that", "q", query=True)],
+               ["I just said: The system says hello!",
+                "I like cheese. My favorite food is cheese",
+                "I just said: The system says hello!"])
+    _testEqual("query session unchanged", k.getSessionData("q"), session)
+    _testEqual("query candidates",
+               k.respondCandidates("test random", lambda r: False, "q",
+                                   query=True) in
+               ["response #1", "response #2", "response #3"], True)
+    _testEqual("query sessions removed", sorted(k.getSessionData()),
+               [k._globalSessionID, "q"])
+    _testEqual("response after queries", k.respond("test that", "q"),
+               "I just said: The system says hello!")
+
+def _testNormalization(aimlFile):
+    """Tests that a request normalizes each string once, and that the
+    strings normalized are forgotten once the request is done.
 
+    """
+    k = Kernel()
+    k.learn(aimlFile)
+    response = k.respond("test sr test srai")
+    stats = k.getNormalizationStats()
+    _testEqual("normalization memo",
+               (response, stats["hits"] > 0, stats["misses"] > 0),
+               ("srai results: srai test passed", True, True))
+    response = k.respond("tst srai")
+    k._subbers["normal"]["tst"] = "test"
+    _testEqual("normalization memo per request",
+               (response, k.respond("tst srai")), ("", "srai test passed"))
+
+def _testTemplateCompilation(aimlFile):
+    """Tests that templates are compiled once, and compiled again when
+    the brain changes.  _testKernel() tests the interpreter.
+
+    """
+    k = Kernel()
+    k.learn(aimlFile)
+    k.respond("test sr test srai")
+    compiled = len(k._compiledTemplates)
+    k.respond("test sr test srai")
+    _testEqual("template compilation", (compiled, len(k._compiledTemplates)),
+               (3, 3))
+    k.learn(aimlFile)
+    _testEqual("template compilation dropped", len(k._compiledTemplates), 0)
+    k.setTemplateCompilation(False)
+    k.respond("test sr test srai")
+    _testEqual("template compilation disabled", len(k._compiledTemplates), 0)
+
+def _testTraces(aimlFile):
+    """Tests the traces of requests, traced or not, and that they are
+    kept by the thread of the request.
+
+    """
+    k = Kernel()
+    k.learn(aimlFile)
+    input = "test sr test srai. test bot"
+    k.respond(input)
+    patterns = lambda records: [record["pattern"] for record in records]
+    _testEqual("trace", (patterns(k.getTrace()), patterns(k.getMatches())),
+               ([u"TEST BOT", u"TEST SR *", u"TEST SRAI", u"SRAI TARGET"],
+                [u"TEST BOT", u"TEST SR *"]))
+    _testEqual("trace docs", k.getTraceDocs()[0],
+               "%s, (line 39, column 0), TEST BOT, (line 38, column 9)" %
+               aimlFile)
+    thread = threading.Thread(target=k.respond, args=("test srai",))
+    thread.start()
+    thread.join()
+    _testEqual("trace of the thread", len(k.getTrace()), 4)
+    k.respond(input, trace=False)
+    _testEqual("trace disabled", (k.getTrace(), patterns(k.getMatches())),
+               ([], [u"TEST BOT", u"TEST SR *"]))
+
+def _testLearnProcesses(aimlFile):
+    """Tests that the files learned by a pool of processes, or one by one
+    while another thread runs, give the brain they give learned one by
+    one.
+
+    """
+    files = [aimlFile, aimlFile]
+    expected = Kernel()
+    expected.learn(files)
+    inputs = ["test srai", "test bot", "test star end the credits roll"]
+    expected = (expected.numCategories(), map(expected.respond, inputs))
+    k = Kernel()
+    k.setLearnProcesses(2)
+    k.learn(files)
+    _testEqual("learn processes", (k.numCategories(), map(k.respond, inputs)),
+               expected)
+    done = threading.Event()
+    thread = threading.Thread(target=done.wait)
+    thread.start()
+    try:
+        _testEqual("learn processes (threaded)", _forkIsSafe(), False)
+        k = Kernel()
+        k.setLearnProcesses(2)
+        k.learn(files)
+        _testEqual("learn processes (threaded) brain",
+                   (k.numCategories(), map(k.respond, inputs)), expected)
+    finally:
+        done.set()
+        thread.join()
+
+def _testMatchCache(k):
+    """Tests that inputs differing in case and punctuation only share
+    their match, and get the stars of their own words.
+
+    """
+    k.respond('test star end rolling credits', 'cache1')
+    hits = k.getMatchCacheStats()["hits"]
+    _testEqual("match cache (punctuation)",
+               (k.respond('Test star end: Rolling, credits', 'cache2'),
+                k.getMatchCacheStats()["hits"] > hits),
+               ('End star matched: Rolling, credits', True))
+
+def _testSraiIndex():
+    """Tests that the responses of a Kernel indexing the chains of
+    reductions are those of one processing each reduction, as the brain
+    and the bot name change.
+
+    """
+    import shutil
+    import tempfile
+    tmpDir = tempfile.mkdtemp()
+    aimlFile = os.path.join(tmpDir, "chains.aiml")
+    categories = [
+        ("CHAIN ONE", "", "<srai>chain two</srai>"),
+        ("CHAIN TWO", "", "<srai>chain three</srai>"),
+        ("CHAIN THREE", "", "<srai>chain end</srai>"),
+        ("CHAIN END", "", "end of <star/> chain"),
+        ("CHAIN *", "", "<srai>chain end</srai>"),
+        ("CHAIN BOT", "", "<srai>hello nameless</srai>"),
+        ('HELLO <bot name="name"/>', "", "<srai>chain one</srai>"),
+        ("HELLO *", "", "hello stranger"),
+        ("CHAIN THAT", "", "<srai>depends</srai>"),
+        ("DEPENDS", "", "without that"),
+        ("DEPENDS", "END OF CHAIN", "with that"),
+        ("CYCLE A", "", "<srai>cycle b</srai>"),
+        ("CYCLE B", "", "<srai>cycle a</srai>"),
+    ]
+    with open(aimlFile, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<aiml>\n')
+        for pattern, that, template in categories:
+            that = "<that>%s</that>" % that if that else ""
+            f.write("<category><pattern>%s</pattern>%s<template>%s"
+                    "</template></category>\n" % (pattern, that, template))
+        f.write("</aiml>\n")
+    inputs = ["chain one", "chain that", "chain bot", "chain that",
+              "chain two. chain bot", "cycle a", "chain that"]
+    try:
+        for brainType in ["dict", "compiled"]:
+            kernels = [Kernel(), Kernel()]
+            for k in kernels:
+                k.setBrainType(brainType)
+                k.setBotPredicate("name", "NAMELESS")
+                k.learn(aimlFile)
+            kernels[0].setSraiIndexing(True)
+
+            def responses():
+                return [[(k.respond(input, "chains"),
+                          [t["pattern"] for t in k.getTrace()])
+                         for input in inputs] for k in kernels]
+            plain, indexed = responses()
+            _testEqual("%s brain srai index" % brainType, indexed, plain)
+            _testEqual("%s brain srai index chains" % brainType,
+                       len(kernels[0]._sraiIndex), 4)
+            for k in kernels:
+                k.setBotPredicate("name", "ROBBY")
+            plain, indexed = responses()
+            _testEqual("%s brain srai index bot name" % brainType,
+                       (indexed, indexed[2]),
+                       (plain, ("hello stranger",
+                                [u"CHAIN BOT", u"HELLO *"])))
+            for k in kernels:
+                k.unlearn(aimlFile)
+            _testEqual("%s brain srai index dropped" % brainType,
+                       kernels[0]._sraiIndex, None)
+            plain, indexed = responses()
+            _testEqual("%s brain srai index unlearned" % brainType,
+                       indexed, plain)
+    finally:
+        shutil.rmtree(tmpDir)
+
+def _testLearnedFiles():
+    """Tests unlearning and relearning files, with a category defined in
+    two of them, in brains learned, shared, loaded or mapped.
+
+    """
+    import shutil
+    import tempfile
+    tmpDir = tempfile.mkdtemp()
+
+    def write(name, categories):
+        filename = os.path.join(tmpDir, name)
+        with open(filename, "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<aiml>\n')
+            for pattern, template in categories:
+                f.write("<category><pattern>%s</pattern>"
+                        "<template>%s</template></category>\n" % (
+                            pattern, template))
+            f.write("</aiml>\n")
+        return filename
+
+    def responses(k):
+        return [k.respond(input) for input in ("test one", "test both",
+                                               "test two")]
+
+    try:
+        fileA = write("a.aiml", [("TEST ONE", "one from a"),
+                                 ("TEST BOTH", "both from a")])
+        fileB = write("b.aiml", [("TEST BOTH", "both from b"),
+                                 ("TEST TWO", "two from b")])
+        learned = Kernel()
+        learned.learn([fileA, fileB])
+
+        def shared():
+            k = Kernel()
+            k.setBrain(learned.shareBrain())
+            return k
+
+        def loaded():
+            k = Kernel()
+            brainFile = os.path.join(tmpDir, "snapshot.brn")
+            learned.saveBrain(brainFile)
+            k.loadBrain(brainFile)
+            return k
+
+        def mapped():
+            k = Kernel()
+            brainFile = os.path.join(tmpDir, "snapshot.mbrn")
+            learned.saveMappedBrain(brainFile)
+            k.mapBrain(brainFile)
+            return k
+
+        for source, makeKernel in [("shared", shared), ("loaded", loaded),
+                                   ("mapped", mapped)]:
+            k = makeKernel()
+            _testEqual("%s brain learned files" % source,
+                       (k.getLearnedFiles(), responses(k)),
+                       ([fileA, fileB],
+                        ["one from a", "both from b", "two from b"]))
+            k.unlearn(fileB)
+            _testEqual("%s brain unlearn" % source, responses(k),
+                       ["one from a", "both from a", ""])
+            k.learn(fileB)
+            k.unlearn(fileA)
+            _testEqual("%s brain unlearn overridden" % source, responses(k),
+                       ["", "both from b", "two from b"])
+            k.learn(fileA)
+            _testEqual("%s brain learn again" % source, responses(k),
+                       ["one from a", "both from a", "two from b"])
+            write("b.aiml", [("TEST BOTH", "both from b2")])
+            k = makeKernel()
+            k.relearn(fileB)
+            _testEqual("%s brain relearn" % source, responses(k),
+                       ["one from a", "both from b2", ""])
+            write("b.aiml", [("TEST BOTH", "both from b"),
+                             ("TEST TWO", "two from b")])
+        _testEqual("shared brain unchanged", responses(learned),
+                   ["one from a", "both from b", "two from b"])
+    finally:
+        shutil.rmtree(tmpDir)
+
+def _testMatchMany(k):
+    """Tests that the inputs matched by a pool of processes, or in this
+    process while another thread runs, match as they do one by one.
+
+    """
+    inputs = ["test srai", "test star end the credits roll. test bot",
+              "no such pattern", "", float("nan")]
+    expected = [k.matchMany([input])[0] for input in inputs]
+    _testEqual("matchMany", [len(matches) for matches in expected],
+               [1, 2, 1, 0, 0])
+    _testEqual("matchMany processes", k.matchMany(inputs, processes=2),
+               expected)
+    done = threading.Event()
+    thread = threading.Thread(target=done.wait)
+    thread.start()
+    try:
+        _testEqual("matchMany processes (threaded)",
+                   k.matchMany(inputs, processes=2), expected)
+    finally:
+        done.set()
+        thread.join()
+
+def _testSessions(aimlFile):
+    """Tests the session records, the query sessions layered over them,
+    and the session store.
+
+    """
+    from Session import KernelSession
+    session = KernelSession()
+    session["name"] = "Alice"
+    session["_inputHistory"].append(u"hi")
+    _testEqual("session copy", session.copy(), {
+        "name": "Alice", "_inputHistory": [u"hi"], "_outputHistory": []})
+    del session["_inputHistory"]
+    _testEqual("session history delete", session["_inputHistory"], [])
+
+    query = QuerySession(session)
+    query["mood"] = "happy"
+    nested = QuerySession(query)
+    nested["_outputHistory"].append(u"hello")
+    _testEqual("nested query session copy", nested.copy(), {
+        "name": "Alice", "mood": "happy", "_inputHistory": [],
+        "_outputHistory": [u"hello"]})
+    del nested["name"]
+    _testEqual("query session delete",
+               ("name" in nested, "name" in nested.copy(), "name" in query,
+                sorted(nested.keys())),
+               (False, False, True,
+                ["_inputHistory", "_outputHistory", "mood"]))
+    nested.commit()
+    _testEqual("query session commit",
+               (sorted(query.copy().items()), session["_outputHistory"]),
+               ([("_inputHistory", []), ("_outputHistory", [u"hello"]),
+                 ("mood", "happy")], []))
+    query.commit()
+    _testEqual("query session commit through",
+               ("name" in session, session["mood"],
+                session["_outputHistory"]),
+               (False, "happy", [u"hello"]))
+
+    store = SessionStore()
+    empty = store.add("a").sizeof()
+    store.add("b")["name"] = "Bob"
+    store["q"] = QuerySession(store["b"])
+    sizes = store.sizes()
+    _testEqual("session sizes", (sorted(sizes), sizes["a"] == empty,
+                                 sizes["b"] > empty),
+               (["a", "b"], True, True))
+
+    k = Kernel()
+    k.learn(aimlFile)
+    k.respond(u"test srai", "u")
+    _testEqual("session history types",
+               [map(type, k.getPredicate(name, "u"))
+                for name in (k._inputHistory, k._outputHistory)],
+               [[unicode], [unicode]])
+
+def _testKernel(k):
+    """Run the self-tests against the Kernel k, which must have learned
+    self-test.aiml.
+
+    """
     _testTag(k, 'bot', 'test bot', ["My name is Nameless"])
 
     k.setPredicate('gender', 'male')
@@ -1280,6 +2884,8 @@ if __name__ == "__main__":
     _testTag(k, 'random', 'test random', [
              "response #1", "response #2", "response #3"])
     _testTag(k, 'random empty', 'test random empty', ["Nothing here!"])
+    for output in ["response #1", "response #2", "response #3"]:
+        _testCandidates(k, 'random', 'test random', output)
     _testTag(k, 'sentence', "test sentence", [
              "My first letter should be capitalized."])
     _testTag(k, 'size', "test size", [
@@ -1297,6 +2903,14 @@ if __name__ == "__main__":
              ['End star matched: the credits roll'])
     _testTag(k, 'star test #4', 'test star having multiple stars in a pattern makes me extremely happy',
              ['Multiple stars matched: having, stars in a pattern, extremely happy'])
+    _testTag(k, 'star test #5', 'test star end rock & roll',
+             ['End star matched: rock & roll'])
+    _testTag(k, 'star test #6', 'test star end -- cats',
+             ['End star matched: -- cats'])
+    _testTag(k, 'star test #7', 'test star it - multiple out - of 10 makes me happy :)',
+             ['Multiple stars matched: it, out - of 10, happy :)'])
+    _testTag(k, 'star test #8', 'rock-and-roll test star begin',
+             ['Begin star matched: rock-and-roll'])
     _testTag(k, 'system', "test system", ["The system says hello!"])
     _testTag(k, 'that test #1', "test that", [
              "I just said: The system says hello!"])
@@ -1326,6 +2940,58 @@ if __name__ == "__main__":
     _testTag(k, 'whitespace preservation', 'test whitespace', [
              "Extra   Spaces\n   Rule!   (but not in here!)    But   Here   They   Do!"])
 
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    cwd = os.path.dirname(os.path.realpath(__file__))
+
+    global _numTests, _numPassed
+    _numTests = 0
+    _numPassed = 0
+
+    aimlFile = os.path.join(cwd, "self-test.aiml")
+
+    # Run some self-tests against every type of brain
+    for brainType in sorted(Kernel._brainTypes.keys()):
+        logger.info("Testing %s brain" % brainType)
+        k = Kernel()
+        k.setBrainType(brainType)
+        if brainType != "dict":
+            # the dict brain is tested without the match cache
+            k.setMatchCacheSize(100)
+        k.bootstrap(learnFiles=aimlFile)
+        if brainType == "mapped":
+            # match against the brain mapped from a file
+            import tempfile
+            fd, mapFile = tempfile.mkstemp(suffix=".brn")
+            os.close(fd)
+            k.saveMappedBrain(mapFile)
+            k.mapBrain(mapFile)
+            os.remove(mapFile)
+        _testKernel(k)
+        if brainType != "dict":
+            _testMatchCache(k)
+        _testMatchMany(k)
+
+    # and against the template interpreter
+    logger.info("Testing interpreted templates")
+    k = Kernel()
+    k.setTemplateCompilation(False)
+    k.bootstrap(learnFiles=aimlFile)
+    _testKernel(k)
+
+    _testBrainTypes()
+    _testTemplateCompilation(aimlFile)
+    _testConcurrency(aimlFile)
+    _testQueries(aimlFile)
+    _testNormalization(aimlFile)
+    _testTraces(aimlFile)
+    _testLearnProcesses(aimlFile)
+    _testSessions(aimlFile)
+    _testLearnedFiles()
+    _testSraiIndex()
+
     # Report test results
     logger.info("--------------------")
     if _numTests == _numPassed:
@@ -0,0 +1,218 @@
+"""
+Copyright 2003-2010 Cort Stratton. All rights reserved.
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+# This class matches against a compiled brain file that is mapped into
+# memory, so that the processes of a host that map the same file share
+# one copy of it.  The file holds the arrays of CompiledPatternMgr and its
+# word and template tables:
+#
+#  - a header: the magic string, a byte order mark and the item counts,
+#  - the int32 arrays _first, _keys and _tmpl,
+#  - the uint32 offsets of the words and the templates in their blobs,
+#  - the marshal()ed bot name, template count and learned files,
+#  - the UTF-8 encoded words, sorted, and the marshal()ed templates.
+#
+# Words are found by a binary search of the word table, and templates
+# are unmarshalled when they are matched.  Categories added to a mapped
+# brain are compiled into memory like those of CompiledPatternMgr.
+
+from bisect import bisect_left
+import ctypes
+import marshal
+import mmap
+import os
+import struct
+import logging
+
+from CompiledPatternMgr import CompiledPatternMgr, _utf8
+
+logger = logging.getLogger('hr.chatbot.aiml.mappedpatternmgr')
+
+_MAGIC = "PYAIMLM1"
+_BOM = 0x01020304
+_HEADER = struct.Struct("=8sIIIIII")
+
+
+class _WordIds(object):
+    """The word -> id mapping of a mapped word table, which is searched by
+    the UTF-8 encoding of the words.
+
+    """
+
+    def __init__(self, words, firstId):
+        self._words = words
+        self._firstId = firstId
+
+    def get(self, word, default=None):
+        word = _utf8(word)
+        i = bisect_left(self._words, word)
+        if i < len(self._words) and self._words[i] == word:
+            return self._firstId + i
+        return default
+
+
+class _Table(object):
+    """A read-only sequence of the items of a mapped blob.  Item i is
+    decoded from blob[offsets[i]:offsets[i+1]].
+
+    """
+
+    def __init__(self, buf, offsets, start, decode):
+        self._buf = buf
+        self._offsets = offsets
+        self._start = start
+        self._decode = decode
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError, "table index out of range"
+        return self._decode(self._buf[self._start + self._offsets[i]:
+                                      self._start + self._offsets[i + 1]])
+
+
+def _blob(items):
+    """Return the concatenated items and the array of their offsets."""
+    offsets = (ctypes.c_uint32 * (len(items) + 1))()
+    pos = 0
+    for i, item in enumerate(items):
+        offsets[i] = pos
+        pos += len(item)
+    offsets[len(items)] = pos
+    return "".join(items), offsets
+
+
+def saveMapped(brain, filename):
+    """Write the CompiledPatternMgr brain to filename in the format
+    MappedPatternMgr.map() reads.
+
+    """
+    brain.compile()
+    words, wordOffsets = _blob([_utf8(word) for word in brain._words])
+    templates, templateOffsets = _blob(
+        [marshal.dumps(tem) for tem in brain._templates])
+    meta = marshal.dumps((brain._botName, brain._templateCount,
+                          brain._learnedFiles))
+    outFile = open(filename, "wb")
+    try:
+        outFile.write(_HEADER.pack(
+            _MAGIC, _BOM, len(brain._tmpl), len(brain._keys),
+            len(brain._words), len(brain._templates), len(meta)))
+        for table in (brain._first, brain._keys, brain._tmpl):
+            outFile.write((ctypes.c_int32 * len(table))(*table))
+        outFile.write(wordOffsets)
+        outFile.write(templateOffsets)
+        outFile.write(meta)
+        outFile.write(words)
+        outFile.write(templates)
+    finally:
+        outFile.close()
+
+
+class MappedPatternMgr(CompiledPatternMgr):
+
+    def __init__(self):
+        CompiledPatternMgr.__init__(self)
+        self._map = None
+
+    def map(self, filename):
+        """Match against the brain saved to filename by saveMapped().
+        The patterns currently stored are discarded.
+
+        """
+        inFile = open(filename, "rb")
+        try:
+            # ctypes arrays need a writable buffer, a private mapping is
+            # one and its pages are shared until they are written to.
+            buf = mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_COPY)
+        finally:
+            inFile.close()
+        (magic, bom, nodeCount, edgeCount, wordCount, templateCount,
+         metaSize) = _HEADER.unpack_from(buf)
+        if magic != _MAGIC or bom != _BOM:
+            buf.close()
+            raise ValueError, "%s is not a mapped brain file" % filename
+        pos = [_HEADER.size]
+
+        def view(ctype, count):
+            table = (ctype * count).from_buffer(buf, pos[0])
+            pos[0] += ctypes.sizeof(table)
+            return table
+        first = view(ctypes.c_int32, nodeCount + 1)
+        keys = view(ctypes.c_int32, edgeCount)
+        tmpl = view(ctypes.c_int32, nodeCount)
+        wordOffsets = view(ctypes.c_uint32, wordCount + 1)
+        templateOffsets = view(ctypes.c_uint32, templateCount + 1)
+        meta = marshal.loads(buf[pos[0]:pos[0] + metaSize])
+        botName, numTemplates = meta[:2]
+        wordStart = pos[0] + metaSize
+        templateStart = wordStart + wordOffsets[wordCount]
+        with self._compileLock:
+            self._map = buf
+            self._wordIds = _WordIds(
+                _Table(buf, wordOffsets, wordStart, str),
+                self._FIRST_WORD_ID)
+            self._words = _Table(buf, wordOffsets, wordStart,
+                                 lambda s: s.decode('utf-8'))
+            self._templates = _Table(buf, templateOffsets, templateStart,
+                                     marshal.loads)
+            self._first = first
+            self._keys = keys
+            self._tmpl = tmpl
+            # the length bounds aren't saved, and computing them would
+            # read the whole file
+            self._minLen = self._maxLen = None
+            self._root = {}
+            self._dirty = False
+            self._templateCount = numTemplates
+            self._botName = botName
+            self._learnedFiles = meta[2] if len(meta) > 2 else []
+            self._patternsChanged()
+        logger.info("Mapped %d nodes, %d words, %d templates from %s" % (
+            nodeCount, wordCount, templateCount, filename))
+
+    def stableTemplates(self):
+        """Return True if a category's template is the same object every
+        time the category is matched.  Mapped templates are unmarshalled
+        anew for each match.
+
+        """
+        return self._map is None
+
+    def compile(self):
+        """Compile the pending additions into the node arrays, which are
+        then kept in memory instead of the mapped file.
+
+        """
+        with self._compileLock:
+            dirty = self._dirty
+        CompiledPatternMgr.compile(self)
+        if dirty:
+            self._map = None
@@ -28,6 +28,8 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 # by Dr. Richard Wallace at the following site:
 # http://www.alicebot.org/documentation/matching.html
 
+import Utils
+
 import marshal
 import pprint
 import re
@@ -38,6 +40,11 @@ import logging
 logger = logging.getLogger('hr.chatbot.aiml.patternmgr')
 
 
+class _ConditionalMatch(Exception):
+    """Raised by PatternMgr._staticMatch() when the match depends on the
+    'that' and 'topic'."""
+
+
 class PatternMgr:
     # special dictionary keys
     _UNDERSCORE = 0
@@ -46,11 +53,21 @@ class PatternMgr:
     _THAT = 3
     _TOPIC = 4
     _BOT_NAME = 5
+    # the length bound of the nodes a wildcard is reachable from
+    _UNBOUNDED = 0x7fffffff
 
     def __init__(self):
         self._root = {}
         self._templateCount = 0
         self._botName = u"Nameless"
+        # the AIML files learned, in order, and the keys of their
+        # categories, see setLearnedFiles()
+        self._learnedFiles = []
+        # cache of the results of matchStars(), None when disabled
+        self._matchCache = None
+        # the (min, max) length bounds of the nodes, keyed by their id(),
+        # or None if they must be computed again
+        self._lengthBounds = None
         punctuation = "\"`~!@#$%^&*()-_=+[{]}\|;:',<.>/?"
         self._puncStripRE = re.compile("[" + re.escape(punctuation) + "]")
         self._whitespaceRE = re.compile("\s+", re.LOCALE | re.UNICODE)
@@ -59,6 +76,77 @@ class PatternMgr:
         """Return the number of templates currently stored."""
         return self._templateCount
 
+    def setMatchCacheSize(self, size):
+        """Keep the results of the last 'size' distinct matches, which
+        are dropped whenever the patterns change.  A size of 0 disables
+        the cache.
+
+        """
+        if size <= 0:
+            self._matchCache = None
+        elif self._matchCache is None:
+            self._matchCache = Utils.LRUCache(size)
+        else:
+            self._matchCache.size = size
+
+    def matchCacheStats(self):
+        """Return a dictionary of the size, maximum size and hit and miss
+        counts of the match cache, or None if it's disabled.
+
+        """
+        cache = self._matchCache
+        if cache is None:
+            return None
+        return {"size": len(cache), "maxSize": cache.size,
+                "hits": cache.hits, "misses": cache.misses}
+
+    def _patternsChanged(self):
+        """Drop the results of the matches made against the previous
+        patterns.
+
+        """
+        if self._matchCache is not None:
+            self._matchCache.clear()
+        self._lengthBounds = None
+
+    def _computeLengthBounds(self):
+        """Return a dictionary mapping the id() of each node to a tuple
+        (min, max): the least and the most words of its segment of the
+        input (input, 'that' or 'topic') that the completions of the
+        patterns below it can consume.  max is _UNBOUNDED if a wildcard
+        is reachable, and min > max if nothing can be matched below.
+
+        """
+        bounds = {}
+        # the tuples are shared, most nodes have the same few bounds
+        pairs = {}
+        unbounded = self._UNBOUNDED
+        ends = (self._TEMPLATE, self._THAT, self._TOPIC)
+        wildcards = (self._UNDERSCORE, self._STAR)
+
+        def visit(node):
+            lo, hi = unbounded, -1
+            for key, child in node.iteritems():
+                if key in ends:
+                    # the segment can end here
+                    lo, hi = 0, max(hi, 0)
+                if key == self._TEMPLATE:
+                    continue
+                childLo, childHi = visit(child)
+                if key in ends or childLo > childHi:
+                    continue
+                if key in wildcards:
+                    childHi = unbounded
+                elif childHi < unbounded:
+                    childHi += 1
+                lo = min(lo, childLo + 1)
+                hi = max(hi, childHi)
+            pair = pairs.setdefault((lo, hi), (lo, hi))
+            bounds[id(node)] = pair
+            return pair
+        visit(self._root)
+        return bounds
+
     def setBotName(self, name):
         """Set the name of the bot, used to match <bot name="name"> tags in
         patterns.  The name must be a single word!
@@ -67,6 +155,17 @@ class PatternMgr:
         # Collapse a multi-word name into a single word
         self._botName = unicode(string.join(name.split()))
 
+    def setLearnedFiles(self, files):
+        """Keep the (filename, keys) pairs of the AIML files learned into
+        the brain, in order, so that they're saved and shared with it.
+
+        """
+        self._learnedFiles = [(f, frozenset(keys)) for f, keys in files]
+
+    def learnedFiles(self):
+        """Return the (filename, keys) pairs set by setLearnedFiles()."""
+        return list(self._learnedFiles)
+
     def get_templates(self, d, l):
         for k in d.iterkeys():
             if isinstance(d[k], dict):
@@ -74,9 +173,27 @@ class PatternMgr:
             else:
                 l.append(d[k])
 
+    def stableTemplates(self):
+        """Return True if a category's template is the same object every
+        time the category is matched, so it can be told apart by its
+        identity.
+
+        """
+        return True
+
+    def templates(self):
+        """Return a list of all templates currently stored."""
+        l = []
+        self.get_templates(self._tree(), l)
+        return l
+
     def dump(self):
         """Print all learned patterns, for debugging purposes."""
-        pprint.pprint(self._root)
+        pprint.pprint(self._tree())
+
+    def _tree(self):
+        """Return the node tree as nested dictionaries."""
+        return self._root
 
     def save(self, filename):
         """Dump the current patterns to the file specified by filename.  To
@@ -87,7 +204,8 @@ class PatternMgr:
             outFile = open(filename, "wb")
             marshal.dump(self._templateCount, outFile)
             marshal.dump(self._botName, outFile)
-            marshal.dump(self._root, outFile)
+            marshal.dump(self._tree(), outFile)
+            marshal.dump(self._learnedFiles, outFile)
             outFile.close()
         except Exception, e:
             logger.error("Error saving PatternMgr to file %s:" % filename)
@@ -100,22 +218,25 @@ class PatternMgr:
             self._templateCount = marshal.load(inFile)
             self._botName = marshal.load(inFile)
             self._root = marshal.load(inFile)
+            try:
+                self._learnedFiles = marshal.load(inFile)
+            except EOFError:
+                # saved without the learned files
+                self._learnedFiles = []
             inFile.close()
+            self._patternsChanged()
         except Exception, e:
             logger.error("Error restoring PatternMgr from file %s:" % filename)
             raise Exception, e
 
-    def add(self, (pattern, that, topic), template):
-        """Add a [pattern/that/topic] tuple and its corresponding template
-        to the node tree.
+    def _path(self, (pattern, that, topic)):
+        """Return the list of the keys of the edges leading from the root
+        to the node of a [pattern/that/topic] tuple.
 
         """
         # TODO: make sure words contains only legal characters
         # (alphanumerics,*,_)
-
-        # Navigate through the node tree to the template's location, adding
-        # nodes if necessary.
-        node = self._root
+        path = []
         for word in string.split(pattern):
             key = word
             if key == u"_":
@@ -124,45 +245,90 @@ class PatternMgr:
                 key = self._STAR
             elif key == u"BOT_NAME":
                 key = self._BOT_NAME
-            if not node.has_key(key):
-                node[key] = {}
-            node = node[key]
+            path.append(key)
 
         # navigate further down, if a non-empty "that" pattern was included
         if len(that) > 0:
-            if not node.has_key(self._THAT):
-                node[self._THAT] = {}
-            node = node[self._THAT]
+            path.append(self._THAT)
             for word in string.split(that):
                 key = word
                 if key == u"_":
                     key = self._UNDERSCORE
                 elif key == u"*":
                     key = self._STAR
-                if not node.has_key(key):
-                    node[key] = {}
-                node = node[key]
+                path.append(key)
 
         # navigate yet further down, if a non-empty "topic" string was included
         if len(topic) > 0:
-            if not node.has_key(self._TOPIC):
-                node[self._TOPIC] = {}
-            node = node[self._TOPIC]
+            path.append(self._TOPIC)
             for word in string.split(topic):
                 key = word
                 if key == u"_":
                     key = self._UNDERSCORE
                 elif key == u"*":
                     key = self._STAR
-                if not node.has_key(key):
-                    node[key] = {}
-                node = node[key]
+                path.append(key)
+        return path
+
+    def add(self, (pattern, that, topic), template):
+        """Add a [pattern/that/topic] tuple and its corresponding template
+        to the node tree.
+
+        """
+        self._patternsChanged()
+
+        # Navigate through the node tree to the template's location, adding
+        # nodes if necessary.
+        node = self._root
+        for key in self._path((pattern, that, topic)):
+            if not node.has_key(key):
+                node[key] = {}
+            node = node[key]
 
         # add the template.
         if not node.has_key(self._TEMPLATE):
             self._templateCount += 1
         node[self._TEMPLATE] = template
 
+    def get(self, (pattern, that, topic)):
+        """Return the template of the [pattern/that/topic] tuple, or None
+        if it has none.  Unlike match(), the patterns are not matched
+        against each other.
+
+        """
+        node = self._root
+        for key in self._path((pattern, that, topic)):
+            node = node.get(key)
+            if node is None:
+                return None
+        return node.get(self._TEMPLATE)
+
+    def remove(self, (pattern, that, topic)):
+        """Remove the template of a [pattern/that/topic] tuple from the
+        node tree, along with the nodes left empty.  Returns the removed
+        template, or None if there was none.
+
+        """
+        nodes = [self._root]
+        path = self._path((pattern, that, topic))
+        for key in path:
+            node = nodes[-1].get(key)
+            if node is None:
+                return None
+            nodes.append(node)
+        template = nodes[-1].pop(self._TEMPLATE, None)
+        if template is None:
+            return None
+        self._templateCount -= 1
+        self._patternsChanged()
+        # prune the nodes leading to nothing else
+        for key in reversed(path):
+            nodes.pop()
+            if len(nodes[-1][key]) > 0:
+                break
+            del nodes[-1][key]
+        return template
+
     def match(self, pattern, that, topic):
         """Return the template which is the closest match to pattern. The
         'that' parameter contains the bot's previous response. The 'topic'
@@ -170,27 +336,228 @@ class PatternMgr:
 
         Returns None if no template is found.
 
+        """
+        return self.matchStars(pattern, that, topic)[0]
+
+    def matchStars(self, pattern, that, topic, botName=None, memo=None):
+        """Return a tuple (tem, stars) where tem is the template which is
+        the closest match to pattern, as returned by match(), and stars
+        holds the text fragments the wildcards of the matching category
+        captured.
+
+        botName is the name matched by <bot name="name"> tags in
+        patterns, and defaults to the name set with setBotName().  A
+        brain shared by several bots is matched with the name of each.
+
+        memo is an optional Utils.Memo, in which the words of the
+        strings matched are kept so that they're split up only once.
+
+        stars is a dictionary with the keys 'star', 'thatstar' and
+        'topicstar', each mapping to the list of fragments matched by
+        the * and _ wildcards of the pattern, that and topic patterns
+        respectively, in order.
+
+        Returns (None, {}) if no template is found.
+
         """
         if len(pattern) == 0:
-            return None
-        # Mutilate the input.  Remove all punctuation and convert the
-        # text to all caps.
-        input = string.upper(pattern)
-        input = re.sub(self._puncStripRE, " ", input)
+            return (None, {})
+        if botName is None:
+            botName = self._botName
+        else:
+            botName = unicode(string.join(botName.split()))
         if that.strip() == u"":
             that = u"ULTRABOGUSDUMMYTHAT"  # 'that' must never be empty
-        thatInput = string.upper(that)
-        thatInput = re.sub(self._puncStripRE, " ", thatInput)
-        thatInput = re.sub(self._whitespaceRE, " ", thatInput)
         if topic.strip() == u"":
             topic = u"ULTRABOGUSDUMMYTOPIC"  # 'topic' must never be empty
-        topicInput = string.upper(topic)
-        topicInput = re.sub(self._puncStripRE, " ", topicInput)
+        texts = (pattern, that, topic)
+        if memo is None:
+            words = [self._splitWords(text) for text in texts]
+        else:
+            words = [memo.lookup(("words", text), self._splitWords, text)
+                     for text in texts]
+        segments = tuple(segment[0] for segment in words)
+
+        # Inputs differing only in case and punctuation have the same
+        # words, and match the same way
+        cache = self._matchCache
+        if cache is None:
+            result = self._matchRoot(
+                segments[0], segments[1], segments[2], botName)
+        else:
+            key = (tuple(segments[0]), tuple(segments[1]),
+                   tuple(segments[2]), botName)
+            result = cache.get(key)
+            if result is None:
+                result = self._matchRoot(
+                    segments[0], segments[1], segments[2], botName)
+                cache.put(key, result)
+        patMatch, template, spans = result
+        if template is None:
+            return (None, {})
+
+        # Walk the matched pattern, pairing each wildcard with the span
+        # of words it consumed, and extract the star words from the
+        # original, unmutilated input.
+        starTypes = ('star', 'thatstar', 'topicstar')
+        stars = {'star': [], 'thatstar': [], 'topicstar': []}
+        seg = 0
+        spans = iter(spans)
+        for key in patMatch:
+            if key == self._THAT:
+                seg = 1
+            elif key == self._TOPIC:
+                seg = 2
+            elif key == self._STAR or key == self._UNDERSCORE:
+                remaining, length = spans.next()
+                start = len(segments[seg]) - remaining
+                stars[starTypes[seg]].append(
+                    self._starWords(words[seg], start, length))
+        return (template, stars)
+
+    def staticMatch(self, pattern, botName=None):
+        """Return a tuple (tem, stars) where tem is the template pattern
+        matches whatever the 'that' and 'topic' are, and stars is the
+        list of the text fragments the wildcards of the pattern captured.
+
+        Returns None if the match depends on the 'that' or 'topic', or if
+        no template is found.
 
-        # Pass the input off to the recursive call
-        patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
-        return template
+        """
+        if len(pattern) == 0:
+            return None
+        if botName is None:
+            botName = self._botName
+        else:
+            botName = unicode(string.join(botName.split()))
+        words = self._splitWords(pattern)
+        mutilated = words[0]
+        try:
+            result = self._staticMatch(mutilated, self._rootNode(), botName)
+        except _ConditionalMatch:
+            return None
+        if result is None:
+            return None
+        template, spans = result
+        stars = []
+        for remaining, length in spans:
+            start = len(mutilated) - remaining
+            stars.append(self._starWords(words, start, length))
+        return (template, stars)
+
+    def _staticMatch(self, words, node, botName):
+        """Match the input words from node the way _matchRoot() does, and
+        return a tuple (tem, spans) like it for the first category
+        reached.  Returns None if there is no such category, and raises
+        _ConditionalMatch if the category depends on the 'that' and
+        'topic'.
+
+        """
+        if len(words) == 0:
+            that = self._childNode(node, self._THAT)
+            if that is None:
+                template = self._nodeTemplate(node)
+                if template is None:
+                    return None
+                return (template, [])
+            template = self._unconditionalTemplate(that)
+            if template is None:
+                raise _ConditionalMatch
+            return (template, [])
+
+        first = words[0]
+        suffix = words[1:]
+        for key in (self._UNDERSCORE, self._wordKey(first), self._BOT_NAME,
+                    self._STAR):
+            if key == self._BOT_NAME and first != botName:
+                continue
+            child = self._childNode(node, key)
+            if child is None:
+                continue
+            if key == self._UNDERSCORE or key == self._STAR:
+                for j in range(len(suffix) + 1):
+                    result = self._staticMatch(suffix[j:], child, botName)
+                    if result is not None:
+                        return (result[0],
+                                [(len(words), j + 1)] + result[1])
+            else:
+                result = self._staticMatch(suffix, child, botName)
+                if result is not None:
+                    return result
+        return None
+
+    def _unconditionalTemplate(self, that):
+        """Return the template below the _THAT node that, if its 'that'
+        and 'topic' patterns are single wildcards and nothing else is
+        below it.  Otherwise returns None.
+
+        """
+        node = that
+        wildcards = (self._STAR, self._UNDERSCORE)
+        for expected in (wildcards, (self._TOPIC,), wildcards):
+            children = self._childNodes(node)
+            if len(children) != 1 or children[0][0] not in expected:
+                return None
+            node = children[0][1]
+        if len(self._childNodes(node)) > 0:
+            return None
+        return self._nodeTemplate(node)
+
+    # The node tree interface of _staticMatch(), which subclasses storing
+    # the tree in other forms override.
+    def _rootNode(self):
+        return self._root
+
+    def _childNode(self, node, key):
+        """Return the child of node by the edge key, or None."""
+        return node.get(key)
+
+    def _childNodes(self, node):
+        """Return the list of (key, child) of the children of node."""
+        return [(key, child) for key, child in node.iteritems()
+                if key != self._TEMPLATE]
+
+    def _nodeTemplate(self, node):
+        return node.get(self._TEMPLATE)
+
+    def _wordKey(self, word):
+        """Return the key of the edges of word."""
+        return word
+
+    def _splitWords(self, text):
+        """Return a tuple (mutilated, original, tokens) of the words of
+        text, with and without all punctuation removed and the text
+        converted to all caps.  tokens holds the index in original of
+        the word each mutilated word comes from; words made only of
+        punctuation have no mutilated words.
+
+        """
+        original = text.split()
+        mutilated = []
+        tokens = []
+        for i, word in enumerate(original):
+            word = re.sub(self._puncStripRE, " ", string.upper(word))
+            for part in word.split():
+                mutilated.append(part)
+                tokens.append(i)
+        return (mutilated, original, tokens)
+
+    def _starWords(self, words, start, length):
+        """Return the original text of the length mutilated words from
+        start, of the words returned by _splitWords().  The punctuation
+        before them, and after them at the end of the text, is kept, and
+        original words split up are given whole.
+
+        """
+        mutilated, original, tokens = words
+        first = tokens[start]
+        if start == 0:
+            first = 0
+        elif tokens[start - 1] < first:
+            first = tokens[start - 1] + 1
+        end = start + length
+        last = len(original) if end == len(mutilated) else tokens[end - 1] + 1
+        return string.join(original[first:last])
 
     def star(self, starType, pattern, that, topic, index):
         """Returns a string, the portion of pattern that was matched by a *.
@@ -202,185 +569,194 @@ class PatternMgr:
          - 'topicstar': matches a star in the topic pattern.
 
         """
-        # Mutilate the input.  Remove all punctuation and convert the
-        # text to all caps.
-        input = string.upper(pattern)
-        input = re.sub(self._puncStripRE, " ", input)
-        input = re.sub(self._whitespaceRE, " ", input)
-        if that.strip() == u"":
-            that = u"ULTRABOGUSDUMMYTHAT"  # 'that' must never be empty
-        thatInput = string.upper(that)
-        thatInput = re.sub(self._puncStripRE, " ", thatInput)
-        thatInput = re.sub(self._whitespaceRE, " ", thatInput)
-        if topic.strip() == u"":
-            topic = u"ULTRABOGUSDUMMYTOPIC"  # 'topic' must never be empty
-        topicInput = string.upper(topic)
-        topicInput = re.sub(self._puncStripRE, " ", topicInput)
-        topicInput = re.sub(self._whitespaceRE, " ", topicInput)
-
-        # Pass the input off to the recursive pattern-matcher
-        patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
-        if template == None:
-            return ""
-
-        # Extract the appropriate portion of the pattern, based on the
-        # starType argument.
-        words = None
-        if starType == 'star':
-            patMatch = patMatch[:patMatch.index(self._THAT)]
-            words = input.split()
-        elif starType == 'thatstar':
-            patMatch = patMatch[patMatch.index(
-                self._THAT) + 1: patMatch.index(self._TOPIC)]
-            words = thatInput.split()
-        elif starType == 'topicstar':
-            patMatch = patMatch[patMatch.index(self._TOPIC) + 1:]
-            words = topicInput.split()
-        else:
+        if starType not in ['star', 'thatstar', 'topicstar']:
             # unknown value
             raise ValueError, "starType must be in ['star', 'thatstar', 'topicstar']"
-
-        # compare the input string to the matched pattern, word by word.
-        # At the end of this loop, if foundTheRightStar is true, start and
-        # end will contain the start and end indices (in "words") of
-        # the substring that the desired star matched.
-        foundTheRightStar = False
-        start = end = j = numStars = k = 0
-        for i in range(len(words)):
-            # This condition is true after processing a star
-            # that ISN'T the one we're looking for.
-            if i < k:
-                continue
-            # If we're reached the end of the pattern, we're done.
-            if j == len(patMatch):
-                break
-            if not foundTheRightStar:
-                if patMatch[j] in [self._STAR, self._UNDERSCORE]:  # we got a star
-                    numStars += 1
-                    if numStars == index:
-                        # This is the star we care about.
-                        foundTheRightStar = True
-                    start = i
-                    # Iterate through the rest of the string.
-                    for k in range(i, len(words)):
-                        # If the star is at the end of the pattern,
-                        # we know exactly where it ends.
-                        if j + 1 == len(patMatch):
-                            end = len(words)
-                            break
-                        # If the words have started matching the
-                        # pattern again, the star has ended.
-                        if patMatch[j + 1] == words[k]:
-                            end = k - 1
-                            i = k
-                            break
-                # If we just finished processing the star we cared
-                # about, we exit the loop early.
-                if foundTheRightStar:
-                    break
-            # Move to the next element of the pattern.
-            j += 1
-
-        # extract the star words from the original, unmutilated input.
-        if foundTheRightStar:
-            # print string.join(pattern.split()[start:end+1])
-            if starType == 'star':
-                return string.join(pattern.split()[start:end + 1])
-            elif starType == 'thatstar':
-                return string.join(that.split()[start:end + 1])
-            elif starType == 'topicstar':
-                return string.join(topic.split()[start:end + 1])
-        else:
+        template, stars = self.matchStars(pattern, that, topic)
+        if template is None or index < 1:
+            return ""
+        try:
+            return stars[starType][index - 1]
+        except IndexError:
             return ""
 
-    def _match(self, words, thatWords, topicWords, root):
-        """Return a tuple (pat, tem) where pat is a list of nodes, starting
-        at the root and leading to the matching pattern, and tem is the
-        matched template.
+    def _matchRoot(self, words, thatWords, topicWords, botName):
+        """Match the mutilated input words against the whole node tree.
+        Return a tuple (pat, tem, spans) where pat is a list of nodes,
+        starting at the root and leading to the matching pattern, tem is
+        the matched template, and spans describes the words consumed by
+        each * or _ in pat.  Each span is a tuple (remaining, length):
+        the wildcard matched 'length' words, starting at the word that
+        had 'remaining' words (itself included) left in its segment of
+        the input.  botName is the word matched by <bot name="name">.
+
+        Patterns are tried in the order of the AIML matching algorithm:
+        at each node the _ wildcard first, then the word itself, then
+        the bot name, and the * wildcard last, each wildcard matching as
+        few words as it can.
 
         """
-        # base-case: if the word list is empty, return the current node's
-        # template.
-        if len(words) == 0:
-            # we're out of words.
-            pattern = []
-            template = None
-            if len(thatWords) > 0:
-                # If thatWords isn't empty, recursively
-                # pattern-match on the _THAT node with thatWords as words.
-                try:
-                    pattern, template = self._match(
-                        thatWords, [], topicWords, root[self._THAT])
-                    if pattern != None:
-                        pattern = [self._THAT] + pattern
-                except KeyError:
-                    pattern = []
-                    template = None
-            elif len(topicWords) > 0:
-                # If thatWords is empty and topicWords isn't, recursively pattern
-                # on the _TOPIC node with topicWords as words.
-                try:
-                    pattern, template = self._match(
-                        topicWords, [], [], root[self._TOPIC])
-                    if pattern != None:
-                        pattern = [self._TOPIC] + pattern
-                except KeyError:
-                    pattern = []
-                    template = None
-            if template == None:
-                # we're totally out of input.  Grab the template at this node.
-                pattern = []
-                try:
-                    template = root[self._TEMPLATE]
-                except KeyError:
-                    template = None
-            return (pattern, template)
+        return self._matchIter((words, thatWords, topicWords), botName)
+
+    # The states of the frames of _matchIter(), in the order the
+    # alternatives are tried.
+    _TRY_UNDERSCORE = 0
+    _NEXT_UNDERSCORE = 1
+    _TRY_WORD = 2
+    _TRY_BOT_NAME = 3
+    _TRY_STAR = 4
+    _NEXT_STAR = 5
+    _FAIL = 6
+
+    def _matchIter(self, segments, botName):
+        """Return the same (pat, tem, spans) tuple as _matchRoot() for
+        the input, 'that' and 'topic' words of segments.
+
+        The search doesn't recurse: the words are never copied, each
+        frame of an explicit stack holds the offset of a word in its
+        segment, and the frames are reused as the search backtracks.  The matched path is built only once a template is
+        found.  A node that failed to match the words from an offset
+        fails again whichever wildcard split leads back to it, so it
+        isn't searched twice.
+
+        No edge is followed to a node whose length bounds (see
+        _computeLengthBounds()) exclude the number of words left, and
+        wildcards only split the words so that they don't.
+
+        Each frame is a list [seg, pos, node, state, end, key, p]: the
+        words of segments[seg] from pos (of end) are being matched from
+        node, state is the next alternative to try, and key is the edge
+        leading to the frame above, which a wildcard took up to word p.
 
-        first = words[0]
-        suffix = words[1:]
+        """
+        UNDERSCORE = self._UNDERSCORE
+        STAR = self._STAR
+        TRY_UNDERSCORE = self._TRY_UNDERSCORE
+        NEXT_UNDERSCORE = self._NEXT_UNDERSCORE
+        TRY_WORD = self._TRY_WORD
+        TRY_BOT_NAME = self._TRY_BOT_NAME
+        TRY_STAR = self._TRY_STAR
+        NEXT_STAR = self._NEXT_STAR
+        FAIL = self._FAIL
+        bounds = self._lengthBounds
+        if bounds is None:
+            bounds = self._lengthBounds = self._computeLengthBounds()
+        failed = set()
+        frames = [[0, 0, self._root, TRY_UNDERSCORE, len(segments[0]),
+                   None, 0]]
+        depth = 0
+        while depth >= 0:
+            frame = frames[depth]
+            seg, pos, node, state, end, key, p = frame
+            checked = False
+            if pos == end:
+                # we're out of words.
+                child = None
+                if state == TRY_UNDERSCORE:
+                    frame[3] = FAIL
+                    if seg == 0 and len(segments[1]) > 0:
+                        key = self._THAT
+                        child = node.get(key)
+                        seg = 1
+                    elif seg < 2 and len(segments[2]) > 0:
+                        key = self._TOPIC
+                        child = node.get(key)
+                        seg = 2
+                if child is None:
+                    # Grab the template at this node.
+                    template = node.get(self._TEMPLATE)
+                    if template is not None:
+                        pattern, spans = self._matchedPath(frames, depth)
+                        return (pattern, template, spans)
+                    failed.add((id(node), pos))
+                    depth -= 1
+                    continue
+                frame[5] = key
+                p = 0
+            elif state == TRY_WORD:
+                frame[3] = TRY_BOT_NAME
+                key = segments[seg][pos]
+                child = node.get(key)
+                if child is None:
+                    continue
+                frame[5] = key
+                p = pos + 1
+            elif state == TRY_BOT_NAME:
+                frame[3] = TRY_STAR
+                key = segments[seg][pos]
+                if key != botName:
+                    continue
+                child = node.get(self._BOT_NAME)
+                if child is None:
+                    continue
+                frame[5] = key
+                p = pos + 1
+            elif state == FAIL:
+                # No matches were found.
+                failed.add((id(node), pos))
+                depth -= 1
+                continue
+            else:
+                # try the next split of the words by a wildcard
+                if state == TRY_UNDERSCORE or state == NEXT_UNDERSCORE:
+                    key, nextState, doneState = (UNDERSCORE, NEXT_UNDERSCORE,
+                                                 TRY_WORD)
+                else:
+                    key, nextState, doneState = STAR, NEXT_STAR, FAIL
+                child = node.get(key)
+                if child is None:
+                    frame[3] = doneState
+                    continue
+                # only split the words so that what's left is within
+                # the length bounds of the child
+                childId = id(child)
+                lo, hi = bounds[childId]
+                if state == nextState:
+                    p += 1
+                else:
+                    p = max(pos + 1, end - hi)
+                last = end - lo
+                while p <= last and (childId, p) in failed:
+                    p += 1
+                if p > last:
+                    frame[3] = doneState
+                    continue
+                frame[3] = nextState
+                frame[5] = key
+                frame[6] = p
+                checked = True
+
+            if not checked:
+                # descend to the child only if the words left are within
+                # its length bounds, and it didn't fail on them already
+                lo, hi = bounds[id(child)]
+                left = len(segments[seg]) - p
+                if left < lo or left > hi or (id(child), p) in failed:
+                    continue
+            depth += 1
+            if depth == len(frames):
+                frames.append([seg, p, child, TRY_UNDERSCORE,
+                               len(segments[seg]), None, 0])
+            else:
+                frame = frames[depth]
+                frame[0] = seg
+                frame[1] = p
+                frame[2] = child
+                frame[3] = TRY_UNDERSCORE
+                frame[4] = len(segments[seg])
+        return (None, None, None)
+
+    def _matchedPath(self, frames, depth):
+        """Return the tuple (pat, spans) of the edges the frames below
+        depth took, as _matchRoot() returns them.
 
-        # Check underscore.
-        # Note: this is causing problems in the standard AIML set, and is
-        # currently disabled.
-        if root.has_key(self._UNDERSCORE):
-            # Must include the case where suf is [] in order to handle the case
-            # where a * or _ is at the end of the pattern.
-            for j in range(len(suffix) + 1):
-                suf = suffix[j:]
-                pattern, template = self._match(
-                    suf, thatWords, topicWords, root[self._UNDERSCORE])
-                if template is not None:
-                    newPattern = [self._UNDERSCORE] + pattern
-                    return (newPattern, template)
-
-        # Check first
-        if root.has_key(first):
-            pattern, template = self._match(
-                suffix, thatWords, topicWords, root[first])
-            if template is not None:
-                newPattern = [first] + pattern
-                return (newPattern, template)
-
-        # check bot name
-        if root.has_key(self._BOT_NAME) and first == self._botName:
-            pattern, template = self._match(
-                suffix, thatWords, topicWords, root[self._BOT_NAME])
-            if template is not None:
-                newPattern = [first] + pattern
-                return (newPattern, template)
-
-        # check star
-        if root.has_key(self._STAR):
-            # Must include the case where suf is [] in order to handle the case
-            # where a * or _ is at the end of the pattern.
-            for j in range(len(suffix) + 1):
-                suf = suffix[j:]
-                pattern, template = self._match(
-                    suf, thatWords, topicWords, root[self._STAR])
-                if template is not None:
-                    newPattern = [self._STAR] + pattern
-                    return (newPattern, template)
-
-        # No matches were found.
-        return (None, None)
+        """
+        pattern = []
+        spans = []
+        for frame in frames[:depth]:
+            key = frame[5]
+            pattern.append(key)
+            if key == self._UNDERSCORE or key == self._STAR:
+                pos = frame[1]
+                spans.append((frame[4] - pos, frame[6] - pos))
+        return (pattern, spans)
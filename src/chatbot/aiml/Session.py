@@ -0,0 +1,276 @@
+"""
+Copyright 2003-2010 Cort Stratton. All rights reserved.
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+"""This file contains the session classes used by the Kernel to hold
+the predicates of a conversation.
+"""
+
+import sys
+
+# The predicates every session has, which a KernelSession keeps in its
+# slots: the names the Kernel uses for them, and their slots.
+_slots = {
+    "_inputHistory": "inputHistory",
+    "_outputHistory": "outputHistory",
+}
+
+
+def internText(text):
+    """Return text as an interned str if it is ASCII, so that the
+    sessions that hold the same predicate names share a single copy of
+    them.  Other text is returned as it is.
+
+    """
+    try:
+        return intern(str(text))
+    except (UnicodeError, TypeError):
+        return text
+
+
+class KernelSession(object):
+    """The predicates of a conversation with a Kernel.
+
+    The input and output histories are kept in slots, and the other
+    predicates in a dictionary that is created when the first of them is
+    set, by their interned names.  A KernelSession reads and writes like
+    a dictionary of all of them.
+
+    """
+
+    __slots__ = ("inputHistory", "outputHistory", "predicates")
+
+    def __init__(self):
+        self.inputHistory = []
+        self.outputHistory = []
+        self.predicates = None
+
+    def __getitem__(self, name):
+        slot = _slots.get(name)
+        if slot is not None:
+            return getattr(self, slot)
+        if self.predicates is None:
+            raise KeyError(name)
+        return self.predicates[name]
+
+    def __setitem__(self, name, value):
+        slot = _slots.get(name)
+        if slot is not None:
+            setattr(self, slot, value)
+            return
+        if self.predicates is None:
+            self.predicates = {}
+        self.predicates[internText(name)] = value
+
+    def __delitem__(self, name):
+        slot = _slots.get(name)
+        if slot is not None:
+            # the histories are emptied rather than deleted
+            setattr(self, slot, [])
+            return
+        if self.predicates is None:
+            raise KeyError(name)
+        del self.predicates[name]
+
+    def __contains__(self, name):
+        return name in _slots or (self.predicates is not None and
+                                  name in self.predicates)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def has_key(self, name):
+        return name in self
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = list(_slots)
+        if self.predicates is not None:
+            keys.extend(self.predicates)
+        return keys
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        """Return a dictionary of the predicates."""
+        session = dict(self.predicates or {})
+        for name, slot in _slots.items():
+            session[name] = getattr(self, slot)
+        return session
+
+    def sizeof(self):
+        """Return the number of bytes the session holds: the record, the
+        containers of its predicates, and the values in them, each
+        counted once.  The predicate names, which are shared by the
+        sessions, aren't counted.
+
+        """
+        seen = set()
+        size = 0
+        objs = [self]
+        while objs:
+            obj = objs.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, KernelSession):
+                objs.extend(getattr(obj, slot) for slot in obj.__slots__)
+            elif isinstance(obj, dict):
+                objs.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                objs.extend(obj)
+        return size
+
+
+class SessionStore(dict):
+    """The sessions of a Kernel, by their ID."""
+
+    def add(self, sessionID):
+        """Return the session with the ID, which is created if it doesn't
+        exist."""
+        try:
+            return self[sessionID]
+        except KeyError:
+            return self.setdefault(sessionID, KernelSession())
+
+    def sizes(self):
+        """Return the number of bytes each session holds, see
+        KernelSession.sizeof(), by session ID.  Query sessions aren't
+        included.
+
+        """
+        return dict((sessionID, session.sizeof())
+                    for sessionID, session in self.items()
+                    if isinstance(session, KernelSession))
+
+
+
+class QuerySession(dict):
+    """A session layered over another session.
+
+    Reads fall through to the underlying session, and writes are kept in
+    the QuerySession itself, so a query can be processed against the
+    predicates of a session without changing or copying them.  Lists
+    (such as the input and output histories), which the Kernel updates
+    in place, are copied into the QuerySession the first time they are
+    read.  Deleted predicates are hidden until the changes are committed.
+
+    """
+
+    def __init__(self, session):
+        dict.__init__(self)
+        self._session = session
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            if key in self._deleted:
+                raise
+            value = self._session[key]
+            if isinstance(value, list):
+                value = list(value)
+                dict.__setitem__(self, key, value)
+            return value
+
+    def __setitem__(self, key, value):
+        self._deleted.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if dict.__contains__(self, key):
+            dict.__delitem__(self, key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (
+            key not in self._deleted and key in self._session)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = dict.keys(self)
+        keys.extend(k for k in self._session if not dict.__contains__(self, k)
+                    and k not in self._deleted)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        """Return a dictionary of the predicates."""
+        session = self._session.copy()
+        for key in self._deleted:
+            session.pop(key, None)
+        session.update(dict.items(self))
+        return session
+
+    def commit(self):
+        """Write the changes kept in the QuerySession through to the
+        underlying session."""
+        for key in self._deleted:
+            if key in self._session:
+                del self._session[key]
+        for key, value in dict.items(self):
+            self._session[key] = value
@@ -0,0 +1,442 @@
+"""
+Copyright 2003-2010 Cort Stratton. All rights reserved.
+Copyright 2015, 2016 Hanson Robotics
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are
+met:
+ 1. Redistributions of source code must retain the above copyright
+    notice, this list of conditions and the following disclaimer.
+ 2. Redistributions in binary form must reproduce the above copyright
+    notice, this list of conditions and the following disclaimer in the
+    documentation and/or other materials provided with the
+    distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY
+EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE FREEBSD PROJECT OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+"""This module compiles AIML templates into trees of closures.
+
+A template is stored as nested [tag, attributes, contents...] lists,
+which Kernel._processElement() interprets every time the template is
+processed.  The TemplateCompiler turns a template into a function of the
+session ID that gives the same response, with the work that doesn't
+depend on the session done once:
+
+ - text is turned into constants, and adjacent constants are joined, as
+   are the contents of <formal>, <lowercase>, <sentence> and <uppercase>
+   elements that are constant,
+ - <random> elements keep only their <li> elements,
+ - the attributes of elements are parsed,
+ - <srai> elements with constant contents are flagged: their function
+   has the input as its 'sraiInput' attribute.
+
+Elements the compiler doesn't handle are left to the interpreter.
+"""
+
+import re
+import string
+import time
+import logging
+
+logger = logging.getLogger('hr.chatbot.aiml.templatecompiler')
+
+
+def _constant(value):
+    return lambda sessionID: value
+
+
+def _join(parts):
+    """Return the concatenation of parts, a list of constants and
+    functions, as a constant if they're all constant or a function
+    otherwise.
+
+    """
+    if len(parts) == 0:
+        return ""
+    if len(parts) == 1:
+        return parts[0]
+    funcs = [part if callable(part) else _constant(part) for part in parts]
+
+    def join(sessionID):
+        return "".join([func(sessionID) for func in funcs])
+    return join
+
+
+def _apply(part, transform):
+    """Return transform applied to the value of part."""
+    if not callable(part):
+        return transform(part)
+    return lambda sessionID: transform(part(sessionID))
+
+
+def _index(elem, default=1):
+    """Return the 'index' attribute of elem, as the star elements parse
+    it.
+
+    """
+    try:
+        return int(elem[1]['index'])
+    except KeyError:
+        return default
+
+
+def _capitalizeSentence(response):
+    """The transformation of <sentence> elements."""
+    try:
+        response = response.strip()
+        words = string.split(response, " ", 1)
+        words[0] = string.capitalize(words[0])
+        return string.join(words)
+    except IndexError:  # response was empty
+        return ""
+
+
+class TemplateCompiler:
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        self._compilers = {
+            "bot":          self._compileBot,
+            "condition":    self._compileCondition,
+            "date":         self._compileDate,
+            "formal":       self._compileFormal,
+            "gender":       self._compileGender,
+            "get":          self._compileGet,
+            "id":           self._compileId,
+            "input":        self._compileInput,
+            "li":           self._compileContents,
+            "lowercase":    self._compileLowercase,
+            "person":       self._compilePerson,
+            "person2":      self._compilePerson2,
+            "random":       self._compileRandom,
+            "text":         self._compileText,
+            "sentence":     self._compileSentence,
+            "set":          self._compileSet,
+            "size":         self._compileSize,
+            "sr":           self._compileSr,
+            "srai":         self._compileSrai,
+            "star":         self._compileStar,
+            "template":     self._compileTemplate,
+            "that":         self._compileThat,
+            "thatstar":     self._compileThatstar,
+            "think":        self._compileThink,
+            "topicstar":    self._compileTopicstar,
+            "uppercase":    self._compileUppercase,
+            "version":      self._compileVersion,
+        }
+
+    def compile(self, elem):
+        """Return a function of the session ID that processes the
+        template elem.
+
+        """
+        part = self._compile(elem)
+        if not callable(part):
+            part = _constant(part)
+        return part
+
+    def _compile(self, elem):
+        """Return the compiled elem: a constant, or a function of the
+        session ID.
+
+        """
+        compiler = self._compilers.get(elem[0])
+        if compiler is not None:
+            try:
+                return compiler(elem)
+            except Exception:
+                # the interpreter reports the errors of the element
+                pass
+        return self._interpret(elem)
+
+    def _interpret(self, elem):
+        processElement = self._kernel._processElement
+        return lambda sessionID: processElement(elem, sessionID)
+
+    def _compileContents(self, elem):
+        """Compile the concatenation of the contents of elem."""
+        parts = []
+        for e in elem[2:]:
+            part = self._compile(e)
+            if (not callable(part) and len(parts) > 0 and
+                    not callable(parts[-1])):
+                parts[-1] += part
+            else:
+                parts.append(part)
+        return _join(parts)
+
+    def _compileWithStar(self, elem):
+        """Compile the contents of elem, or <star/> if it's atomic."""
+        if len(elem[2:]) == 0:
+            return self._compileStar(['star', {}])
+        return self._compileContents(elem)
+
+    # <bot>
+    def _compileBot(self, elem):
+        getBotPredicate = self._kernel.getBotPredicate
+        name = elem[1]['name']
+        return lambda sessionID: getBotPredicate(name)
+
+    # <condition>
+    def _compileCondition(self, elem):
+        getPredicate = self._kernel.getPredicate
+        attr = elem[1]
+        if attr.has_key('name') and attr.has_key('value'):
+            name, value = attr['name'], attr['value']
+            contents = self._compileContents(elem)
+            if not callable(contents):
+                contents = _constant(contents)
+
+            def condition(sessionID):
+                if getPredicate(name, sessionID) == value:
+                    return contents(sessionID)
+                return ""
+            return condition
+
+        name = attr.get('name')
+        listitems = [e for e in elem[2:] if e[0] == 'li']
+        if len(listitems) == 0:
+            return ""
+        # the (name, value, contents) of the <li> elements to test, in
+        # order, as _processCondition() reads them.  Malformed <li>
+        # elements raise here, and are left to the interpreter.
+        tests = []
+        for li in listitems:
+            liAttr = li[1]
+            if len(liAttr.keys()) == 0 and li == listitems[-1]:
+                continue
+            liName = name
+            if liName == None:
+                liName = liAttr['name']
+            tests.append((liName, liAttr['value'], self.compile(li)))
+        default = None
+        liAttr = listitems[-1][1]
+        if not (liAttr.has_key('name') or liAttr.has_key('value')):
+            default = self.compile(listitems[-1])
+
+        def condition(sessionID):
+            for liName, liValue, contents in tests:
+                if liValue == '*' and getPredicate(liName, sessionID):
+                    return contents(sessionID)
+                if getPredicate(liName, sessionID) == liValue:
+                    return contents(sessionID)
+            if default is not None:
+                return default(sessionID)
+            return ""
+        return condition
+
+    # <date>
+    def _compileDate(self, elem):
+        return lambda sessionID: time.asctime()
+
+    # <formal>
+    def _compileFormal(self, elem):
+        return _apply(self._compileContents(elem), string.capwords)
+
+    # <gender>
+    def _compileGender(self, elem):
+        subbers = self._kernel._subbers
+        return _apply(self._interpretable(self._compileContents(elem)),
+                      lambda response: subbers['gender'].sub(response))
+
+    # <get>
+    def _compileGet(self, elem):
+        getPredicate = self._kernel.getPredicate
+        name = elem[1]['name']
+        return lambda sessionID: getPredicate(name, sessionID)
+
+    # <id>
+    def _compileId(self, elem):
+        return lambda sessionID: sessionID
+
+    # <input>
+    def _compileInput(self, elem):
+        kernel = self._kernel
+        try:
+            index = int(elem[1]['index'])
+        except:
+            index = 1
+
+        def getInput(sessionID):
+            inputHistory = kernel.getPredicate(kernel._inputHistory,
+                                               sessionID)
+            try:
+                return inputHistory[-index]
+            except IndexError:
+                if kernel._verboseMode:
+                    err = "No such index %d while processing <input> element.\n" % index
+                    logger.error(err)
+                return ""
+        return getInput
+
+    # <lowercase>
+    def _compileLowercase(self, elem):
+        return _apply(self._compileContents(elem), string.lower)
+
+    # <person>
+    def _compilePerson(self, elem):
+        subbers = self._kernel._subbers
+        return _apply(self._interpretable(self._compileWithStar(elem)),
+                      lambda response: subbers['person'].sub(response))
+
+    # <person2>
+    def _compilePerson2(self, elem):
+        subbers = self._kernel._subbers
+        return _apply(self._interpretable(self._compileWithStar(elem)),
+                      lambda response: subbers['person2'].sub(response))
+
+    # <random>
+    def _compileRandom(self, elem):
+        kernel = self._kernel
+        listitems = [self.compile(e) for e in elem[2:] if e[0] == 'li']
+        if len(listitems) == 0:
+            return ""
+
+        def choose(sessionID):
+            # choose like _processRandom() does, so that both draw the
+            # same random numbers
+            return listitems[kernel._choose(len(listitems))](sessionID)
+        return choose
+
+    # text
+    def _compileText(self, elem):
+        text = elem[2] + ""
+        if elem[1]["xml:space"] == "default":
+            text = re.sub("\s+", " ", text)
+        return text
+
+    # <sentence>
+    def _compileSentence(self, elem):
+        return _apply(self._compileContents(elem), _capitalizeSentence)
+
+    # <set>
+    def _compileSet(self, elem):
+        setPredicate = self._kernel.setPredicate
+        name = elem[1]['name']
+        contents = self._compileContents(elem)
+        if not callable(contents):
+            contents = _constant(contents)
+
+        def setValue(sessionID):
+            value = contents(sessionID)
+            setPredicate(name, value, sessionID)
+            return value
+        return setValue
+
+    # <size>
+    def _compileSize(self, elem):
+        numCategories = self._kernel.numCategories
+        return lambda sessionID: str(numCategories())
+
+    # <sr>
+    def _compileSr(self, elem):
+        kernel = self._kernel
+        return lambda sessionID: kernel._respond(
+            kernel._getStar("star", 1, sessionID), sessionID)
+
+    # <srai>
+    def _compileSrai(self, elem):
+        respond = self._kernel._respond
+        contents = self._compileContents(elem)
+        if callable(contents):
+            return lambda sessionID: respond(contents(sessionID), sessionID)
+
+        def srai(sessionID):
+            return respond(contents, sessionID)
+        srai.sraiInput = contents
+        return srai
+
+    # <star>
+    def _compileStar(self, elem):
+        getStar = self._kernel._getStar
+        index = _index(elem)
+        return lambda sessionID: getStar("star", index, sessionID)
+
+    # <template>
+    def _compileTemplate(self, elem):
+        kernel = self._kernel
+        contents = self._compileContents(elem)
+        if not callable(contents):
+            contents = _constant(contents)
+
+        def template(sessionID):
+            response = contents(sessionID)
+            trace = kernel._request.trace
+            if trace is not None:
+                trace.append(elem)
+            return response
+        if hasattr(contents, 'sraiInput'):
+            template.sraiInput = contents.sraiInput
+        return template
+
+    # <that>
+    def _compileThat(self, elem):
+        kernel = self._kernel
+        index = 1
+        try:
+            index = int(elem[1]['index'].split(',')[0])
+        except:
+            pass
+
+        def getThat(sessionID):
+            outputHistory = kernel.getPredicate(kernel._outputHistory,
+                                                sessionID)
+            try:
+                return outputHistory[-index]
+            except IndexError:
+                if kernel._verboseMode:
+                    err = "No such index %d while processing <that> element.\n" % index
+                    logger.error(err)
+                return ""
+        return getThat
+
+    # <thatstar>
+    def _compileThatstar(self, elem):
+        getStar = self._kernel._getStar
+        index = _index(elem)
+        return lambda sessionID: getStar("thatstar", index, sessionID)
+
+    # <think>
+    def _compileThink(self, elem):
+        contents = self._compileContents(elem)
+        if not callable(contents):
+            return ""
+
+        def think(sessionID):
+            contents(sessionID)
+            return ""
+        return think
+
+    # <topicstar>
+    def _compileTopicstar(self, elem):
+        getStar = self._kernel._getStar
+        index = _index(elem)
+        return lambda sessionID: getStar("topicstar", index, sessionID)
+
+    # <uppercase>
+    def _compileUppercase(self, elem):
+        return _apply(self._compileContents(elem), string.upper)
+
+    # <version>
+    def _compileVersion(self, elem):
+        version = self._kernel.version
+        return lambda sessionID: version()
+
+    def _interpretable(self, part):
+        """Return part as a function, so that a transformation applied to
+        it is done when the template is processed.
+
+        """
+        if not callable(part):
+            part = _constant(part)
+        return part
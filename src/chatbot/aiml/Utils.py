@@ -29,6 +29,9 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 modules in the PyAIML package.
 """
 
+from collections import OrderedDict
+import threading
+
 def sentences(s):
     """Split the string s into a list of sentences."""
     try:
@@ -60,6 +63,127 @@ def sentences(s):
         sentenceList.append(s)
     return sentenceList
 
+class ReadWriteLock:
+    """A lock that can be held by any number of readers, or by a single
+    writer.
+
+    Writers are preferred: once a writer is waiting, new readers wait
+    until it is done, so a steady stream of readers can't starve it.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waitingWriters = 0
+
+    def acquireRead(self):
+        self._cond.acquire()
+        try:
+            while self._writer or self._waitingWriters:
+                self._cond.wait()
+            self._readers += 1
+        finally:
+            self._cond.release()
+
+    def releaseRead(self):
+        self._cond.acquire()
+        try:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def acquireWrite(self):
+        self._cond.acquire()
+        try:
+            self._waitingWriters += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waitingWriters -= 1
+            self._writer = True
+        finally:
+            self._cond.release()
+
+    def releaseWrite(self):
+        self._cond.acquire()
+        try:
+            self._writer = False
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+class Memo(dict):
+    """A dictionary of the results of functions, which counts how many
+    lookups found their result (hits) and how many had to compute it
+    (misses).
+
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, function, *args):
+        """Return the result stored under key, or store and return the
+        result of function(*args).
+
+        """
+        try:
+            value = self[key]
+        except KeyError:
+            self.misses += 1
+            value = self[key] = function(*args)
+        else:
+            self.hits += 1
+        return value
+
+class LRUCache:
+    """A thread-safe dictionary holding at most 'size' items, which drops
+    the least recently used item to make room for a new one.  It counts
+    the lookups that found their key (hits) and those that didn't
+    (misses).
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the item of key, or default."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # move the item to the most recently used end
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """Drop all the items.  The counters are kept."""
+        with self._lock:
+            self._items.clear()
+
 # Self test
 if __name__ == "__main__":
     # sentences
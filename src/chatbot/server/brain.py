@@ -0,0 +1,123 @@
+import os
+import glob
+import hashlib
+import logging
+import threading
+import traceback
+import weakref
+
+logger = logging.getLogger('hr.chatbot.server.brain')
+
+# Bump this whenever the way AIML files are parsed into the brain changes
+# without a change of the kernel version, to invalidate old snapshots.
+SNAPSHOT_FORMAT = 2
+
+
+def resolve_aiml_files(aiml_files):
+    """Expand the wildcards of aiml_files, in the order Kernel.learn
+    learns them"""
+    files = []
+    for f in aiml_files:
+        files.extend(glob.glob(f))
+    return files
+
+
+def aiml_files_digest(kernel, aiml_files):
+    """Return a digest of the AIML files, their contents and the version
+    of the parser"""
+    sha = hashlib.sha1()
+    sha.update('{}\n{}\n'.format(SNAPSHOT_FORMAT, kernel.version()))
+    for f in resolve_aiml_files(aiml_files):
+        with open(f, 'rb') as fh:
+            content = fh.read()
+        sha.update('{}\n{}\n'.format(
+            os.path.realpath(f), hashlib.sha1(content).hexdigest()))
+    return sha.hexdigest()
+
+
+class BrainSnapshotCache(object):
+    """Cache of brain snapshots, keyed on the digest of the AIML files they
+    were learned from.
+
+    The digest covers the file names, their contents and the version of
+    the parser, so a snapshot is only used while all of them are
+    unchanged. Kernels with a "mapped" brain map the snapshot into memory,
+    so all the processes of a host share one copy of it.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def path(self, kernel, key):
+        if kernel.getBrainType() == 'mapped':
+            return os.path.join(self.cache_dir, '{}.mbrn'.format(key))
+        return os.path.join(self.cache_dir, '{}.brn'.format(key))
+
+    def load(self, kernel, key):
+        """Restore the snapshot into kernel. Return True on success."""
+        fname = self.path(kernel, key)
+        if not os.path.isfile(fname):
+            return False
+        try:
+            if kernel.getBrainType() == 'mapped':
+                kernel.mapBrain(fname)
+            else:
+                kernel.loadBrain(fname)
+            logger.info("Loaded brain snapshot {}".format(fname))
+            return True
+        except Exception as ex:
+            logger.error("Loading brain snapshot {} error {}".format(fname, ex))
+            logger.error(traceback.format_exc())
+            return False
+
+    def save(self, kernel, key):
+        fname = self.path(kernel, key)
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            mapped = kernel.getBrainType() == 'mapped'
+            if mapped:
+                kernel.saveMappedBrain(tmp_fname)
+            else:
+                kernel.saveBrain(tmp_fname)
+            # Other processes may be loading the snapshot
+            os.rename(tmp_fname, fname)
+            logger.info("Saved brain snapshot {}".format(fname))
+            if mapped:
+                # Share the snapshot with the processes that map it later
+                kernel.mapBrain(fname)
+        except Exception as ex:
+            logger.error("Saving brain snapshot {} error {}".format(fname, ex))
+            if os.path.isfile(tmp_fname):
+                os.remove(tmp_fname)
+
+
+class BrainRegistry(object):
+    """Registry of the brains of the kernels, keyed on the AIML files they
+    were learned from and the brain type.
+
+    Kernels that learn the same AIML files share one brain. A brain is
+    dropped from the registry once no kernel uses it.
+    """
+
+    def __init__(self):
+        self._brains = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, kernel, digest):
+        """Return the brain registered for the AIML files with digest, or
+        None"""
+        with self._lock:
+            return self._brains.get((kernel.getBrainType(), digest))
+
+    def add(self, kernel, digest):
+        """Register the brain of kernel as learned from the AIML files
+        with digest"""
+        with self._lock:
+            key = (kernel.getBrainType(), digest)
+            if key not in self._brains:
+                self._brains[key] = kernel.shareBrain()
+                logger.info("Registered brain {}".format(key))
+
+brain_registry = BrainRegistry()
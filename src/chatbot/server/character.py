@@ -2,7 +2,10 @@ import os
 from chatbot.aiml import Kernel
 import logging
 import re
-from config import CHARACTER_PATH
+from config import CHARACTER_PATH, AIML_CONCURRENCY, AIML_LEARN_PROCESSES, \
+    AIML_MATCH_CACHE_SIZE, AIML_SRAI_INDEX, BRAIN_CACHE_DIR, SHARE_BRAINS
+from brain import BrainSnapshotCache, aiml_files_digest, brain_registry, \
+    resolve_aiml_files
 from chatbot.utils import shorten, check_online
 from collections import defaultdict
 from pprint import pformat
@@ -39,6 +42,12 @@ class Character(object):
         self.languages = ['en-US']  # List of lanugages it supports
         self.local = True
         self.non_repeat = True
+        # Slow or remote tier, asked in advance while the tiers before it
+        # answer. Its answer is dropped if not used, so it must be stateless.
+        self.prefetch = False
+        # respond() keeps no state in the session, so the tier can be asked
+        # before the cascade reaches it and its answer dropped if not used
+        self.speculative = False
         self.logger = logging.getLogger('hr.chatbot.character.{}'.format(id))
         self.type = TYPE_DEFAULT
         self.stateful = False
@@ -86,15 +95,14 @@ class DefaultCharacter(Character):
     def refresh(self, session):
         session.session_context.reset_context(self.id)
 
-def replace_aiml_abs_path(trace):
-    if isinstance(trace, list):
-        for path in CHARACTER_PATH.split(','):
-            path = path.strip()
-            if not path:
-                continue
-            path = path + '/'
-            trace = [f.replace(path, '') for f in trace]
-    return trace
+CHARACTER_PATHS = [path.strip() + '/' for path in CHARACTER_PATH.split(',')
+                   if path.strip()]
+
+def relative_aiml_path(doc):
+    for path in CHARACTER_PATHS:
+        if doc.startswith(path):
+            return doc[len(path):]
+    return doc
 
 
 class AIMLCharacter(Character):
@@ -103,28 +111,111 @@ class AIMLCharacter(Character):
         super(AIMLCharacter, self).__init__(id, name, level)
         self.kernel = Kernel()
         self.aiml_files = []
+        # modification times of the AIML files, when they were learned
+        self.aiml_mtimes = {}
         self.kernel.verbose(True)
+        self.kernel.setConcurrency(AIML_CONCURRENCY)
+        self.kernel.setLearnProcesses(AIML_LEARN_PROCESSES)
+        self.kernel.setMatchCacheSize(AIML_MATCH_CACHE_SIZE)
+        self.kernel.setSraiIndexing(AIML_SRAI_INDEX)
         self.current_topic = ''
         self.counter = 0
         self.N = 10  # How many times of reponse on the same topic
         self.languages = ['en']
         self.max_chat_tries = 5
-        self.trace_pattern = re.compile(
-            r'.*/(?P<fname>.*), (?P<tloc>\(.*\)), (?P<pname>.*), (?P<ploc>\(.*\))')
         self.response_limit = 512
         self.type = TYPE_AIML
 
     def load_aiml_files(self, kernel, aiml_files):
         errors = []
+        snapshot_cache, digest = None, None
+        if (SHARE_BRAINS or BRAIN_CACHE_DIR) and kernel.numCategories() == 0:
+            # Nothing has been learned yet, so the brain can be shared with
+            # other characters or restored from a snapshot of the same files
+            digest = aiml_files_digest(kernel, aiml_files)
+            loaded = False
+            brain = None
+            if SHARE_BRAINS:
+                brain = brain_registry.get(kernel, digest)
+            if brain is not None:
+                kernel.setBrain(brain)
+                self.logger.info("Share brain of {}".format(aiml_files))
+                loaded = True
+            elif BRAIN_CACHE_DIR:
+                snapshot_cache = BrainSnapshotCache(BRAIN_CACHE_DIR)
+                loaded = snapshot_cache.load(kernel, digest)
+            if loaded:
+                if SHARE_BRAINS:
+                    brain_registry.add(kernel, digest)
+                for f in aiml_files:
+                    if f not in self.aiml_files:
+                        self.aiml_files.append(f)
+                self.record_mtimes(aiml_files)
+                return errors
         for f in aiml_files:
             if '*' not in f and not os.path.isfile(f):
                 self.logger.warn("{} is not found".format(f))
-            errors.extend(kernel.learn(f))
+        # Learn all the files at once so they can be parsed in parallel
+        errors.extend(kernel.learn(aiml_files))
+        for f in aiml_files:
             self.logger.info("Load {}".format(f))
             if f not in self.aiml_files:
                 self.aiml_files.append(f)
+        self.record_mtimes(aiml_files)
+        if digest is not None and not errors:
+            if snapshot_cache is not None:
+                snapshot_cache.save(kernel, digest)
+            if SHARE_BRAINS:
+                brain_registry.add(kernel, digest)
         return errors
 
+    def record_mtimes(self, aiml_files):
+        for f in resolve_aiml_files(aiml_files):
+            try:
+                self.aiml_mtimes[f] = os.path.getmtime(f)
+            except OSError:
+                pass
+
+    def reload_changed_files(self):
+        """Relearn the AIML files changed since they were learned, and
+        unlearn the ones that were removed"""
+        files = resolve_aiml_files(self.aiml_files)
+        changed = []
+        for f in files:
+            try:
+                mtime = os.path.getmtime(f)
+            except OSError:
+                continue
+            if self.aiml_mtimes.get(f) != mtime:
+                changed.append(f)
+        removed = [f for f in self.aiml_mtimes if f not in files]
+        errors = []
+        if not changed and not removed:
+            return [], errors
+        brain, digest = None, None
+        if SHARE_BRAINS:
+            # Another character may have reloaded the same files already,
+            # its brain is shared rather than copied and changed again
+            digest = aiml_files_digest(self.kernel, self.aiml_files)
+            brain = brain_registry.get(self.kernel, digest)
+        if brain is not None:
+            self.kernel.setBrain(brain)
+            self.logger.info("Share brain of {}".format(self.aiml_files))
+        else:
+            if removed:
+                self.kernel.unlearn(removed)
+            if changed:
+                errors.extend(self.kernel.relearn(changed))
+            if digest is not None and not errors:
+                brain_registry.add(self.kernel, digest)
+        for f in removed:
+            del self.aiml_mtimes[f]
+            self.logger.info("Unload {}".format(f))
+        self.record_mtimes(changed)
+        for f in changed:
+            self.logger.info("Reload {}".format(f))
+        return changed + removed, errors
+
     def set_property_file(self, propname):
         try:
             with open(propname) as f:
@@ -167,7 +258,8 @@ class AIMLCharacter(Character):
         self.kernel.setPredicate('topic', '', session)
         self.logger.info("Topic is reset")
 
-    def respond(self, question, lang, session, query, request_id=None):
+    def respond(self, question, lang, session, query, request_id=None,
+                trace=True):
         ret = {}
         ret['text'] = ''
         ret['botid'] = self.id
@@ -181,17 +273,17 @@ class AIMLCharacter(Character):
         elif re.search(r'\[.*\]', question):
             return ret
 
-        chat_tries = 0
-        answer = self.kernel.respond(question, sid, query)
-        answer, res = shorten(answer, self.response_limit)
-
         if self.non_repeat:
-            while chat_tries < self.max_chat_tries:
-                if answer and session.check(question, answer):
-                    break
-                answer = self.kernel.respond(question, sid, query)
+            # Match once, and take the first of the answers the <random>
+            # elements can give that isn't a repeat
+            def accept(answer):
                 answer, res = shorten(answer, self.response_limit)
-                chat_tries += 1
+                return answer and session.check(question, answer)
+            answer = self.kernel.respondCandidates(
+                question, accept, sid, query, trace, self.max_chat_tries + 1)
+        else:
+            answer = self.kernel.respond(question, sid, query, trace)
+        answer, res = shorten(answer, self.response_limit)
         if answer:
             if not session.check(question, answer):
                 ret['repeat'] = answer
@@ -203,14 +295,12 @@ class AIMLCharacter(Character):
         ret['text'] = answer
         ret['emotion'] = self.kernel.getPredicate('emotion', sid)
         ret['performance'] = self.kernel.getPredicate('performance', sid)
-        traces = self.kernel.getTraceDocs()
-        if traces:
-            self.logger.debug("Trace: {}".format(traces))
-            patterns = []
-            for trace in traces:
-                match_obj = self.trace_pattern.match(trace)
-                if match_obj:
-                    patterns.append(match_obj.group('pname'))
+        if trace:
+            records = self.kernel.getTrace()
+        else:
+            records = self.kernel.getMatches()
+        if records:
+            patterns = [record['pattern'] for record in records]
             ret['pattern'] = patterns
             if patterns:
                 first = patterns[0]
@@ -222,10 +312,25 @@ class AIMLCharacter(Character):
                         ret['ok_match'] = True
                 else:
                     ret['exact_match'] = True
-            traces = replace_aiml_abs_path(traces)
-            ret['trace'] = '\n'.join(traces)
+            if trace:
+                ret['trace'] = '\n'.join(
+                    '{}, {}, {}, {}'.format(
+                        relative_aiml_path(record['doc']), record['loc'],
+                        record['pattern'], record['pattern-loc'])
+                    for record in records)
         return ret
 
+    def session_sizes(self):
+        """Returns the number of bytes the kernel holds for each session"""
+        return self.kernel.getSessionSizes()
+
+    def batch_match(self, questions, processes=1):
+        """Match the questions without responding to them. Returns the
+        list of the matches of the sentences of each question, see
+        Kernel.matchMany"""
+        questions = list(questions)
+        return self.kernel.matchMany(questions, processes=processes)
+
     def refresh(self, session):
         sid = session.sid
         self.kernel._deleteSession(sid)
@@ -257,10 +362,7 @@ class AIMLCharacter(Character):
             return False
 
     def get_templates(self):
-        templates = []
-        root = self.kernel._brain._root
-        self.kernel._brain.get_templates(root, templates)
-        return templates
+        return self.kernel._brain.templates()
 
     def print_duplicated_patterns(self):
         patterns = defaultdict(list)
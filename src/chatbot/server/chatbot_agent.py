@@ -5,12 +5,15 @@ import random
 import os
 import re
 import sys
+import time
 reload(sys)
 sys.setdefaultencoding('utf-8')
 import atexit
 from collections import defaultdict
 
-from threading import RLock
+from threading import Lock, RLock
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 sync = RLock()
 
 SUCCESS = 0
@@ -23,8 +26,9 @@ TRANSLATE_ERROR = 5
 logger = logging.getLogger('hr.chatbot.server.chatbot_agent')
 
 from loader import load_characters
+from registry import CharacterRegistry
 from config import CHARACTER_PATH, RESET_SESSION_BY_HELLO, config
-CHARACTERS = load_characters(CHARACTER_PATH)
+REGISTRY = CharacterRegistry(load_characters(CHARACTER_PATH))
 REVISION = os.environ.get('HR_CHATBOT_REVISION')
 
 from session import ChatSessionManager
@@ -39,6 +43,7 @@ from chatbot.server.character import TYPE_AIML, TYPE_CS
 from operator import add, sub, mul, truediv, pow
 import math
 from chatbot.server.template import render
+from chatbot.server.timing import Timer, LatencyHistograms
 
 OPERATOR_MAP = {
     '[add]': add,
@@ -49,22 +54,18 @@ OPERATOR_MAP = {
 }
 
 def get_character(id, lang=None, ns=None):
-    for character in CHARACTERS:
-        if (ns is not None and character.name != ns) or character.id != id:
-            continue
-        if lang is None:
-            return character
-        elif lang in character.languages:
-            return character
+    return REGISTRY.get(id, lang, ns)
 
 
 def add_character(character):
-    if character.id not in [c.id for c in CHARACTERS]:
-        CHARACTERS.append(character)
-        return True, "Character added"
-    # TODO: Update character
-    else:
-        return False, "Character exists"
+    global REGISTRY
+    with sync:
+        if character.id not in REGISTRY:
+            REGISTRY = CharacterRegistry(REGISTRY.characters + [character])
+            return True, "Character added"
+        # TODO: Update character
+        else:
+            return False, "Character exists"
 
 
 def is_local_character(character):
@@ -72,23 +73,7 @@ def is_local_character(character):
 
 
 def get_characters_by_name(name, local=True, lang=None, user=None):
-    characters = []
-    _characters = [c for c in CHARACTERS if c.name == name]
-    if local:
-        _characters = [c for c in _characters if is_local_character(c)]
-    if lang is not None:
-        _characters = [c for c in _characters if lang in c.languages]
-
-    if user is not None:
-        for c in _characters:
-            toks = c.id.split('/')
-            if len(toks) == 2:
-                if toks[0] == user:
-                    characters.append(c)
-            else:
-                characters.append(c)
-    else:
-        characters = _characters
+    characters = list(REGISTRY.by_name(name, local, lang, user))
     if not characters:
         logger.warn('No character is satisfied')
     return characters
@@ -104,7 +89,7 @@ def list_character(lang, sid):
 
 
 def list_character_names():
-    names = list(set([c.name for c in CHARACTERS if c.name != 'dummy']))
+    names = list(set([c.name for c in REGISTRY.characters if c.name != 'dummy']))
     return names
 
 
@@ -154,7 +139,7 @@ def set_context(prop, sid):
     sess = session_manager.get_session(sid)
     if sess is None:
         return False, "No session"
-    for c in CHARACTERS:
+    for c in REGISTRY.characters:
         try:
             c.set_context(sess, prop)
         except Exception:
@@ -165,9 +150,7 @@ def remove_context(keys, sid):
     sess = session_manager.get_session(sid)
     if sess is None:
         return False, "No session"
-    for c in CHARACTERS:
-        if c.type != TYPE_AIML and c.type != TYPE_CS:
-            continue
+    for c in REGISTRY.by_type(TYPE_AIML) + REGISTRY.by_type(TYPE_CS):
         try:
             for key in keys:
                 c.remove_context(sess, key)
@@ -214,20 +197,143 @@ def update_config(**kwargs):
     else:
         return False, "No configuration is updated"
 
-def preprocessing(question, lang, session):
+def preprocessing(question):
     question = question.lower().strip()
     question = ' '.join(question.split())  # remove consecutive spaces
     question = question.replace('sofia', 'sophia')
-
-    reduction = get_character('reduction')
-    if reduction is not None:
-        response = reduction.respond(question, lang, session, query=True, request_id=request_id)
-        reducted_text = response.get('text')
-        if reducted_text:
-            question = reducted_text
-
     return question
 
+def respond_character(character, question, lang, sess, query, request_id,
+                      trace=True):
+    """Ask the character. AIML characters skip tracing the templates
+    they process, unless trace is True."""
+    if character.type == TYPE_AIML:
+        return character.respond(
+            question, lang, sess, query, request_id, trace=trace)
+    return character.respond(question, lang, sess, query, request_id)
+
+TIER_POOL = None
+TIER_LATENCY = {}  # Moving average of the seconds each tier takes
+TIER_CUTS = defaultdict(int)  # Times each tier is cut by the time budget
+# Times each tier is cut while waiting in the queue of the thread pool
+TIER_QUEUE_CUTS = defaultdict(int)
+tier_stats_lock = Lock()
+TIER_HISTOGRAMS = LatencyHistograms()  # Seconds each tier takes to respond
+STAGE_HISTOGRAMS = LatencyHistograms()  # Seconds each stage of ask takes
+clock = time.time  # The clock the time budgets of the requests are kept by
+
+def get_tier_pool():
+    global TIER_POOL
+    with sync:
+        if TIER_POOL is None:
+            TIER_POOL = ThreadPool(config['TIER_THREADS'])
+        return TIER_POOL
+
+def timed_respond(character, *args):
+    """Ask the character like respond_character, and update the average
+    time it takes"""
+    start = clock()
+    try:
+        return respond_character(character, *args)
+    except Exception as ex:
+        logger.error("Character {} error {}".format(character.id, ex))
+        logger.error(traceback.format_exc())
+        return {'text': '', 'trace': 'Error {}'.format(ex)}
+    finally:
+        elapsed = clock() - start
+        TIER_HISTOGRAMS.add(character.id, elapsed)
+        with tier_stats_lock:
+            average = TIER_LATENCY.get(character.id)
+            if average is None:
+                TIER_LATENCY[character.id] = elapsed
+            else:
+                TIER_LATENCY[character.id] = 0.8*average + 0.2*elapsed
+
+def tier_budget():
+    """Report the average seconds each tier takes and the times it was cut
+    by the time budget of the requests"""
+    with tier_stats_lock:
+        return {
+            'latency': dict(TIER_LATENCY),
+            'cuts': dict(TIER_CUTS),
+            'queue_cuts': dict(TIER_QUEUE_CUTS),
+        }
+
+def timing():
+    """Report the latency histograms of the stages of ask and of the
+    tiers"""
+    return {
+        'stages': STAGE_HISTOGRAMS.report(),
+        'tiers': TIER_HISTOGRAMS.report(),
+    }
+
+def record_timing(response, timer, trace):
+    """Add the seconds the stages of the request took to the latency
+    histograms, and to the response if it is traced"""
+    report = timer.report()
+    STAGE_HISTOGRAMS.add('total', report['total'])
+    for stage, tier, offset, seconds in timer.stages:
+        STAGE_HISTOGRAMS.add(stage, seconds)
+    if trace:
+        response['timing'] = report
+
+class TierCall(object):
+    """A tier asked on the tier thread pool. The tier is not asked at all
+    if the call is still queued when the deadline passes."""
+
+    def __init__(self, character, args, deadline=None):
+        self.character = character
+        self.deadline = deadline
+        self.started = False
+        self.result = get_tier_pool().apply_async(self._respond, args)
+
+    def _respond(self, *args):
+        if self.deadline is not None and clock() > self.deadline:
+            return
+        self.started = True
+        return timed_respond(self.character, *args)
+
+    def wait(self, deadline=None):
+        """Wait for the response until the deadline, if any. Return None if
+        it doesn't come in time."""
+        if deadline is not None:
+            deadline = max(0, deadline - clock())
+        try:
+            return self.result.get(deadline)
+        except TimeoutError:
+            logger.warn("Character {} timed out".format(self.character.id))
+
+def out_of_time(character, deadline):
+    """Whether the tier usually takes longer than the time left before the
+    deadline"""
+    if deadline is None:
+        return False
+    with tier_stats_lock:
+        latency = TIER_LATENCY.get(character.id, 0)
+    return clock() + latency > deadline
+
+def ask_in_time(character, deadline, question, lang, sess, query, *args):
+    """Ask the character, within the deadline if any. Return its response,
+    or None if it is cut, and the call on the thread pool if any.
+
+    A tier that usually takes longer than the time left is not asked. Only
+    speculative tiers and queries are cut while they answer: they run on
+    the tier thread pool, and their answers are dropped if they come late.
+    The other tiers change the session when they answer, so they answer
+    even if it takes them past the deadline."""
+    args = (question, lang, sess, query) + args
+    if out_of_time(character, deadline):
+        return None, None
+    if deadline is None or not (character.speculative or query):
+        return timed_respond(character, *args), None
+    call = TierCall(character, args, deadline)
+    return call.wait(deadline), call
+
+def fan_out(characters, deadline, *args):
+    """Start asking the characters concurrently. Return the calls by
+    character id."""
+    return dict((c.id, TierCall(c, args, deadline)) for c in characters)
+
 def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs):
     sess = session_manager.get_session(sid)
     if sess is None:
@@ -237,106 +343,169 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
     data = sess.session_context
     user = getattr(data, 'user')
     botname = getattr(data, 'botname')
+    trace = kwargs.get('trace', True)
+    deadline = kwargs.get('deadline')
+    timer = kwargs.get('timer') or Timer()
     weights = get_weights(characters, sess)
     weighted_characters = zip(characters, weights)
     weighted_characters = [wc for wc in weighted_characters if wc[1]>0]
     logger.info("Weights {}".format(weights))
 
-    _question = preprocessing(question, lang, sess)
     response = {}
     hit_character = None
     answer = None
     cross_trace = []
+    cut_tiers = []
+    queue_cut_tiers = []
     cached_responses = defaultdict(list)
 
+    def _cut(character, stage, call):
+        if call is None:
+            # The tier usually takes longer than the time left
+            cross_trace.append((character.id, stage, 'Out of time'))
+        elif not call.started:
+            # The tier didn't get a thread in time, it isn't slow
+            cross_trace.append((character.id, stage, 'Queued out of time'))
+            queue_cut_tiers.append(character.id)
+        else:
+            cross_trace.append((character.id, stage, 'Timeout'))
+        cut_tiers.append(character.id)
+
+    start = time.time()
+    _question = preprocessing(question)
+    reduction = get_character('reduction')
+    if reduction is not None:
+        _response, call = ask_in_time(reduction, deadline,
+            _question, lang, sess, True, request_id, False)
+        if _response is None:
+            _cut(reduction, 'reduction', call)
+        elif _response.get('text'):
+            _question = _response.get('text')
+    timer.record('preprocessing', start)
+
+    # Start asking the slow tiers in advance. Their responses are used if
+    # the stages below reach them, so only speculative tiers can be asked.
+    calls = {}
+    prefetch_question = _question
+    prefetch = [c for c, weight in weighted_characters
+                if c.prefetch and c.speculative]
+    prefetch = prefetch[:config['TIER_REQUEST_THREADS']]
+    if prefetch:
+        calls = fan_out(prefetch, deadline,
+            _question, lang, sess, query, request_id, trace)
+
+    start = time.time()
     control = get_character('control')
     if control is not None:
-        _response = control.respond(_question, lang, sess, query, request_id)
-        _answer = _response.get('text')
-        if _answer == '[tell me more]':
-            cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
-            if sess.last_used_character:
-                if sess.cache.that_question is None:
-                    sess.cache.that_question = sess.cache.last_question
-                context = sess.last_used_character.get_context(sess)
-                if 'continue' in context and context.get('continue'):
-                    _answer, res = shorten(context.get('continue'), 140)
-                    response['text'] = answer = _answer
-                    response['botid'] = sess.last_used_character.id
-                    response['botname'] = sess.last_used_character.name
-                    sess.last_used_character.set_context(sess, {'continue': res})
-                    hit_character = sess.last_used_character
-                    cross_trace.append((sess.last_used_character.id, 'continuation', 'Non-empty'))
-                else:
-                    _question = sess.cache.that_question.lower().strip()
-                    cross_trace.append((sess.last_used_character.id, 'continuation', 'Empty'))
-        elif _answer.startswith('[weather]'):
-            template = _answer.replace('[weather]', '')
-            cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
-            context = control.get_context(sess)
-            if context:
-                location = context.get('querylocation')
-                prop = parse_weather(get_weather(location))
-                if prop:
-                    try:
-                        _answer = template.format(location=location, **prop)
-                        if _answer:
-                            answer = _answer
-                            response['text'] = _answer
-                            response['botid'] = control.id
-                            response['botname'] = control.name
-                    except Exception as ex:
+        _response, call = ask_in_time(control, deadline,
+            _question, lang, sess, query, request_id, trace)
+        if _response is None:
+            _cut(control, 'control', call)
+        else:
+            _answer = _response.get('text')
+            if _answer == '[tell me more]':
+                cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
+                if sess.last_used_character:
+                    if sess.cache.that_question is None:
+                        sess.cache.that_question = sess.cache.last_question
+                    context = sess.last_used_character.get_context(sess)
+                    if 'continue' in context and context.get('continue'):
+                        _answer, res = shorten(context.get('continue'), 140)
+                        response['text'] = answer = _answer
+                        response['botid'] = sess.last_used_character.id
+                        response['botname'] = sess.last_used_character.name
+                        sess.last_used_character.set_context(sess, {'continue': res})
+                        hit_character = sess.last_used_character
+                        cross_trace.append((sess.last_used_character.id, 'continuation', 'Non-empty'))
+                    else:
+                        _question = sess.cache.that_question.lower().strip()
+                        cross_trace.append((sess.last_used_character.id, 'continuation', 'Empty'))
+            elif _answer.startswith('[weather]'):
+                template = _answer.replace('[weather]', '')
+                cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
+                context = control.get_context(sess)
+                if context:
+                    location = context.get('querylocation')
+                    prop = parse_weather(get_weather(location))
+                    if prop:
+                        try:
+                            _answer = template.format(location=location, **prop)
+                            if _answer:
+                                answer = _answer
+                                response['text'] = _answer
+                                response['botid'] = control.id
+                                response['botname'] = control.name
+                        except Exception as ex:
+                            cross_trace.append((control.id, 'control', 'No answer'))
+                            logger.error(ex)
+                            logger.error(traceback.format_exc())
+                    else:
                         cross_trace.append((control.id, 'control', 'No answer'))
-                        logger.error(ex)
-                        logger.error(traceback.format_exc())
+            elif _answer in OPERATOR_MAP.keys():
+                opt = OPERATOR_MAP[_answer]
+                cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
+                context = control.get_context(sess)
+                if context:
+                    item1 = context.get('item1')
+                    item2 = context.get('item2')
+                    item1 = words2num(item1)
+                    item2 = words2num(item2)
+                    if item1 is not None and item2 is not None:
+                        try:
+                            result = opt(item1, item2)
+                            img = math.modf(result)[0]
+                            if img < 1e-6:
+                                result_str = '{:d}'.format(int(result))
+                            else:
+                                result_str = 'about {:.4f}'.format(result)
+                            if result > 1e20:
+                                answer = "The number is too big. You should use a calculator."
+                            else:
+                                answer = "The answer is {result}".format(result=result_str)
+                        except ZeroDivisionError:
+                            answer = "Oh, the answer is not a number"
+                        except Exception as ex:
+                            logger.error(ex)
+                            logger.error(traceback.format_exc())
+                            answer = "Sorry, something goes wrong. I can't calculate it."
+                        response['text'] = answer
+                        response['botid'] = control.id
+                        response['botname'] = control.name
+                    else:
+                        cross_trace.append((control.id, 'control', 'No answer'))
+            else:
+                if _answer and not re.findall(r'\[.*\].*', _answer):
+                    cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
+                    hit_character = control
+                    answer = _answer
+                    response = _response
                 else:
                     cross_trace.append((control.id, 'control', 'No answer'))
-        elif _answer in OPERATOR_MAP.keys():
-            opt = OPERATOR_MAP[_answer]
-            cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
-            context = control.get_context(sess)
-            if context:
-                item1 = context.get('item1')
-                item2 = context.get('item2')
-                item1 = words2num(item1)
-                item2 = words2num(item2)
-                if item1 is not None and item2 is not None:
+                for c in characters:
                     try:
-                        result = opt(item1, item2)
-                        img = math.modf(result)[0]
-                        if img < 1e-6:
-                            result_str = '{:d}'.format(int(result))
-                        else:
-                            result_str = 'about {:.4f}'.format(result)
-                        if result > 1e20:
-                            answer = "The number is too big. You should use a calculator."
-                        else:
-                            answer = "The answer is {result}".format(result=result_str)
-                    except ZeroDivisionError:
-                        answer = "Oh, the answer is not a number"
-                    except Exception as ex:
-                        logger.error(ex)
-                        logger.error(traceback.format_exc())
-                        answer = "Sorry, something goes wrong. I can't calculate it."
-                    response['text'] = answer
-                    response['botid'] = control.id
-                    response['botname'] = control.name
-                else:
-                    cross_trace.append((control.id, 'control', 'No answer'))
-        else:
-            if _answer and not re.findall(r'\[.*\].*', _answer):
-                cross_trace.append((control.id, 'control', _response.get('trace') or 'No trace'))
-                hit_character = control
-                answer = _answer
-                response = _response
-            else:
-                cross_trace.append((control.id, 'control', 'No answer'))
-            for c in characters:
-                try:
-                    c.remove_context(sess, 'continue')
-                except NotImplementedError:
-                    pass
-            sess.cache.that_question = None
+                        c.remove_context(sess, 'continue')
+                    except NotImplementedError:
+                        pass
+                sess.cache.that_question = None
+        timer.record('control', start, control.id)
+
+    if _question != prefetch_question:
+        # The tiers asked in advance answered another question
+        calls = {}
+
+    # Ask the speculative tiers of the stages below all at once. The stages
+    # then wait for their responses in the same order as they would ask
+    # them. The other tiers keep state in their sessions, so they are only
+    # asked when the stages reach them.
+    if not answer and config['TIER_FAN_OUT']:
+        tiers = [c for c, weight in weighted_characters]
+        if sess.open_character in characters and \
+                sess.open_character not in tiers:
+            tiers.append(sess.open_character)
+        tiers = [c for c in tiers if c.speculative and c.id not in calls]
+        tiers = tiers[:max(0, config['TIER_REQUEST_THREADS'] - len(calls))]
+        calls.update(fan_out(tiers, deadline,
+            _question, lang, sess, query, request_id, trace))
 
     def _ask_character(stage, character, weight, good_match=False, reuse=False):
         logger.info("Asking character {} \"{}\" in stage {}".format(
@@ -360,9 +529,19 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
                 character.id, stage))
             return False, None, None
 
-        response = character.respond(_question, lang, sess, query, request_id)
+        start = time.time()
+        args = (_question, lang, sess, query, request_id, trace)
+        call = calls.get(character.id)
+        if call is not None:
+            response = call.wait(deadline)
+        else:
+            response, call = ask_in_time(character, deadline, *args)
+        timer.record(stage, start, character.id)
+        if response is None:
+            _cut(character, stage, call)
+            return False, None, None
         answer = str_cleanup(response.get('text', ''))
-        trace = response.get('trace')
+        tier_trace = response.get('trace')
 
         if answer:
             if 'pickup' in character.id:
@@ -373,7 +552,7 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
                     logger.info("{} has good match".format(character.id))
                     if response.get('gambit'):
                         if random.random() > 0.5:
-                            cross_trace.append((character.id, stage, 'Ignore gambit answer. Answer: {}, Trace: {}'.format(answer, trace)))
+                            cross_trace.append((character.id, stage, 'Ignore gambit answer. Answer: {}, Trace: {}'.format(answer, tier_trace)))
                             cached_responses['gambit'].append((response, answer, character))
                         else:
                             answered = True
@@ -382,22 +561,22 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
                 else:
                     if not response.get('bad'):
                         logger.info("{} has no good match".format(character.id))
-                        cross_trace.append((character.id, stage, 'No good match. Answer: {}, Trace: {}'.format(answer, trace)))
+                        cross_trace.append((character.id, stage, 'No good match. Answer: {}, Trace: {}'.format(answer, tier_trace)))
                         cached_responses['nogoodmatch'].append((response, answer, character))
             elif response.get('bad'):
-                cross_trace.append((character.id, stage, 'Bad answer. Answer: {}, Trace: {}'.format(answer, trace)))
+                cross_trace.append((character.id, stage, 'Bad answer. Answer: {}, Trace: {}'.format(answer, tier_trace)))
                 cached_responses['bad'].append((response, answer, character))
             elif DISABLE_QUIBBLE and response.get('quibble'):
-                cross_trace.append((character.id, stage, 'Quibble answer. Answer: {}, Trace: {}'.format(answer, trace)))
+                cross_trace.append((character.id, stage, 'Quibble answer. Answer: {}, Trace: {}'.format(answer, tier_trace)))
                 cached_responses['quibble'].append((response, answer, character))
             else:
                 answered = True
             if answered:
                 if random.random() < weight:
-                    cross_trace.append((character.id, stage, 'Trace: {}'.format(trace)))
+                    cross_trace.append((character.id, stage, 'Trace: {}'.format(tier_trace)))
                 else:
                     answered = False
-                    cross_trace.append((character.id, stage, 'Pass through. Answer: {}, Weight: {}, Trace: {}'.format(answer, weight, trace)))
+                    cross_trace.append((character.id, stage, 'Pass through. Answer: {}, Weight: {}, Trace: {}'.format(answer, weight, tier_trace)))
                     logger.info("{} has no answer".format(character.id))
                     if 'markov' not in character.id:
                         cached_responses['pass'].append((response, answer, character))
@@ -406,11 +585,11 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
         else:
             if response.get('repeat'):
                 answer = response.get('repeat')
-                cross_trace.append((character.id, stage, 'Repetitive answer. Answer: {}, Trace: {}'.format(answer, trace)))
+                cross_trace.append((character.id, stage, 'Repetitive answer. Answer: {}, Trace: {}'.format(answer, tier_trace)))
                 cached_responses['repeat'].append((response, answer, character))
             else:
                 logger.info("{} has no answer".format(character.id))
-                cross_trace.append((character.id, stage, 'No answer. Trace: {}'.format(trace)))
+                cross_trace.append((character.id, stage, 'No answer. Trace: {}'.format(tier_trace)))
         return answered, answer, response
 
     # If the last input is a question, then try to use the same tier to
@@ -484,6 +663,7 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
 
     if answer and re.match('.*{.*}.*', answer):
         logger.info("Template answer {}".format(answer))
+        start = time.time()
         try:
             response['orig_text'] = answer
             answer = render(answer)
@@ -492,15 +672,18 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
             answer = ''
             response['text'] = ''
             logger.error("Error in rendering template, {}".format(ex))
+        timer.record('render', start)
 
     dummy_character = get_character('dummy', lang)
     if not answer and dummy_character:
+        start = time.time()
         if response.get('repeat'):
             response = dummy_character.respond("REPEAT_ANSWER", lang, sid, query)
         else:
             response = dummy_character.respond("NO_ANSWER", lang, sid, query)
         hit_character = dummy_character
         answer = str_cleanup(response.get('text', ''))
+        timer.record('dummy', start, dummy_character.id)
 
     if not query and hit_character is not None:
         response['AnsweredBy'] = hit_character.id
@@ -514,8 +697,18 @@ def _ask_characters(characters, question, lang, sid, query, request_id, **kwargs
         else:
             sess.open_character = None
 
+    if cut_tiers:
+        logger.warn("Tiers cut by the time budget {}".format(cut_tiers))
+        with tier_stats_lock:
+            for id in cut_tiers:
+                if id in queue_cut_tiers:
+                    TIER_QUEUE_CUTS[id] += 1
+                else:
+                    TIER_CUTS[id] += 1
+
     response['ModQuestion'] = _question
     response['trace'] = cross_trace
+    response['CutTiers'] = cut_tiers
     return response
 
 def is_question(question):
@@ -534,23 +727,13 @@ def get_responding_characters(lang, sid):
     user = sess.session_context.user
 
     # current character > local character with the same name > solr > generic
-    responding_characters = get_characters_by_name(
-        botname, local=False, lang=lang, user=user)
-    responding_characters = sorted(responding_characters, key=lambda x: x.level)
-
-    generic = get_character('generic', lang)
+    responding_characters, generic = REGISTRY.responding(botname, lang, user)
     if generic:
-        if generic not in responding_characters:
-            # get shared properties
-            character = get_character(botname)
-            generic.set_properties(character.get_properties())
-            responding_characters.append(generic)
-    else:
-        logger.info("Generic character is not found")
+        # get shared properties
+        character = get_character(botname)
+        generic.set_properties(character.get_properties())
 
-    responding_characters = sorted(responding_characters, key=lambda x: x.level)
-
-    return responding_characters
+    return list(responding_characters)
 
 
 def rate_answer(sid, idx, rate):
@@ -570,9 +753,15 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
     """
     return (response dict, return code)
     """
+    kwargs['timer'] = timer = Timer()
     response = {'text': '', 'emotion': '', 'botid': '', 'botname': ''}
     response['lang'] = lang
 
+    # The time the request has to answer, in seconds
+    timeout = kwargs.get('timeout') or config['REQUEST_TIMEOUT']
+    if timeout:
+        kwargs['deadline'] = clock() + timeout
+
     sess = session_manager.get_session(sid)
     if sess is None:
         return response, INVALID_SESSION
@@ -595,12 +784,14 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
         fallback_mode = True
         logger.warn("Use %s medium language, in fallback mode", FALLBACK_LANG)
         responding_characters = get_responding_characters(FALLBACK_LANG, sid)
+        start = time.time()
         try:
             input_translated, question = do_translate(question, FALLBACK_LANG)
         except Exception as ex:
             logger.error(ex)
             logger.error(traceback.format_exc())
             return response, TRANSLATE_ERROR
+        timer.record('translate input', start)
 
     if not responding_characters:
         logger.error("Wrong characer name")
@@ -662,6 +853,7 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
         response.update(_response)
         response['OriginalAnswer'] = response.get('text')
         if fallback_mode:
+            start = time.time()
             try:
                 answer = response.get('text')
                 output_translated, answer = do_translate(answer, lang)
@@ -670,7 +862,9 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
                 logger.error(ex)
                 logger.error(traceback.format_exc())
                 return response, TRANSLATE_ERROR
+            timer.record('translate output', start)
 
+        start = time.time()
         sess.add(
             response['OriginalQuestion'],
             response.get('text'),
@@ -690,12 +884,18 @@ def ask(question, lang, sid, query=False, request_id=None, **kwargs):
             OriginalAnswer=response['OriginalAnswer'],
             RunID=kwargs.get('run_id'),
             Topic=response.get('topic'),
+            CutTiers=response.get('CutTiers'),
         )
+        timer.record('session add', start)
+        record_timing(response, timer, kwargs.get('trace', True))
 
         logger.info("Ask {}, response {}".format(response['OriginalQuestion'], response))
         return response, SUCCESS
     else:
         logger.error("No pattern match")
+        if _response is not None:
+            response['CutTiers'] = _response.get('CutTiers')
+        record_timing(response, timer, kwargs.get('trace', True))
         return response, NO_PATTERN_MATCH
 
 def said(sid, text):
@@ -717,14 +917,11 @@ def dump_session(sid):
 
 
 def reload_characters(**kwargs):
-    global CHARACTERS, REVISION
+    global REGISTRY, REVISION
     with sync:
-        characters = None
         logger.info("Reloading")
         try:
-            characters = load_characters(CHARACTER_PATH)
-            del CHARACTERS[:]
-            CHARACTERS = characters
+            REGISTRY = CharacterRegistry(load_characters(CHARACTER_PATH))
             revision = kwargs.get('revision')
             if revision:
                 REVISION = revision
@@ -732,6 +929,34 @@ def reload_characters(**kwargs):
         except Exception as ex:
             logger.error("Reloading characters error {}".format(ex))
 
+def reload_aiml_files(**kwargs):
+    """Reload only the AIML files that changed, of every AIML character"""
+    reloaded = {}
+    with sync:
+        for c in REGISTRY.by_type(TYPE_AIML):
+            try:
+                files, errors = c.reload_changed_files()
+                if errors:
+                    logger.error("Reloading {} error {}".format(c.id, errors))
+                if files:
+                    reloaded[c.id] = files
+            except Exception as ex:
+                logger.error("Reloading {} error {}".format(c.id, ex))
+                logger.error(traceback.format_exc())
+    return reloaded
+
+def session_memory():
+    """Report the memory the sessions take in each AIML character"""
+    report = {}
+    for c in REGISTRY.by_type(TYPE_AIML):
+        sizes = c.session_sizes().values()
+        report[c.id] = {
+            'sessions': len(sizes),
+            'bytes': sum(sizes),
+            'bytes_per_session': sum(sizes)/len(sizes) if sizes else 0,
+        }
+    return report
+
 def rebuild_cs_character(**kwargs):
     with sync:
         try:
@@ -11,11 +11,37 @@ CHATBOT_LOG_DIR = os.environ.get('CHATBOT_LOG_DIR') or os.path.expanduser('~/.hr
 SERVER_LOG_DIR = os.environ.get('SERVER_LOG_DIR') or os.path.expanduser('~/.hr/log/chatbot')
 HISTORY_DIR = os.path.join(CHATBOT_LOG_DIR, 'history')
 TEST_HISTORY_DIR = os.path.join(CHATBOT_LOG_DIR, 'test/history')
+BRAIN_CACHE_DIR = os.environ.get(
+    'HR_CHATBOT_BRAIN_CACHE_DIR', os.path.join(CHATBOT_LOG_DIR, 'brain_cache'))
+# Share one brain between the AIML characters learning the same files
+SHARE_BRAINS = os.environ.get('HR_CHATBOT_SHARE_BRAINS', '1') == '1'
 CS_HOST = os.environ.get('CS_HOST') or 'localhost'
 CS_PORT = os.environ.get('CS_PORT') or '1024'
 CS_BOT = os.environ.get('CS_BOT') or 'rose'
 
 HR_CHATBOT_AUTHKEY = os.environ.get('HR_CHATBOT_AUTHKEY', 'AAAAB3NzaC')
+# "session" lets an AIML character answer different sessions concurrently,
+# "global" processes one request at a time
+AIML_CONCURRENCY = os.environ.get('HR_CHATBOT_AIML_CONCURRENCY', 'session')
+# Number of match results each AIML brain keeps, 0 disables the cache
+AIML_MATCH_CACHE_SIZE = int(os.environ.get(
+    'HR_CHATBOT_AIML_MATCH_CACHE_SIZE', 10000))
+# Index the chains of <srai> reductions of the AIML brains
+AIML_SRAI_INDEX = os.environ.get('HR_CHATBOT_AIML_SRAI_INDEX', '1') == '1'
+# Number of processes parsing the AIML files of a character. The processes
+# are only forked before the server starts its threads
+AIML_LEARN_PROCESSES = int(os.environ.get(
+    'HR_CHATBOT_AIML_LEARN_PROCESSES', 1))
+# Ask the speculative tiers of a request concurrently instead of one
+# after another
+TIER_FAN_OUT = os.environ.get('HR_CHATBOT_TIER_FAN_OUT', '0') == '1'
+# Seconds a request has to answer, 0 for no limit
+REQUEST_TIMEOUT = float(os.environ.get('HR_CHATBOT_REQUEST_TIMEOUT', 0))
+# Number of threads asking the tiers
+TIER_THREADS = int(os.environ.get('HR_CHATBOT_TIER_THREADS', 16))
+# Number of tiers one request may ask concurrently
+TIER_REQUEST_THREADS = int(os.environ.get(
+    'HR_CHATBOT_TIER_REQUEST_THREADS', 4))
 
 config = {}
 config['DEFAULT_CHARACTER_PATH'] = DEFAULT_CHARACTER_PATH
@@ -25,7 +51,17 @@ config['SESSION_REMOVE_TIMEOUT'] = SESSION_REMOVE_TIMEOUT
 config['CHATBOT_LOG_DIR'] = CHATBOT_LOG_DIR
 config['SERVER_LOG_DIR'] = SERVER_LOG_DIR
 config['HISTORY_DIR'] = HISTORY_DIR
+config['BRAIN_CACHE_DIR'] = BRAIN_CACHE_DIR
+config['SHARE_BRAINS'] = SHARE_BRAINS
 config['CS_HOST'] = CS_HOST
 config['CS_PORT'] = CS_PORT
 config['CS_BOT'] = CS_BOT
 config['HR_CHATBOT_AUTHKEY'] = HR_CHATBOT_AUTHKEY
+config['AIML_CONCURRENCY'] = AIML_CONCURRENCY
+config['AIML_LEARN_PROCESSES'] = AIML_LEARN_PROCESSES
+config['AIML_MATCH_CACHE_SIZE'] = AIML_MATCH_CACHE_SIZE
+config['AIML_SRAI_INDEX'] = AIML_SRAI_INDEX
+config['TIER_FAN_OUT'] = TIER_FAN_OUT
+config['TIER_THREADS'] = TIER_THREADS
+config['TIER_REQUEST_THREADS'] = TIER_REQUEST_THREADS
+config['REQUEST_TIMEOUT'] = REQUEST_TIMEOUT
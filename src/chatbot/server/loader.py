@@ -159,6 +159,8 @@ class AIMLCharacterLoader(object):
                         character.set_property_file(abs_path(spec['property_file']))
                     if 'level' in spec:
                         character.level = int(spec['level'])
+                    if 'brain_type' in spec:
+                        character.kernel.setBrainType(spec['brain_type'])
                     if 'aiml' in spec:
                         aiml_files = [abs_path(f) for f in spec['aiml']]
                         errors = character.load_aiml_files(
@@ -0,0 +1,82 @@
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger('hr.chatbot.server.registry')
+
+
+class CharacterRegistry(object):
+    """Index of the characters by id, name and type.
+
+    A registry is not changed once it is built. Reloading or adding
+    characters builds a new registry, so the lookups can be cached.
+    """
+
+    def __init__(self, characters):
+        self.characters = list(characters)
+        self._ids = defaultdict(list)
+        self._names = defaultdict(list)
+        self._types = defaultdict(list)
+        for c in self.characters:
+            self._ids[c.id].append(c)
+            self._names[c.name].append(c)
+            self._types[c.type].append(c)
+        self._by_name = {}
+        self._responding = {}
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def get(self, id, lang=None, ns=None):
+        """Return the first character with the id that speaks lang, in
+        the namespace ns if given"""
+        for character in self._ids.get(id, ()):
+            if ns is not None and character.name != ns:
+                continue
+            if lang is None or lang in character.languages:
+                return character
+
+    def by_type(self, type):
+        return self._types.get(type, [])
+
+    def by_name(self, name, local=True, lang=None, user=None):
+        """Return the characters with the name. The characters of other
+        users, with ids like "user/id", are left out when user is given."""
+        key = (name, local, lang)
+        characters = self._by_name.get(key)
+        if characters is None:
+            characters = self._names.get(name, [])
+            if local:
+                characters = [c for c in characters if c.local]
+            if lang is not None:
+                characters = [c for c in characters if lang in c.languages]
+            self._by_name[key] = characters
+        return self._of_user(characters, user)
+
+    def responding(self, botname, lang, user):
+        """Return the characters responding to the user in the bot's name,
+        sorted by level, and the generic character if it is appended to
+        them"""
+        key = (botname, lang)
+        if key not in self._responding:
+            characters = self.by_name(botname, local=False, lang=lang)
+            characters = sorted(characters, key=lambda x: x.level)
+            generic = self.get('generic', lang)
+            if generic:
+                if generic in characters:
+                    generic = None
+                else:
+                    characters.append(generic)
+            else:
+                logger.info("Generic character is not found")
+            characters = sorted(characters, key=lambda x: x.level)
+            self._responding[key] = characters, generic
+        characters, generic = self._responding[key]
+        return self._of_user(characters, user), generic
+
+    def _of_user(self, characters, user):
+        """Leave out the characters of other users than user, if given.
+        The lookups are cached for any user, so this is done per call."""
+        if user is None:
+            return characters
+        return [c for c in characters
+                if len(c.id.split('/')) != 2 or c.id.split('/')[0] == user]
@@ -0,0 +1,66 @@
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the buckets of the latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Timer(object):
+    """Seconds taken by the stages of one request"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages = []
+
+    def record(self, stage, start, tier=None):
+        """Record the stage, and the tier that answered in it, as started at
+        start and ending now"""
+        seconds = time.time() - start
+        self.stages.append((stage, tier, start - self.start, seconds))
+        return seconds
+
+    def report(self):
+        return {
+            'total': time.time() - self.start,
+            'stages': [
+                {'stage': stage, 'tier': tier, 'offset': offset,
+                 'seconds': seconds}
+                for stage, tier, offset, seconds in self.stages],
+        }
+
+
+class LatencyHistograms(object):
+    """Histograms of the seconds taken, by key"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._counts = {}
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, seconds):
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0]*(len(self.buckets)+1)
+                self._sums[key] = 0
+            counts[bisect_left(self.buckets, seconds)] += 1
+            self._sums[key] += seconds
+
+    def report(self):
+        """Return the count, the total seconds and the cumulative counts of
+        the buckets, by key. The last bucket has no upper bound."""
+        report = {}
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative, total = [], 0
+                for le, count in zip(self.buckets + ('inf',), counts):
+                    total += count
+                    cumulative.append((le, total))
+                report[key] = {
+                    'count': total,
+                    'seconds': self._sums[key],
+                    'buckets': cumulative,
+                }
+        return report
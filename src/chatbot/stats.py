@@ -81,11 +81,45 @@ def playback_history(df):
     df.loc[:,'Pattern'] = pd.Series(pattern_column, index=df.index)
     return df
 
-def pattern_stats(history_dir, days):
+def history_question(question):
+    """Return the question of a history row, or None if the row has none.
+    Empty questions are read as NaN."""
+    if isinstance(question, basestring):
+        return question if question.strip() else None
+    if pd.isnull(question):
+        return None
+    return str(question)
+
+def match_history(df, characters, processes=1):
+    """Fill the Pattern column with the patterns the questions match, in
+    the first of the AIML characters that matches them. Unlike
+    playback_history, the questions are matched in batches without a
+    server, and no template is processed. Rows without a question match
+    nothing."""
+    pattern_column = [[] for question in df.Question]
+    rows = [(patterns, history_question(question))
+            for patterns, question in zip(pattern_column, df.Question)]
+    rows = [(patterns, question) for patterns, question in rows
+            if question is not None]
+    questions = [question for patterns, question in rows]
+    for character in characters:
+        matches = character.batch_match(questions, processes)
+        for (patterns, question), question_matches in zip(rows, matches):
+            if patterns:
+                continue
+            patterns.extend(match['pattern'] for match in question_matches
+                            if match is not None)
+    df.loc[:,'Pattern'] = pd.Series(pattern_column, index=df.index)
+    return df
+
+def pattern_stats(history_dir, days, characters=None, processes=1):
     df = collect_history_data(history_dir, days)
     if df is None:
         return {}
-    df = playback_history(df)
+    if characters:
+        df = match_history(df, characters, processes)
+    else:
+        df = playback_history(df)
     patterns = sum(df.Pattern, [])
     counter = Counter(patterns)
     pattern_freq = pd.Series(counter)
@@ -6,10 +6,412 @@ import sys
 import time
 import subprocess
 import signal
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
 
 RCFILE = os.environ.get('COVERAGE_RCFILE', '.coveragerc')
 
 from chatbot.client import Client
+from chatbot.server.character import Character
+
+class FakeClock(object):
+    """A clock that only moves when it is told to"""
+
+    def __init__(self):
+        self.now = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+class StubCharacter(Character):
+    """Answers the questions in its table after a delay, or after moving
+    its clock by the delay if it has one. It can then be blocked until an
+    event is set. Unless it is speculative, it keeps the questions it is
+    asked in the session."""
+
+    def __init__(self, id, level, answers, delay=0, speculative=False):
+        super(StubCharacter, self).__init__(id, 'stub', level)
+        self.languages = ['en-US']
+        self.answers = answers
+        self.delay = delay
+        self.speculative = speculative
+        self.history = defaultdict(list)
+        self.clock = None
+        self.block = None
+
+    def respond(self, question, lang, session=None, query=False, request_id=None):
+        if self.clock is not None:
+            self.clock.advance(self.delay)
+        else:
+            time.sleep(self.delay)
+        if self.block is not None:
+            self.block.wait()
+        if not self.speculative and not query:
+            self.history[session.sid].append(question)
+        return {'text': self.answers.get(question, ''), 'trace': self.id}
+
+
+class AgentTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        os.environ.setdefault('HR_CHARACTER_PATH', os.path.join(
+            os.path.abspath(os.path.dirname(__file__)), 'characters'))
+        import chatbot.server.chatbot_agent
+        self.agent = chatbot.server.chatbot_agent
+
+    def setUp(self):
+        self.registry = self.agent.REGISTRY
+        self.config = dict(self.agent.config)
+        self.latency = dict(self.agent.TIER_LATENCY)
+        self.agent.TIER_LATENCY.clear()
+        self.blocks = []
+
+    def tearDown(self):
+        for block in self.blocks:
+            block.set()
+        self.agent.clock = time.time
+        self.agent.REGISTRY = self.registry
+        self.agent.config.update(self.config)
+        self.agent.TIER_LATENCY.clear()
+        self.agent.TIER_LATENCY.update(self.latency)
+
+    def stub_characters(self):
+        return [
+            StubCharacter('first', 0, {'a': 'first a'}, 0.1),
+            StubCharacter('remote', 1, {'b': 'remote b', 'c': 'remote c'},
+                          0.3, speculative=True),
+            StubCharacter('second', 2, {'c': 'second c', 'd': 'second d'}, 0.1),
+        ]
+
+    def budget_characters(self, clock, blocked=()):
+        """The stub characters, with a slow reduction tier and a dummy,
+        moving the clock. The blocked tiers answer once the test is
+        over."""
+        reduction = StubCharacter('reduction', 0, {'x': 'a'}, 0.3)
+        dummy = StubCharacter(
+            'dummy', 0, {'NO_ANSWER': 'no answer'}, speculative=True)
+        reduction.name = dummy.name = 'tools'
+        characters = self.stub_characters() + [reduction, dummy]
+        for c in characters:
+            c.clock = clock
+            if c.id in blocked:
+                c.block = threading.Event()
+                self.blocks.append(c.block)
+        return characters
+
+    def chat(self, characters, questions, **kwargs):
+        """Ask the stub characters the questions in a new session. Return
+        the answers, the traces and the state left in the session."""
+        from chatbot.server.registry import CharacterRegistry
+        agent = self.agent
+        agent.REGISTRY = CharacterRegistry(characters)
+        sid = agent.session_manager.start_session(
+            'test', 'test', test=True, refresh=True)
+        sess = agent.session_manager.get_session(sid)
+        sess.session_context.botname = 'stub'
+        sess.session_context.user = 'test'
+        sess.session_context.client_id = 'test'
+        responses = []
+        for question in questions:
+            response, ret = agent.ask(question, 'en-US', sid, **kwargs)
+            responses.append((ret, response.get('text'), response.get('trace'),
+                              response.get('CutTiers')))
+        state = [c.history[sid] for c in characters]
+        state.append([(r['Question'], r['Answer']) for r in sess.cache.record])
+        state.append(sess.last_used_character and sess.last_used_character.id)
+        return responses, state
+
+    def test_fan_out(self):
+        questions = ['a', 'b', 'c', 'd', 'e', 'a']
+        self.agent.config['TIER_FAN_OUT'] = False
+        sequential = self.chat(self.stub_characters(), questions)
+        self.agent.config['TIER_FAN_OUT'] = True
+        fan_out = self.chat(self.stub_characters(), questions)
+        self.assertEqual(sequential, fan_out)
+        self.assertEqual([r[1] for r in fan_out[0]],
+            ['first a', 'remote b', 'remote c', 'second d', '', 'first a'])
+
+    def test_time_budget(self):
+        agent = self.agent
+        agent.clock = clock = FakeClock()
+
+        # in time
+        characters = self.budget_characters(clock)
+        responses, state = self.chat(characters, ['x'], timeout=2)
+        self.assertEqual(responses[0][1], 'first a')
+        self.assertEqual(responses[0][3], [])
+
+        # the remote tier is still answering at the deadline
+        characters = [c for c in self.budget_characters(clock, ['remote'])
+                      if c.id != 'reduction']
+        responses, state = self.chat(characters, ['b'], timeout=0.35)
+        ret, text, trace, cut_tiers = responses[0]
+        self.assertEqual(text, 'no answer')
+        self.assertEqual(cut_tiers, ['remote', 'second'])
+        self.assertIn(('remote', 'loop', 'Timeout'), trace)
+        self.assertIn(('second', 'loop', 'Out of time'), trace)
+
+        # the second tier usually takes longer than the time left
+        characters = [c for c in self.budget_characters(clock)
+                      if c.id != 'reduction']
+        characters[2].delay = 5
+        self.chat(characters, ['d'])
+        responses, state = self.chat(characters, ['d'], timeout=1)
+        ret, text, trace, cut_tiers = responses[0]
+        self.assertEqual(text, 'no answer')
+        self.assertEqual(cut_tiers, ['second'])
+        self.assertIn(('second', 'loop', 'Out of time'), trace)
+        self.assertGreater(agent.tier_budget()['cuts']['second'], 0)
+
+        # the second tier keeps state in the session, so once it has
+        # started it answers past the deadline
+        responses, state = self.chat(characters, ['d'], timeout=5.5)
+        ret, text, trace, cut_tiers = responses[0]
+        self.assertEqual(text, 'second d')
+        self.assertEqual(cut_tiers, [])
+        self.assertEqual(state[2], ['d'])
+
+        # the budget covers the reduction tier too
+        characters = self.budget_characters(clock, ['reduction'])
+        characters[3].delay = 1
+        responses, state = self.chat(characters, ['x'], timeout=0.5)
+        ret, text, trace, cut_tiers = responses[0]
+        self.assertEqual(text, 'no answer')
+        self.assertEqual(cut_tiers[0], 'reduction')
+        self.assertIn(('reduction', 'reduction', 'Timeout'), trace)
+        for c in characters[:3]:
+            self.assertIn((c.id, 'loop', 'Out of time'), trace)
+
+    def test_prefetch(self):
+        questions = ['a', 'b', 'c', 'd', 'e', 'a']
+        sequential = self.chat(self.stub_characters(), questions)
+        characters = self.stub_characters()
+        characters[1].prefetch = True
+        start = time.time()
+        prefetch = self.chat(characters, questions)
+        self.assertEqual(sequential, prefetch)
+        # the remote tier answers while the first tier is asked twice
+        self.assertLess(time.time() - start, 2.5)
+
+    def test_swap_registry(self):
+        characters = self.stub_characters()
+        responses, state = self.chat(characters, ['a', 'd'])
+        self.assertEqual([r[1] for r in responses], ['first a', 'second d'])
+        characters = [c for c in self.stub_characters() if c.id != 'first']
+        characters.append(StubCharacter('other', 0, {'a': 'other a'}))
+        responses, state = self.chat(characters, ['a', 'd'])
+        self.assertEqual([r[1] for r in responses], ['other a', 'second d'])
+
+
+class RegistryTest(unittest.TestCase):
+
+    def character(self, id, name, level, languages=('en-US',), local=True):
+        character = Character(id, name, level)
+        character.languages = list(languages)
+        character.local = local
+        return character
+
+    def setUp(self):
+        from chatbot.server.registry import CharacterRegistry
+        self.english = self.character('sophia', 'sophia', 10)
+        self.chinese = self.character('sophia', 'sophia', 20, ['cmn-Hans-CN'])
+        self.remote = self.character('remote', 'sophia', 5, local=False)
+        self.own = self.character('test/sophia', 'sophia', 30)
+        self.other = self.character('other/sophia', 'sophia', 40)
+        self.generic = self.character('generic', 'generic', 50)
+        self.registry = CharacterRegistry([
+            self.english, self.chinese, self.remote, self.own, self.other,
+            self.generic])
+
+    def test_get(self):
+        registry = self.registry
+        self.assertIn('sophia', registry)
+        self.assertNotIn('han', registry)
+        self.assertIs(registry.get('sophia'), self.english)
+        self.assertIs(registry.get('sophia', 'cmn-Hans-CN'), self.chinese)
+        self.assertIs(registry.get('sophia', 'en-US', 'sophia'), self.english)
+        self.assertIsNone(registry.get('sophia', 'en-US', 'han'))
+        self.assertIsNone(registry.get('sophia', 'fr-FR'))
+        self.assertIsNone(registry.get('han'))
+
+    def test_by_name(self):
+        registry = self.registry
+        self.assertEqual(registry.by_name('sophia'),
+            [self.english, self.chinese, self.own, self.other])
+        self.assertEqual(registry.by_name('sophia', local=False),
+            [self.english, self.chinese, self.remote, self.own, self.other])
+        self.assertEqual(registry.by_name('sophia', lang='cmn-Hans-CN'),
+            [self.chinese])
+        self.assertEqual(registry.by_name('sophia', user='test'),
+            [self.english, self.chinese, self.own])
+        self.assertIs(registry.by_name('sophia'), registry.by_name('sophia'))
+        self.assertEqual(registry.by_name('han'), [])
+
+    def test_responding(self):
+        registry = self.registry
+        characters, generic = registry.responding('sophia', 'en-US', 'test')
+        self.assertEqual(characters,
+            [self.remote, self.english, self.own, self.generic])
+        self.assertIs(generic, self.generic)
+        characters, generic = registry.responding('generic', 'en-US', 'test')
+        self.assertEqual(characters, [self.generic])
+        self.assertIsNone(generic)
+        characters, generic = registry.responding(
+            'sophia', 'cmn-Hans-CN', 'test')
+        self.assertEqual(characters, [self.chinese])
+        self.assertIsNone(generic)
+
+    def test_users_not_cached(self):
+        registry = self.registry
+        for user in ('test', 'other', 'third'):
+            registry.responding('sophia', 'en-US', user)
+        characters, generic = registry.responding('sophia', 'en-US', 'other')
+        self.assertEqual(characters,
+            [self.remote, self.english, self.other, self.generic])
+        self.assertEqual(len(registry._responding), 1)
+        self.assertEqual(len(registry._by_name), 1)
+
+
+class TimingTest(unittest.TestCase):
+
+    def test_timer(self):
+        from chatbot.server.timing import Timer
+        timer = Timer()
+        start = time.time()
+        time.sleep(0.01)
+        seconds = timer.record('reduction', start, 'generic')
+        timer.record('ask', timer.start)
+        report = timer.report()
+        self.assertGreaterEqual(seconds, 0.01)
+        self.assertGreaterEqual(report['total'], seconds)
+        self.assertEqual([(s['stage'], s['tier']) for s in report['stages']],
+            [('reduction', 'generic'), ('ask', None)])
+        self.assertEqual(report['stages'][0]['seconds'], seconds)
+        self.assertGreaterEqual(report['stages'][0]['offset'], 0)
+        self.assertEqual(report['stages'][1]['offset'], 0)
+
+    def test_histograms(self):
+        from chatbot.server.timing import LatencyHistograms
+        histograms = LatencyHistograms((0.1, 1))
+        for seconds in (0.05, 0.1, 0.5, 2, 3):
+            histograms.add('sophia', seconds)
+        histograms.add('generic', 0.5)
+        report = histograms.report()
+        self.assertEqual(sorted(report), ['generic', 'sophia'])
+        self.assertEqual(report['sophia']['count'], 5)
+        self.assertAlmostEqual(report['sophia']['seconds'], 5.65)
+        self.assertEqual(report['sophia']['buckets'],
+            [(0.1, 2), (1, 3), ('inf', 5)])
+        self.assertEqual(report['generic']['buckets'],
+            [(0.1, 0), (1, 1), ('inf', 1)])
+
+
+class BrainTest(unittest.TestCase):
+
+    def setUp(self):
+        import chatbot.server.character
+        self.character = chatbot.server.character
+        self.config = (self.character.BRAIN_CACHE_DIR,
+                       self.character.SHARE_BRAINS)
+        self.character.BRAIN_CACHE_DIR = None
+        self.character.SHARE_BRAINS = True
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        (self.character.BRAIN_CACHE_DIR,
+         self.character.SHARE_BRAINS) = self.config
+        shutil.rmtree(self.tmp_dir)
+
+    def write_aiml(self, name, categories, mtime):
+        fname = os.path.join(self.tmp_dir, name)
+        with open(fname, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<aiml>\n')
+            for pattern, template in sorted(categories.items()):
+                f.write('<category><pattern>{}</pattern><template>{}'
+                        '</template></category>\n'.format(pattern, template))
+            f.write('</aiml>\n')
+        os.utime(fname, (mtime, mtime))
+        return fname
+
+    def test_snapshot(self):
+        from chatbot.aiml import Kernel
+        from chatbot.server.brain import BrainSnapshotCache, aiml_files_digest
+        fname = self.write_aiml('test.aiml', {'HELLO': 'hi', 'BYE': 'bye'}, 1)
+        cache = BrainSnapshotCache(os.path.join(self.tmp_dir, 'cache'))
+        for brain_type in ['dict', 'compiled', 'mapped']:
+            kernel = Kernel()
+            kernel.setBrainType(brain_type)
+            kernel.learn(fname)
+            digest = aiml_files_digest(kernel, [fname])
+            self.assertFalse(cache.load(kernel, digest))
+            cache.save(kernel, digest)
+
+            restored = Kernel()
+            restored.setBrainType(brain_type)
+            self.assertTrue(cache.load(restored, digest))
+            self.assertEqual(restored.getBrainType(), brain_type)
+            self.assertEqual(restored.numCategories(), 2)
+            self.assertEqual(restored.getLearnedFiles(), [fname])
+            self.assertEqual(restored.respond('hello'), 'hi')
+            restored.unlearn(fname)
+            self.assertEqual(restored.respond('hello'), '')
+            os.remove(cache.path(kernel, digest))
+
+        # the snapshot of other contents isn't used
+        self.write_aiml('test.aiml', {'HELLO': 'hello again'}, 2)
+        self.assertNotEqual(aiml_files_digest(kernel, [fname]), digest)
+
+    def test_reload_shared_brain(self):
+        fname = self.write_aiml('test.aiml', {'HELLO': 'hi', 'BYE': 'bye'}, 1)
+        characters = [self.character.AIMLCharacter(id, 'test')
+                      for id in ('one', 'two')]
+        for character in characters:
+            character.load_aiml_files(character.kernel, [fname])
+        brain = characters[0].kernel._brain
+        self.assertIs(characters[1].kernel._brain, brain)
+
+        self.write_aiml('test.aiml', {'HELLO': 'hello again'}, 2)
+        for character in characters:
+            self.assertEqual(character.reload_changed_files(), ([fname], []))
+        # the first character reloads, the second shares its new brain
+        self.assertIsNot(characters[0].kernel._brain, brain)
+        self.assertIs(characters[1].kernel._brain, characters[0].kernel._brain)
+        for character in characters:
+            self.assertEqual(character.kernel.respond('hello'), 'hello again')
+            self.assertEqual(character.kernel.respond('bye'), '')
+            self.assertEqual(character.reload_changed_files(), ([], []))
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_match_history(self):
+        import pandas as pd
+        from chatbot.stats import match_history
+
+        class BatchCharacter(object):
+            def __init__(self):
+                self.questions = []
+
+            def batch_match(self, questions, processes=1):
+                self.questions.extend(questions)
+                return [[{'pattern': question.upper()}]
+                        for question in questions]
+
+        character = BatchCharacter()
+        df = pd.DataFrame({'Question': ['hi', float('nan'), ' ', 'bye']})
+        df = match_history(df, [character], processes=2)
+        # the rows without a question aren't matched as "nan"
+        self.assertEqual(character.questions, ['hi', 'bye'])
+        self.assertEqual(list(df.Pattern), [['HI'], [], [], ['BYE']])
+
 
 class ChatbotTest(unittest.TestCase):
 
@@ -70,6 +472,16 @@ class ChatbotTest(unittest.TestCase):
         response = cli2.ask('hello sophia')
         self.assertTrue(response.get('text') == 'Hi there from sophia')
 
+    def test_chat_timeout(self):
+        import requests
+        cli = Client('AAAAB3NzaC', botname='generic', port=self.port, test=True)
+        while not cli.ping():
+            time.sleep(1)
+        r = requests.get('http://localhost:{}/v2.0/chat'.format(self.port),
+            params={'Auth': 'AAAAB3NzaC', 'question': 'hi', 'session': 'test',
+                    'timeout': 'soon'})
+        self.assertEqual(r.status_code, 400)
+
     def test_session_manager(self):
         from chatbot.server.session import SessionManager
         session_manager = SessionManager(False)